@@ -1,7 +1,12 @@
-from typing import Dict, Callable, Any, Optional
-from gold.api_calls.google_calls import handle_google_call
-from gold.api_calls.mixtral_calls import handle_mixtral_call
-from gold.api_calls.openai_call import handle_openai_call
+import time
+from typing import Dict, Callable, Any, Optional, Iterator, List, Tuple, Awaitable
+from api_calls.google_calls import handle_google_call, handle_google_call_async
+from api_calls.mixtral_calls import handle_mixtral_call, handle_mixtral_call_async
+from api_calls.openai_call import handle_openai_call, handle_openai_call_async, handle_openai_call_stream
+from api_calls.llm_cache import get_llm_cache
+from api_calls.rate_limiter import get_request_scheduler, estimate_request_tokens
+from api_calls.model_router import get_model_router
+from api_calls.hedging import get_request_hedger
 
 
 def make_multi_provider_call(call_type: str,
@@ -23,11 +28,174 @@ def make_multi_provider_call(call_type: str,
         tools:      A dictionary mapping tool names to callable functions that
                     implement the tool's logic.
         **kwargs:   Additional keyword arguments for finer control of the API call.
+                    refresh_cache=True skips the cache lookup (the new response is still stored),
+                    except in replay mode, where every response has to come from the cache.
+                    task="draft" / "refine" / "json" / "code" lets the model router pick the provider and model,
+                    if config has no model (see api_calls.model_router).
+                    hedge=True / False sends, or doesn't send, a duplicate of the call if it is slow,
+                    None follows the HEDGING config (see api_calls.hedging).
 
     Returns:
         str: The response from the executed API call.
     """
+    provider, config, task = _route_call(provider, input_text, config, kwargs)
+    hedge: Optional[bool] = kwargs.pop("hedge", None)
+    cache = get_llm_cache()
+    refresh_cache: bool = kwargs.pop("refresh_cache", False)
+    cache_key = cache.make_key(call_type, provider, input_text, config, kwargs)
+    # Replay mode never makes a real call, a refresh still has to come from the cache (or raise on a miss)
+    if not refresh_cache or cache.mode == "replay":
+        cached_response: Optional[str] = cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
 
+    # Waits for rate limit budget, and retries the call if it is rate limited anyway.
+    # The hedge delay starts once the budget is granted, and a hedge is only sent if it gets budget right away
+    estimated_tokens = estimate_request_tokens(input_text, kwargs)
+    scheduler = get_request_scheduler()
+    response = scheduler.run(
+        provider, config.get("model"), estimated_tokens,
+        lambda: get_request_hedger().run(
+            lambda: _timed_call(provider, config.get("model"), task,
+                                lambda: _call_provider(call_type, provider, input_text, config, tools, **kwargs)),
+            provider, config.get("model"), task, hedge=hedge,
+            can_hedge=lambda: scheduler.try_acquire(provider, config.get("model"), estimated_tokens)))
+
+    cache.put(cache_key, response, provider=provider, model=config.get("model"))
+    return response
+
+
+async def make_multi_provider_call_async(call_type: str,
+                                         provider: str,
+                                         input_text: str,
+                                         config: Dict[str, Any],
+                                         tools: Optional[Dict[str, Callable]] = None,
+                                         **kwargs) -> Any:
+    """
+    Async version of make_multi_provider_call, takes the same arguments and returns the same thing.
+    Every provider keeps one keep-alive connection pool, so hundreds of these can be awaited at once
+    (e.g. with asyncio.gather) from a single event loop without a thread per request.
+    """
+    provider, config, task = _route_call(provider, input_text, config, kwargs)
+    hedge: Optional[bool] = kwargs.pop("hedge", None)
+    cache = get_llm_cache()
+    refresh_cache: bool = kwargs.pop("refresh_cache", False)
+    cache_key = cache.make_key(call_type, provider, input_text, config, kwargs)
+    # Replay mode never makes a real call, a refresh still has to come from the cache (or raise on a miss)
+    if not refresh_cache or cache.mode == "replay":
+        cached_response: Optional[str] = cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+    # Waits for rate limit budget, and retries the call if it is rate limited anyway.
+    # The hedge delay starts once the budget is granted, and a hedge is only sent if it gets budget right away
+    estimated_tokens = estimate_request_tokens(input_text, kwargs)
+    scheduler = get_request_scheduler()
+    response = await scheduler.run_async(
+        provider, config.get("model"), estimated_tokens,
+        lambda: get_request_hedger().run_async(
+            lambda: _timed_call_async(provider, config.get("model"), task,
+                                      lambda: _call_provider_async(call_type, provider, input_text, config, tools,
+                                                                   **kwargs)),
+            provider, config.get("model"), task, hedge=hedge,
+            can_hedge=lambda: scheduler.try_acquire(provider, config.get("model"), estimated_tokens)))
+
+    cache.put(cache_key, response, provider=provider, model=config.get("model"))
+    return response
+
+
+def make_multi_provider_call_stream(call_type: str,
+                                    provider: str,
+                                    input_text: str,
+                                    config: Dict[str, Any],
+                                    tools: Optional[Dict[str, Callable]] = None,
+                                    **kwargs) -> Iterator[str]:
+    """
+    Streaming version of make_multi_provider_call, yields the response text as it arrives.
+    A cached response is yielded all at once. Providers that can't stream yet give the whole response as one piece.
+    Closing the generator early cancels the request, and caches the text read up to then, so a cached stream
+    gives back what its first reader read (EX: the response up to the end of the code block).
+    Streams have their own cache keys, a partial response is never given to make_multi_provider_call.
+    Streams are routed by their task too, but aren't timed or hedged, the time to the first piece isn't comparable.
+    """
+    provider, config, _ = _route_call(provider, input_text, config, kwargs)
+    if provider != "openai":
+        yield make_multi_provider_call(call_type, provider, input_text, config, tools, **kwargs)
+        return
+
+    kwargs.pop("hedge", None)
+    cache = get_llm_cache()
+    refresh_cache: bool = kwargs.pop("refresh_cache", False)
+    # The stream marker keeps what a reader read (maybe only part of the response) apart from full responses
+    cache_key = cache.make_key(call_type, provider, input_text, config, {**kwargs, "stream": True})
+    # Replay mode never makes a real call, a refresh still has to come from the cache (or raise on a miss)
+    if not refresh_cache or cache.mode == "replay":
+        cached_response: Optional[str] = cache.get(cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+    pieces: List[str] = []
+    stream = get_request_scheduler().run_stream(
+        provider, config.get("model"), estimate_request_tokens(input_text, kwargs),
+        lambda: handle_openai_call_stream(call_type, input_text, config, tools, **kwargs))
+    try:
+        for piece in stream:
+            pieces.append(piece)
+            yield piece
+    except GeneratorExit:
+        # The reader stopped early (EX: extract_code_from_stream once the code block is closed),
+        # what it read is everything it needed, so that is what gets cached
+        if pieces:
+            cache.put(cache_key, "".join(pieces), provider=provider, model=config.get("model"))
+        raise
+    else:
+        cache.put(cache_key, "".join(pieces), provider=provider, model=config.get("model"))
+    finally:
+        stream.close()
+
+
+def _route_call(provider: str, input_text: str, config: Dict[str, Any],
+                kwargs: Dict[str, Any]) -> Tuple[str, Dict[str, Any], Optional[str]]:
+    """
+    Takes the task out of kwargs, and asks the router for the provider and model if config doesn't pin a model
+    :return: provider, config, task
+    """
+    task: Optional[str] = kwargs.pop("task", None)
+    if task is None or config.get("model"):
+        return provider, config, task
+    provider, model = get_model_router().choose(task, input_text, kwargs.get("max_tokens"))
+    return provider, {**config, "model": model}, task
+
+
+def _timed_call(provider: str, model: Optional[str], task: Optional[str], call: Callable[[], Any]) -> Any:
+    """
+    Makes the call and adds its latency, or its error, to the stats of the router
+    """
+    start_time = time.perf_counter()
+    try:
+        response = call()
+    except Exception:
+        get_model_router().record(provider, model, task, time.perf_counter() - start_time, succeeded=False)
+        raise
+    get_model_router().record(provider, model, task, time.perf_counter() - start_time, succeeded=True)
+    return response
+
+
+async def _timed_call_async(provider: str, model: Optional[str], task: Optional[str],
+                            call: Callable[[], Awaitable[Any]]) -> Any:
+    start_time = time.perf_counter()
+    try:
+        response = await call()
+    except Exception:
+        get_model_router().record(provider, model, task, time.perf_counter() - start_time, succeeded=False)
+        raise
+    get_model_router().record(provider, model, task, time.perf_counter() - start_time, succeeded=True)
+    return response
+
+
+def _call_provider(call_type: str, provider: str, input_text: str, config: Dict[str, Any],
+                   tools: Optional[Dict[str, Callable]] = None, **kwargs) -> Any:
     # Provider-Specific Logic
     if provider == "google":
         response = handle_google_call(call_type, input_text, config, tools, **kwargs)
@@ -37,5 +205,18 @@ def make_multi_provider_call(call_type: str,
         response = handle_mixtral_call(call_type, input_text, config, tools, **kwargs)
     else:
         raise ValueError(f"Unsupported provider: {provider}")
+    return response
+
 
-    return response
\ No newline at end of file
+async def _call_provider_async(call_type: str, provider: str, input_text: str, config: Dict[str, Any],
+                               tools: Optional[Dict[str, Callable]] = None, **kwargs) -> Any:
+    # Provider-Specific Logic
+    if provider == "google":
+        response = await handle_google_call_async(call_type, input_text, config, tools, **kwargs)
+    elif provider == "openai":
+        response = await handle_openai_call_async(call_type, input_text, config, tools, **kwargs)
+    elif provider == "mixtral":
+        response = await handle_mixtral_call_async(call_type, input_text, config, tools, **kwargs)
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+    return response
@@ -1,6 +1,4 @@
-from openai import OpenAI
 from global_code.singleton import State
-import openai
 
 
 def code_feedback_agent_call(initial_prompt: str, code: str) -> str:
@@ -34,6 +32,8 @@ def code_feedback_agent_call(initial_prompt: str, code: str) -> str:
                 }
         },
         {"type": "code_interpreter"}]
+    from openai import OpenAI
+
     client = OpenAI(api_key=State.config['OPENAI']['API_KEY'])
     completion = client.chat.completions.create(
         messages=[{"role": "user", "content": "Check to see if the code looks good"}],
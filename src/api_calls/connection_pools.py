@@ -0,0 +1,44 @@
+from typing import Dict, Optional, Any
+
+# One keep-alive pool per provider, shared by every async call made from the event loop.
+# httpx pools are bound to the event loop that opened the connections, so use a single loop per process
+# (or call close_async_http_clients before switching loops).
+# These are the keyword arguments of httpx.Limits, httpx is only imported when the first pool is made
+ASYNC_POOL_LIMITS: Dict[str, Dict[str, Any]] = {
+    "openai": {"max_connections": 200, "max_keepalive_connections": 100, "keepalive_expiry": 30.0},
+    "mixtral": {"max_connections": 100, "max_keepalive_connections": 50, "keepalive_expiry": 30.0},
+    "google": {"max_connections": 100, "max_keepalive_connections": 50, "keepalive_expiry": 30.0},
+}
+ASYNC_POOL_TIMEOUT_SECONDS = 600.0
+ASYNC_POOL_CONNECT_TIMEOUT_SECONDS = 10.0
+
+_async_http_clients: Dict[str, Any] = {}
+
+
+def get_async_http_client(provider: str, limits: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Returns the shared async HTTP client (and its connection pool) for a provider.
+    The client is created on first use and reused for every call after that.
+    :param provider: the provider the pool is for (e.g. "openai", "mixtral", "google")
+    :param limits: httpx.Limits keyword arguments, only used the first time the pool is created,
+    defaults to ASYNC_POOL_LIMITS[provider]
+    :return: the httpx.AsyncClient for that provider
+    """
+    http_client = _async_http_clients.get(provider)
+    if http_client is None or http_client.is_closed:
+        import httpx
+
+        http_client = httpx.AsyncClient(limits=httpx.Limits(**(limits or ASYNC_POOL_LIMITS.get(provider, {}))),
+                                        timeout=httpx.Timeout(ASYNC_POOL_TIMEOUT_SECONDS,
+                                                              connect=ASYNC_POOL_CONNECT_TIMEOUT_SECONDS))
+        _async_http_clients[provider] = http_client
+    return http_client
+
+
+async def close_async_http_clients() -> None:
+    """
+    Closes every shared provider pool. Call this before the event loop shuts down.
+    :return: None
+    """
+    for provider in list(_async_http_clients):
+        await _async_http_clients.pop(provider).aclose()
@@ -1,9 +1,14 @@
 # import google.cloud.language_v1 as language
 from typing import Dict, Any, Callable
 
+from global_code.helpful_functions import CustomError
+
 
 def handle_google_call(call_type: str, input_text: str, config: Dict[str, Any], tools: Dict[str, Callable],
                         **kwargs) -> str:
+    """
+    CAN RAISE AN ERROR: CustomError, google isn't supported yet
+    """
     if call_type != "llm":
         raise ValueError("Google provider currently only supports LLM calls")
 
@@ -16,4 +21,17 @@ def handle_google_call(call_type: str, input_text: str, config: Dict[str, Any],
     # response = client.analyze_entities(document=document, features=features)
     #
     # # TODO: Extract and format desired results from 'response' before returning
-    return "Google LLM Response (Modify based on the results you want)"
\ No newline at end of file
+    raise CustomError("The google provider isn't supported yet, use openai", error_type="provider_not_supported")
+
+
+async def handle_google_call_async(call_type: str, input_text: str, config: Dict[str, Any], tools: Dict[str, Callable],
+                                   **kwargs) -> str:
+    """
+    Async version of handle_google_call. When this is implemented it should use
+    get_async_http_client("google") so it shares the google connection pool.
+    CAN RAISE AN ERROR: CustomError, google isn't supported yet
+    """
+    if call_type != "llm":
+        raise ValueError("Google provider currently only supports LLM calls")
+
+    raise CustomError("The google provider isn't supported yet, use openai", error_type="provider_not_supported")
@@ -0,0 +1,235 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, Optional, Callable, Awaitable, Set
+
+from global_code.helpful_functions import create_logger_error, log_it
+from global_code.metrics import get_metrics_registry
+from global_code.singleton import State
+
+logger = create_logger_error(os.path.abspath(__file__), "hedging", log_to_console=True, log_to_file=True)
+
+
+class RequestHedger:
+    """
+    Hedged requests, for the few LLM calls that take many times longer than the rest.
+    If a call hasn't returned after the hedge delay, the same call is sent again and the first response wins.
+    The delay is the quantile (EX: p90) of the latency of that (provider, model, task), from the
+    llm_call_duration_seconds histogram the model router records, so only the slowest calls get a duplicate.
+    The hedges are capped at max_hedge_rate of the calls, so the extra cost is bounded.
+    It runs after the rate limiter let the call through, so time spent queued for budget never counts towards the
+    delay, and a hedge is only sent if can_hedge takes budget for it right away (no hedges under rate limit pressure).
+    Async calls that lose are cancelled. Sync calls can't be stopped once sent, the loser runs to the end in the
+    background and its response is thrown away.
+    Off unless enabled, or a call is made with hedge=True.
+    To use:
+        response = get_request_hedger().run(lambda: make_the_call(), "openai", "gpt-4", "code",
+                                            can_hedge=lambda: scheduler.try_acquire("openai", "gpt-4", tokens))
+    """
+
+    def __init__(self, enabled: bool = False, quantile: float = 0.9, min_delay_seconds: float = 1.0,
+                 max_hedge_rate: float = 0.1, min_samples: int = 20, max_workers: int = 32):
+        """
+        :param enabled: hedge every call, otherwise only the calls made with hedge=True
+        :param quantile: the latency quantile a call has to go past to be hedged, EX: 0.9
+        :param min_delay_seconds: never hedge earlier than this
+        :param max_hedge_rate: the max fraction of calls that get a hedge, EX: 0.1 for at most 10% more calls
+        :param min_samples: the calls of a (provider, model, task) needed before its quantile is trusted,
+        it isn't hedged before that
+        :param max_workers: the threads the sync calls and their hedges run on
+        """
+        if not 0 < quantile < 1:
+            raise ValueError("quantile must be between 0 and 1")
+        if max_hedge_rate < 0:
+            raise ValueError("max_hedge_rate can't be negative")
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay_seconds = min_delay_seconds
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def hedge_delay(self, provider: str, model: Optional[str], task: Optional[str]) -> Optional[float]:
+        """
+        :return: how many seconds to wait before sending a hedge, None if there aren't enough samples yet
+        """
+        histogram = get_metrics_registry().histogram("llm_call_duration_seconds", "How long an LLM call took",
+                                                     provider=provider, model=model or "", task=task or "none")
+        if histogram.count < self.min_samples:
+            return None
+        return max(self.min_delay_seconds, histogram.quantile(self.quantile))
+
+    def run(self, call: Callable[[], Any], provider: str, model: Optional[str], task: Optional[str],
+            hedge: Optional[bool] = None, can_hedge: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Makes the call, and a hedge of it if it is too slow
+        :param call: makes the request, it is called a second time for the hedge
+        :param hedge: True or False to hedge this call or not, None to follow enabled
+        :param can_hedge: takes the rate limit budget of the hedge, False if there is none, None if it needs none
+        :return: the first response, the error of the call if both of them failed
+        """
+        delay = self._start(provider, model, task, hedge)
+        if delay is None:
+            return call()
+        primary = self._get_executor().submit(call)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        if not self._take_hedge(provider, model, task, delay, can_hedge):
+            return primary.result()
+
+        futures: Dict[Future, bool] = {primary: False, self._get_executor().submit(call): True}
+        pending: Set[Future] = set(futures)
+        first_error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    self._finish(provider, model, task, hedge_won=futures[future])
+                    return future.result()
+                first_error = first_error or future.exception()
+        raise first_error
+
+    async def run_async(self, call: Callable[[], Awaitable[Any]], provider: str, model: Optional[str],
+                        task: Optional[str], hedge: Optional[bool] = None,
+                        can_hedge: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Async version of run, call has to return an awaitable. The loser is cancelled, which closes its request
+        """
+        delay = self._start(provider, model, task, hedge)
+        if delay is None:
+            return await call()
+        primary = asyncio.ensure_future(call())
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            return primary.result()
+        if not self._take_hedge(provider, model, task, delay, can_hedge):
+            return await primary
+
+        hedge_task = asyncio.ensure_future(call())
+        pending: Set[asyncio.Future] = {primary, hedge_task}
+        first_error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is None:
+                        self._finish(provider, model, task, hedge_won=finished is hedge_task)
+                        return finished.result()
+                    first_error = first_error or finished.exception()
+            raise first_error
+        finally:
+            for loser in pending:
+                loser.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: how many calls were hedged, and how often the hedge was faster
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedges / self.calls if self.calls else 0.0,
+            }
+
+    def _start(self, provider: str, model: Optional[str], task: Optional[str],
+               hedge: Optional[bool]) -> Optional[float]:
+        """
+        Counts the call
+        :return: the hedge delay, None if the call isn't hedged
+        """
+        if not (self.enabled if hedge is None else hedge):
+            return None
+        with self._lock:
+            self.calls += 1
+        return self.hedge_delay(provider, model, task)
+
+    def _take_hedge(self, provider: str, model: Optional[str], task: Optional[str], delay: float,
+                    can_hedge: Optional[Callable[[], bool]]) -> bool:
+        """
+        :return: True if the hedge rate has room for one more hedge and there is budget for it, it is counted
+        """
+        with self._lock:
+            if self.hedges >= self.max_hedge_rate * self.calls:
+                return False
+        if can_hedge is not None and not can_hedge():
+            # The hedge would only wait behind the call it duplicates, and take budget from the calls in the queue
+            return False
+        with self._lock:
+            self.hedges += 1
+        get_metrics_registry().counter("llm_hedges_total", "Duplicate LLM calls sent for slow calls",
+                                       provider=provider, model=model or "", task=task or "none").inc()
+        log_it(logger, error=None, custom_message=f"{provider}/{model} ({task}) took more than {delay:.2f}s, "
+                                                  f"sending a hedge", log_level="debug")
+        return True
+
+    def _finish(self, provider: str, model: Optional[str], task: Optional[str], hedge_won: bool) -> None:
+        if not hedge_won:
+            return
+        with self._lock:
+            self.hedge_wins += 1
+        get_metrics_registry().counter("llm_hedge_wins_total", "Hedges that returned before the call they duplicated",
+                                       provider=provider, model=model or "", task=task or "none").inc()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix="llm_hedge")
+        return self._executor
+
+
+_request_hedger: Optional[RequestHedger] = None
+_request_hedger_lock = threading.Lock()
+
+
+def get_request_hedger() -> RequestHedger:
+    """
+    Returns the hedger used by make_multi_provider_call.
+    It is off by default, turn it on from the HEDGING section of config.yaml, EX:
+    HEDGING:
+      ENABLED: true
+      QUANTILE: 0.9
+      MIN_DELAY_SECONDS: 1.0
+      MAX_HEDGE_RATE: 0.1
+      MIN_SAMPLES: 20
+    :return: the RequestHedger
+    """
+    global _request_hedger
+    if _request_hedger is None:
+        with _request_hedger_lock:
+            if _request_hedger is None:
+                hedging_config: Dict[str, Any] = State.config.get("HEDGING") or {}
+                _request_hedger = RequestHedger(enabled=bool(hedging_config.get("ENABLED", False)),
+                                                quantile=float(hedging_config.get("QUANTILE", 0.9)),
+                                                min_delay_seconds=float(hedging_config.get("MIN_DELAY_SECONDS", 1.0)),
+                                                max_hedge_rate=float(hedging_config.get("MAX_HEDGE_RATE", 0.1)),
+                                                min_samples=int(hedging_config.get("MIN_SAMPLES", 20)))
+    return _request_hedger
+
+
+def configure_request_hedger(**kwargs) -> RequestHedger:
+    """
+    Replaces the hedger used by make_multi_provider_call, EX: configure_request_hedger(enabled=True)
+    :param kwargs: the arguments of RequestHedger
+    :return: the new RequestHedger
+    """
+    global _request_hedger
+    _request_hedger = RequestHedger(**kwargs)
+    return _request_hedger
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from global_code.helpful_functions import CustomError, create_logger_error, log_it
+from global_code.singleton import State
+
+logger = create_logger_error(os.path.abspath(__file__), "llm_cache", log_to_console=False, log_to_file=True)
+
+CACHE_MODES = ["off", "read_write", "replay"]
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "llm_responses")
+# When the cache is too big it is trimmed down to this fraction of max_size_bytes, so it isn't trimmed on every write
+EVICTION_TARGET_RATIO = 0.9
+
+
+class LLMResponseCache:
+    """
+    Content addressed on disk cache for LLM responses.
+    Every entry is keyed on the sha256 of (call type, provider, model, temperature, the rest of the settings, the prompt)
+    and lives in its own json file, so the cache survives restarts and can be shared between runs.
+    Entries not used for max_age_seconds are dropped, and the least recently used entries are evicted
+    once the cache grows past max_size_bytes.
+    Modes:
+        off: never read or write
+        read_write: return cached responses, and store new ones
+        replay: read only, a miss raises a CustomError instead of calling the LLM. Use it for deterministic reruns
+    """
+
+    def __init__(self, cache_directory: str = DEFAULT_CACHE_DIRECTORY, mode: str = "read_write",
+                 max_size_bytes: int = 500 * 1024 * 1024, max_age_seconds: Optional[float] = 30 * 24 * 60 * 60):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unsupported cache mode: {mode}, must be one of {CACHE_MODES}")
+        self.cache_directory = cache_directory
+        self.mode = mode
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+
+    @staticmethod
+    def make_key(call_type: str, provider: str, input_text: str, config: Dict[str, Any],
+                 kwargs: Dict[str, Any]) -> str:
+        """
+        Builds the content address for a call
+        :return: hex sha256 of everything that can change the response
+        """
+        key_parts = {
+            "call_type": call_type,
+            "provider": provider,
+            "model": config.get("model"),
+            "temperature": kwargs.get("temperature"),
+            "config": config,
+            "kwargs": kwargs,
+            "prompt_sha256": hashlib.sha256(input_text.encode("utf-8")).hexdigest(),
+        }
+        serialized = json.dumps(key_parts, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Looks up a response.
+        CAN RAISE AN ERROR: in replay mode a miss raises CustomError
+        :param key: the key from make_key
+        :return: the cached response or None on a miss
+        """
+        if self.mode == "off":
+            return None
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "r") as entry_file:
+                entry: Dict[str, Any] = json.load(entry_file)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is not None and self._is_expired(entry_path) and self.mode != "replay":
+            self._remove(entry_path)
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if entry is None:
+            if self.mode == "replay":
+                raise CustomError(f"LLM cache replay miss for key {key}", error_type="cache_replay_miss")
+            return None
+
+        # Touch the entry so eviction removes the least recently used entries first
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return entry["response"]
+
+    def put(self, key: str, response: Any, provider: str, model: Optional[str]) -> None:
+        """
+        Stores a response. Only text responses are cached, and nothing is written in replay or off mode.
+        :param key: the key from make_key
+        :param response: the response from the LLM
+        :param provider: what provider made the response
+        :param model: what model made the response
+        :return: None
+        """
+        if self.mode != "read_write" or not isinstance(response, str):
+            return
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        entry = {"response": response, "provider": provider, "model": model, "created_at": time.time()}
+
+        # Write to a temp file and rename it so a reader never sees a half written entry
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        with os.fdopen(file_descriptor, "w") as temp_file:
+            json.dump(entry, temp_file)
+        old_size = os.path.getsize(entry_path) if os.path.exists(entry_path) else 0
+        os.replace(temp_path, entry_path)
+
+        with self._lock:
+            self.writes += 1
+            if self._total_bytes is not None:
+                self._total_bytes += os.path.getsize(entry_path) - old_size
+        if self._current_size() > self.max_size_bytes:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Removes expired entries, and then the least recently used entries until the cache is
+        under EVICTION_TARGET_RATIO of max_size_bytes
+        :return: how many entries were removed
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_directory):
+            for file in files:
+                if file.endswith(".json"):
+                    stat = os.stat(os.path.join(root, file))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+        entries.sort()
+
+        removed = 0
+        total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = self.max_size_bytes * EVICTION_TARGET_RATIO
+        now = time.time()
+        for last_used, size, entry_path in entries:
+            too_old = self.max_age_seconds is not None and now - last_used > self.max_age_seconds
+            if not too_old and total_bytes <= target_bytes:
+                continue
+            if self._remove(entry_path, count_size=False):
+                total_bytes -= size
+                removed += 1
+
+        with self._lock:
+            self._total_bytes = total_bytes
+            self.evictions += removed
+        if removed:
+            log_it(logger, error=None, custom_message=f"Evicted {removed} LLM cache entries", log_level="info")
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: the hit/miss counters of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"mode": self.mode, "hits": self.hits, "misses": self.misses, "writes": self.writes,
+                    "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_directory, key[:2], f"{key}.json")
+
+    def _is_expired(self, entry_path: str) -> bool:
+        # Age is measured from the last time the entry was used, the same as evict
+        try:
+            return self.max_age_seconds is not None and time.time() - os.path.getmtime(entry_path) > self.max_age_seconds
+        except OSError:
+            return True
+
+    def _current_size(self) -> int:
+        if self._total_bytes is None:
+            total_bytes = 0
+            for root, _, files in os.walk(self.cache_directory):
+                total_bytes += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+            with self._lock:
+                self._total_bytes = total_bytes
+        return self._total_bytes
+
+    def _remove(self, entry_path: str, count_size: bool = True) -> bool:
+        try:
+            size = os.path.getsize(entry_path)
+            os.remove(entry_path)
+        except OSError:
+            return False
+        if count_size:
+            with self._lock:
+                if self._total_bytes is not None:
+                    self._total_bytes -= size
+        return True
+
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """
+    Returns the cache used by make_multi_provider_call.
+    It is set up from the LLM_CACHE section of config.yaml the first time it is used, EX:
+    LLM_CACHE:
+      MODE: read_write  # off, read_write or replay
+      DIRECTORY: /path/to/cache
+      MAX_SIZE_MB: 500
+      MAX_AGE_DAYS: 30
+    :return: the LLMResponseCache
+    """
+    global _llm_cache
+    if _llm_cache is None:
+        cache_config: Dict[str, Any] = State.config.get("LLM_CACHE") or {}
+        max_age_days = cache_config.get("MAX_AGE_DAYS", 30)
+        _llm_cache = LLMResponseCache(cache_directory=cache_config.get("DIRECTORY", DEFAULT_CACHE_DIRECTORY),
+                                      mode=cache_config.get("MODE", "read_write"),
+                                      max_size_bytes=int(cache_config.get("MAX_SIZE_MB", 500) * 1024 * 1024),
+                                      max_age_seconds=None if max_age_days is None else max_age_days * 24 * 60 * 60)
+    return _llm_cache
+
+
+def configure_llm_cache(**kwargs) -> LLMResponseCache:
+    """
+    Replaces the cache used by make_multi_provider_call, EX: configure_llm_cache(mode="replay")
+    :param kwargs: the arguments of LLMResponseCache
+    :return: the new LLMResponseCache
+    """
+    global _llm_cache
+    _llm_cache = LLMResponseCache(**kwargs)
+    return _llm_cache
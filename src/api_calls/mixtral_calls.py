@@ -1,19 +1,27 @@
 from typing import Dict, Any, Callable
 
-from openai import OpenAI
+from global_code.helpful_functions import CustomError
 
 
 def handle_mixtral_call(call_type: str, input_text: str, config: Dict[str, Any], tools: Dict[str, Callable],
                         **kwargs) -> str:
+    """
+    CAN RAISE AN ERROR: CustomError, mixtral isn't supported yet
+    """
     if call_type != "llm":
-        raise ValueError("OpenAI provider currently only supports LLM calls")
+        raise ValueError("Mixtral provider currently only supports LLM calls")
 
-    raise NotImplemented
+    raise CustomError("The mixtral provider isn't supported yet, use openai", error_type="provider_not_supported")
 
-    # Example LLM request customization
-    response = client.completions.create(engine=config['model'],
-    prompt=input_text,
-    max_tokens=kwargs.get('max_tokens', 100),
-    temperature=kwargs.get('temperature', 0.7))
 
-    return response.choices[0].text.strip()
+async def handle_mixtral_call_async(call_type: str, input_text: str, config: Dict[str, Any],
+                                    tools: Dict[str, Callable], **kwargs) -> str:
+    """
+    Async version of handle_mixtral_call. When this is implemented it should use
+    get_async_http_client("mixtral") so it shares the mixtral connection pool.
+    CAN RAISE AN ERROR: CustomError, mixtral isn't supported yet
+    """
+    if call_type != "llm":
+        raise ValueError("Mixtral provider currently only supports LLM calls")
+
+    raise CustomError("The mixtral provider isn't supported yet, use openai", error_type="provider_not_supported")
@@ -0,0 +1,276 @@
+import os
+import threading
+import time
+from typing import Dict, Any, Optional, List, Tuple
+
+from api_calls.openai_call import OPENAI_MODELS
+from api_calls.rate_limiter import DEFAULT_COMPLETION_TOKENS
+from global_code.helpful_functions import create_logger_error, log_it
+from global_code.metrics import get_metrics_registry
+from global_code.singleton import State
+from global_code.token_counter import count_tokens
+
+logger = create_logger_error(os.path.abspath(__file__), "model_router", log_to_console=True, log_to_file=True)
+
+# The task classes a call can be routed by
+DRAFT = "draft"
+REFINE = "refine"
+JSON = "json"
+CODE = "code"
+TASK_CLASSES = [DRAFT, REFINE, JSON, CODE]
+
+# USD per 1000 (input tokens, output tokens) of every (provider, model)
+DEFAULT_MODEL_COSTS: Dict[Tuple[str, str], Tuple[float, float]] = {
+    ("openai", "gpt-3.5-turbo"): (0.0005, 0.0015),
+    ("openai", "gpt-3.5-turbo-0125"): (0.0005, 0.0015),
+    ("openai", "gpt-3.5-turbo-16k"): (0.003, 0.004),
+    ("openai", "gpt-4"): (0.03, 0.06),
+    ("openai", "gpt-4-0125-preview"): (0.01, 0.03),
+    ("openai", "gpt-4-turbo-preview"): (0.01, 0.03),
+    ("openai", "gpt-4-1106-vision-preview"): (0.01, 0.03),
+}
+
+
+class TaskRoute:
+    """
+    The models a task class can be sent to, best first, and the limits a model has to be within to be picked
+    """
+
+    def __init__(self, candidates: List[Tuple[str, str]], max_cost_per_call: Optional[float] = None,
+                 max_latency_seconds: Optional[float] = None):
+        """
+        :param candidates: (provider, model), the first one that is within the limits is picked
+        :param max_cost_per_call: the max estimated USD of one call, None for no ceiling
+        :param max_latency_seconds: models slower than this (on average, for this task) are skipped, None for no limit
+        """
+        if not candidates:
+            raise ValueError("A task route needs at least one candidate model")
+        self.candidates = candidates
+        self.max_cost_per_call = max_cost_per_call
+        self.max_latency_seconds = max_latency_seconds
+
+
+# Drafts and JSON go to the fast, cheap model: a draft is refined afterwards and JSON is checked and repaired.
+# Component code goes to the stronger model while a call costs at most MAX_CODE_COST_PER_CALL, a bigger prompt
+# (or gpt-4 failing) falls back to the small model, so quality is traded for cost only on the largest files.
+# Refines are few and decide what the project looks like, they go to gpt-4 without a ceiling. Both of their models
+# have a 128k context, the structure chain sizes its token budget to the smallest model of this route.
+# The second candidate of a route is only used while the first one is failing (or over the ceiling)
+MAX_CODE_COST_PER_CALL = 0.08
+DEFAULT_TASK_ROUTES: Dict[str, TaskRoute] = {
+    DRAFT: TaskRoute([("openai", "gpt-3.5-turbo-0125"), ("openai", "gpt-3.5-turbo")]),
+    REFINE: TaskRoute([("openai", "gpt-4-0125-preview"), ("openai", "gpt-4-turbo-preview")]),
+    JSON: TaskRoute([("openai", "gpt-3.5-turbo-0125"), ("openai", "gpt-3.5-turbo")]),
+    CODE: TaskRoute([("openai", "gpt-4-0125-preview"), ("openai", "gpt-3.5-turbo-0125")],
+                    max_cost_per_call=MAX_CODE_COST_PER_CALL),
+}
+
+
+class _RouteStats:
+    """
+    Exponentially weighted moving averages of the calls to one (provider, model) for one task
+    """
+
+    def __init__(self):
+        self.latency_seconds: Optional[float] = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.last_error_at = 0.0
+
+
+class ModelRouter:
+    """
+    Picks the provider and model of a call from its task class.
+    Every call updates the latency and error rate of its (provider, model, task), and a model is picked if:
+        its estimated cost is within the cost ceiling of the task,
+        its error rate is at most max_error_rate (a failing model gets traffic again recovery_seconds after its last error),
+        its average latency is within the latency limit of the task.
+    The first candidate of the task that passes all of them is picked, so the candidates are in order of quality.
+    If none pass, the candidate that is within the cost ceiling and has the lowest expected latency is picked.
+    To use:
+        provider, model = get_model_router().choose("code", prompt)
+        ... make the call ...
+        get_model_router().record(provider, model, "code", seconds, succeeded=True)
+    """
+
+    def __init__(self, task_routes: Optional[Dict[str, TaskRoute]] = None,
+                 model_costs: Optional[Dict[Tuple[str, str], Tuple[float, float]]] = None,
+                 smoothing: float = 0.2, max_error_rate: float = 0.5, recovery_seconds: float = 60.0):
+        """
+        :param task_routes: task class -> TaskRoute
+        :param model_costs: (provider, model) -> USD per 1000 (input tokens, output tokens), unknown models cost 0
+        :param smoothing: the weight of the newest call in the moving averages, between 0 and 1
+        :param max_error_rate: models failing more than this are skipped
+        :param recovery_seconds: how long after its last error a failing model is tried again
+        """
+        if not 0 < smoothing <= 1:
+            raise ValueError("smoothing must be between 0 and 1")
+        self.task_routes = dict(DEFAULT_TASK_ROUTES if task_routes is None else task_routes)
+        self.model_costs = dict(DEFAULT_MODEL_COSTS if model_costs is None else model_costs)
+        self.smoothing = smoothing
+        self.max_error_rate = max_error_rate
+        self.recovery_seconds = recovery_seconds
+        for task, route in self.task_routes.items():
+            for provider, model in route.candidates:
+                if provider == "openai" and model not in OPENAI_MODELS:
+                    raise ValueError(f"The {task} route has an unsupported openai model: {model}")
+        self._stats: Dict[Tuple[str, str, str], _RouteStats] = {}
+        self._lock = threading.Lock()
+
+    def choose(self, task: str, input_text: str, max_tokens: Optional[int] = None) -> Tuple[str, str]:
+        """
+        :param task: the task class of the call, EX: code
+        :param input_text: the prompt, the cost is estimated from it
+        :param max_tokens: the completion tokens of the call, None for the default the rate limiter assumes
+        :return: provider, model
+        """
+        route = self._route(task)
+        now = time.monotonic()
+        affordable = [candidate for candidate in route.candidates
+                      if route.max_cost_per_call is None
+                      or self.estimate_cost(*candidate, input_text, max_tokens) <= route.max_cost_per_call]
+        if not affordable:
+            cheapest = min(route.candidates, key=lambda candidate: self.estimate_cost(*candidate, input_text,
+                                                                                      max_tokens))
+            log_it(logger, error=None, custom_message=f"No {task} model is within the cost ceiling of "
+                                                      f"{route.max_cost_per_call}, using the cheapest: {cheapest}",
+                   log_level="warning")
+            return self._decide(task, cheapest, "cheapest")
+
+        with self._lock:
+            stats = {candidate: self._stats.get((*candidate, task)) for candidate in affordable}
+        for candidate in affordable:
+            if self._is_healthy(stats[candidate], now) and self._is_fast_enough(stats[candidate], route):
+                return self._decide(task, candidate, "preferred" if candidate == route.candidates[0] else "fallback")
+
+        fastest = min(affordable, key=lambda candidate: self._expected_latency(stats[candidate]))
+        return self._decide(task, fastest, "fastest")
+
+    def record(self, provider: str, model: Optional[str], task: Optional[str], duration_seconds: float,
+               succeeded: bool) -> None:
+        """
+        Adds a finished call to the moving averages of its model, calls without a task are counted under "none"
+        :param duration_seconds: how long the call took
+        :param succeeded: False if it raised an error
+        """
+        task = task or "none"
+        with self._lock:
+            stats = self._stats.setdefault((provider, model or "", task), _RouteStats())
+            stats.calls += 1
+            if succeeded:
+                stats.latency_seconds = duration_seconds if stats.latency_seconds is None else \
+                    self.smoothing * duration_seconds + (1 - self.smoothing) * stats.latency_seconds
+            else:
+                stats.last_error_at = time.monotonic()
+            stats.error_rate = self.smoothing * (0.0 if succeeded else 1.0) + (1 - self.smoothing) * stats.error_rate
+        registry = get_metrics_registry()
+        registry.histogram("llm_call_duration_seconds", "How long an LLM call took", provider=provider,
+                           model=model or "", task=task).observe(duration_seconds)
+        if not succeeded:
+            registry.counter("llm_call_errors_total", "LLM calls that raised an error", provider=provider,
+                             model=model or "", task=task).inc()
+
+    def estimate_cost(self, provider: str, model: str, input_text: str, max_tokens: Optional[int] = None) -> float:
+        """
+        :return: the estimated USD of a call, tokens are estimated the same way the rate limiter does
+        """
+        input_cost, output_cost = self.model_costs.get((provider, model), (0.0, 0.0))
+        input_tokens = count_tokens(input_text)
+        output_tokens = DEFAULT_COMPLETION_TOKENS if max_tokens is None else int(max_tokens)
+        return (input_tokens * input_cost + output_tokens * output_cost) / 1000
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        :return: "provider/model/task" -> calls, average latency and error rate
+        """
+        with self._lock:
+            return {f"{provider}/{model}/{task}": {
+                "calls": stats.calls,
+                "latency_seconds": stats.latency_seconds,
+                "error_rate": stats.error_rate,
+            } for (provider, model, task), stats in self._stats.items()}
+
+    def _route(self, task: str) -> TaskRoute:
+        route = self.task_routes.get(task)
+        if route is None:
+            raise ValueError(f"Unsupported task class: {task}, must be one of {list(self.task_routes)}")
+        return route
+
+    def _is_healthy(self, stats: Optional[_RouteStats], now: float) -> bool:
+        if stats is None or stats.error_rate <= self.max_error_rate:
+            return True
+        return now - stats.last_error_at >= self.recovery_seconds
+
+    @staticmethod
+    def _is_fast_enough(stats: Optional[_RouteStats], route: TaskRoute) -> bool:
+        if route.max_latency_seconds is None or stats is None or stats.latency_seconds is None:
+            return True
+        return stats.latency_seconds <= route.max_latency_seconds
+
+    @staticmethod
+    def _expected_latency(stats: Optional[_RouteStats]) -> float:
+        """
+        The average latency, made longer by the retries its error rate will cost. Models never used come first
+        """
+        if stats is None or stats.latency_seconds is None:
+            return 0.0
+        return stats.latency_seconds / max(1.0 - stats.error_rate, 0.01)
+
+    @staticmethod
+    def _decide(task: str, candidate: Tuple[str, str], reason: str) -> Tuple[str, str]:
+        provider, model = candidate
+        get_metrics_registry().counter("llm_route_decisions_total", "Which model the router picked for a task",
+                                       task=task, provider=provider, model=model, reason=reason).inc()
+        return candidate
+
+
+_model_router: Optional[ModelRouter] = None
+_model_router_lock = threading.Lock()
+
+
+def get_model_router() -> ModelRouter:
+    """
+    Returns the router used by make_multi_provider_call.
+    The defaults can be overridden from the MODEL_ROUTER section of config.yaml, EX:
+    MODEL_ROUTER:
+      MAX_ERROR_RATE: 0.5
+      TASKS:
+        code:
+          MODELS: [openai/gpt-4-0125-preview, openai/gpt-3.5-turbo-0125]
+          MAX_COST_PER_CALL: 0.05
+          MAX_LATENCY_SECONDS: 60
+      COSTS:
+        openai/gpt-4-0125-preview:
+          INPUT: 0.01
+          OUTPUT: 0.03
+    :return: the ModelRouter
+    """
+    global _model_router
+    if _model_router is None:
+        with _model_router_lock:
+            if _model_router is None:
+                router_config: Dict[str, Any] = State.config.get("MODEL_ROUTER") or {}
+                task_routes = dict(DEFAULT_TASK_ROUTES)
+                for task, task_config in (router_config.get("TASKS") or {}).items():
+                    task_routes[task] = TaskRoute(
+                        [tuple(name.split("/", 1)) for name in task_config["MODELS"]],
+                        max_cost_per_call=task_config.get("MAX_COST_PER_CALL"),
+                        max_latency_seconds=task_config.get("MAX_LATENCY_SECONDS"))
+                model_costs = dict(DEFAULT_MODEL_COSTS)
+                for name, costs in (router_config.get("COSTS") or {}).items():
+                    provider, model = name.split("/", 1)
+                    model_costs[(provider, model)] = (float(costs["INPUT"]), float(costs["OUTPUT"]))
+                _model_router = ModelRouter(task_routes=task_routes, model_costs=model_costs,
+                                            max_error_rate=float(router_config.get("MAX_ERROR_RATE", 0.5)))
+    return _model_router
+
+
+def configure_model_router(**kwargs) -> ModelRouter:
+    """
+    Replaces the router used by make_multi_provider_call
+    :param kwargs: the arguments of ModelRouter
+    :return: the new ModelRouter
+    """
+    global _model_router
+    _model_router = ModelRouter(**kwargs)
+    return _model_router
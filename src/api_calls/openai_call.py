@@ -1,8 +1,63 @@
-from typing import Dict, Any, Callable, Optional
+import threading
+from typing import Dict, Any, Callable, Optional, Tuple, Iterator, TYPE_CHECKING
 from global_code.singleton import State
-from openai import OpenAI
 
-client = OpenAI(api_key=State.config["OPENAI"]["API_KEY"])
+from api_calls.connection_pools import get_async_http_client
+
+if TYPE_CHECKING:
+    from openai import OpenAI, AsyncOpenAI
+
+OPENAI_MODELS = ["gpt-4-0125-preview", "gpt-3.5-turbo", "gpt-4", "gpt-3.5-turbo-0125", "gpt-4-1106-vision-preview",
+                 "gpt-4-turbo-preview", "gpt-3.5-turbo-16k"]
+# The tokens of the prompt and the completion together every model can take
+OPENAI_CONTEXT_WINDOWS: Dict[str, int] = {
+    "gpt-4-0125-preview": 128000,
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-4-1106-vision-preview": 128000,
+    "gpt-4-turbo-preview": 128000,
+    "gpt-3.5-turbo-16k": 16385,
+}
+# The most tokens any of the models writes in one completion
+OPENAI_MAX_COMPLETION_TOKENS = 4096
+
+# The clients (and the openai package) are only loaded the first time a call is made
+_client: Optional["OpenAI"] = None
+_client_lock = threading.Lock()
+_async_client: Optional["AsyncOpenAI"] = None
+_async_client_http_client: Any = None
+
+
+def get_openai_client() -> "OpenAI":
+    """
+    Returns the OpenAI client, it is created the first time it is needed and shared after that.
+    :return: the OpenAI client
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(api_key=State.config["OPENAI"]["API_KEY"])
+    return _client
+
+
+def get_async_openai_client() -> "AsyncOpenAI":
+    """
+    Returns the async OpenAI client, it is created on first use so it can run on the callers event loop.
+    Every async call shares the "openai" keep-alive connection pool.
+    :return: the AsyncOpenAI client
+    """
+    global _async_client, _async_client_http_client
+    http_client = get_async_http_client("openai")
+    if _async_client is None or _async_client_http_client is not http_client:
+        from openai import AsyncOpenAI
+
+        _async_client = AsyncOpenAI(api_key=State.config["OPENAI"]["API_KEY"], http_client=http_client)
+        _async_client_http_client = http_client
+    return _async_client
 
 
 def handle_openai_call(call_type: str, input_text: str, config: Dict[str, Any],
@@ -24,6 +79,71 @@ def handle_openai_call(call_type: str, input_text: str, config: Dict[str, Any],
     :param kwargs: max_tokens, temperature
     :return: the response from the OpenAI API
     """
+    model, temperature, type_of_response = _prepare_openai_call(call_type, config, kwargs)
+
+    response = get_openai_client().chat.completions.create(model=model,
+                                                           messages=[{"role": "user", "content": input_text}],
+                                                           temperature=temperature)
+
+    return _format_openai_response(response, type_of_response)
+
+
+async def handle_openai_call_async(call_type: str, input_text: str, config: Dict[str, Any],
+                                   tools: Optional[Dict[str, Callable]] = None,
+                                   **kwargs) -> Any:
+    """
+    Async version of handle_openai_call, takes the same arguments and returns the same thing.
+    Uses the shared "openai" connection pool so many prompts can be in flight from one event loop.
+    :param call_type: needs to be llm
+    :param input_text: the prompt
+    :param config: same as handle_openai_call
+    :param tools: NOT SUPPORTED YET
+    :param kwargs: max_tokens, temperature
+    :return: the response from the OpenAI API
+    """
+    model, temperature, type_of_response = _prepare_openai_call(call_type, config, kwargs)
+
+    response = await get_async_openai_client().chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": input_text}],
+        temperature=temperature)
+
+    return _format_openai_response(response, type_of_response)
+
+
+def handle_openai_call_stream(call_type: str, input_text: str, config: Dict[str, Any],
+                              tools: Optional[Dict[str, Callable]] = None,
+                              **kwargs) -> Iterator[str]:
+    """
+    Streaming version of handle_openai_call, yields the text of the response as the tokens arrive.
+    Closing the generator early (EX: once the code block is finished) closes the HTTP stream,
+    so the rest of the response is never generated.
+    :param call_type: needs to be llm
+    :param input_text: the prompt
+    :param config: same as handle_openai_call
+    :param tools: NOT SUPPORTED YET
+    :param kwargs: max_tokens, temperature
+    :return: the text of the response, a piece at a time
+    """
+    model, temperature, _ = _prepare_openai_call(call_type, config, kwargs)
+
+    stream = get_openai_client().chat.completions.create(model=model,
+                                                         messages=[{"role": "user", "content": input_text}],
+                                                         temperature=temperature,
+                                                         stream=True)
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+
+
+def _prepare_openai_call(call_type: str, config: Dict[str, Any], kwargs: Dict[str, Any]) -> Tuple[str, float, str]:
+    """
+    Validates the call and works out the model, temperature and type of response
+    :return: model, temperature, type_of_response
+    """
     if call_type != "llm":
         raise ValueError("OpenAI provider currently only supports LLM calls")
     type_of_response = config.get("type_of_response")
@@ -32,14 +152,15 @@ def handle_openai_call(call_type: str, input_text: str, config: Dict[str, Any],
         temperature = 0.1
     model = config.get("model")
 
-    if model not in ["gpt-4-0125-preview", "gpt-3.5-turbo", "gpt-4", "gpt-3.5-turbo-0125", "gpt-4-1106-vision-preview",
-                     "gpt-4-turbo-preview", "gpt-3.5-turbo-16k"]:
+    if model not in OPENAI_MODELS:
         raise ValueError("Unsupported model specified")
+    return model, temperature, type_of_response
 
-    response = client.chat.completions.create(model=config['model'],
-                                         messages=[{"role": "user", "content": input_text}],
-                                              temperature=temperature)
 
+def _format_openai_response(response: Any, type_of_response: str) -> Any:
+    """
+    Pulls out what the caller asked for from the OpenAI response
+    """
     if type_of_response == "only_code" or type_of_response == "code_only":
         return response.choices[0].message.content
     elif type_of_response == "only_text" or type_of_response == "text_only":
@@ -0,0 +1,335 @@
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple, Callable, Awaitable, Iterator
+
+from global_code.helpful_functions import create_logger_error, log_it
+from global_code.singleton import State
+from global_code.token_counter import count_tokens
+
+logger = create_logger_error(os.path.abspath(__file__), "rate_limiter", log_to_console=True, log_to_file=True)
+
+# (requests per minute, tokens per minute) for each (provider, model), anything not listed uses the fallback
+DEFAULT_RATE_LIMITS: Dict[Tuple[str, str], Tuple[int, int]] = {
+    ("openai", "gpt-3.5-turbo"): (3500, 160000),
+    ("openai", "gpt-3.5-turbo-0125"): (3500, 160000),
+    ("openai", "gpt-3.5-turbo-16k"): (3500, 160000),
+    ("openai", "gpt-4"): (500, 40000),
+    ("openai", "gpt-4-0125-preview"): (500, 300000),
+    ("openai", "gpt-4-turbo-preview"): (500, 300000),
+    ("openai", "gpt-4-1106-vision-preview"): (80, 10000),
+}
+FALLBACK_RATE_LIMIT: Tuple[int, int] = (60, 60000)
+# What a request is assumed to use on top of its prompt, the budget counts the completion too
+DEFAULT_COMPLETION_TOKENS = 1000
+
+
+class TokenBucket:
+    """
+    Refills at capacity per minute, and can go negative so one oversized request doesn't block forever.
+    Not thread safe, RequestScheduler holds its lock around every call.
+    """
+
+    def __init__(self, capacity_per_minute: int):
+        self.capacity = float(capacity_per_minute)
+        self.refill_per_second = capacity_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        :return: how many seconds until amount can be taken out of the bucket
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.tokens -= amount
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+
+class _ModelBudget:
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        # Set from a Retry-After header, nobody sends to this model until then
+        self.blocked_until = 0.0
+        self.queue_depth = 0
+        self.total_requests = 0
+        self.rate_limited = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+
+class RequestScheduler:
+    """
+    Central scheduler for every LLM request.
+    Tracks a requests per minute and a tokens per minute budget for every (provider, model), and queues requests
+    until there is budget for them instead of sending them and getting a 429.
+    If a 429 still comes back the request is retried after the Retry-After header, or a jittered exponential backoff.
+    To use:
+        scheduler = get_request_scheduler()
+        response = scheduler.run("openai", "gpt-4", estimated_tokens, lambda: make_the_call())
+    """
+
+    def __init__(self, rate_limits: Optional[Dict[Tuple[str, str], Tuple[int, int]]] = None,
+                 max_retries: int = 6, base_backoff_seconds: float = 1.0, max_backoff_seconds: float = 60.0):
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits)
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._budgets: Dict[Tuple[str, str], _ModelBudget] = {}
+        self._lock = threading.Lock()
+
+    def run(self, provider: str, model: Optional[str], estimated_tokens: int, call: Callable[[], Any]) -> Any:
+        """
+        Waits for budget, makes the call, and retries it if it was rate limited.
+        :param provider: the provider of the call
+        :param model: the model of the call
+        :param estimated_tokens: prompt + completion tokens the call will use
+        :param call: makes the request
+        :return: what call returns
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(provider, model, estimated_tokens)
+            try:
+                return call()
+            except Exception as e:
+                delay = self._handle_failure(provider, model, e, attempt)
+            time.sleep(delay)
+
+    async def run_async(self, provider: str, model: Optional[str], estimated_tokens: int,
+                        call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Async version of run, call has to return an awaitable.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.acquire_async(provider, model, estimated_tokens)
+            try:
+                return await call()
+            except Exception as e:
+                delay = self._handle_failure(provider, model, e, attempt)
+            await asyncio.sleep(delay)
+
+    def run_stream(self, provider: str, model: Optional[str], estimated_tokens: int,
+                   start_stream: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        Streaming version of run. A rate limited stream is only retried if nothing was yielded from it yet.
+        :param start_stream: starts the streamed request
+        :return: the pieces of the stream
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(provider, model, estimated_tokens)
+            stream = start_stream()
+            try:
+                first_piece = next(stream)
+            except StopIteration:
+                return
+            except Exception as e:
+                stream.close()
+                delay = self._handle_failure(provider, model, e, attempt)
+                time.sleep(delay)
+                continue
+            try:
+                yield first_piece
+                yield from stream
+            finally:
+                stream.close()
+            return
+
+    def acquire(self, provider: str, model: Optional[str], estimated_tokens: int) -> float:
+        """
+        Blocks until the request fits in the budget of the model, and takes it out of the budget.
+        :return: how long the request waited in seconds
+        """
+        budget, start = self._enter_queue(provider, model)
+        try:
+            while True:
+                wait = self._try_take(budget, estimated_tokens)
+                if wait <= 0:
+                    break
+                time.sleep(wait)
+        finally:
+            waited = self._leave_queue(budget, start)
+        return waited
+
+    def try_acquire(self, provider: str, model: Optional[str], estimated_tokens: int) -> bool:
+        """
+        Takes the request out of the budget only if there is budget right now, never waits
+        :return: True if it was taken
+        """
+        with self._lock:
+            budget = self._budget(provider, model)
+        return self._try_take(budget, estimated_tokens) <= 0
+
+    async def acquire_async(self, provider: str, model: Optional[str], estimated_tokens: int) -> float:
+        """
+        Async version of acquire, waits without blocking the event loop.
+        """
+        budget, start = self._enter_queue(provider, model)
+        try:
+            while True:
+                wait = self._try_take(budget, estimated_tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            waited = self._leave_queue(budget, start)
+        return waited
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Use this to size the worker pool, a queue that is always deep means more workers won't go any faster.
+        :return: "provider/model" -> queue depth, wait times and how often it was rate limited
+        """
+        with self._lock:
+            return {f"{provider}/{model}": {
+                "queue_depth": budget.queue_depth,
+                "requests": budget.total_requests,
+                "rate_limited": budget.rate_limited,
+                "total_wait_seconds": budget.total_wait_seconds,
+                "average_wait_seconds": budget.total_wait_seconds / budget.total_requests
+                if budget.total_requests else 0.0,
+                "max_wait_seconds": budget.max_wait_seconds,
+            } for (provider, model), budget in self._budgets.items()}
+
+    def _budget(self, provider: str, model: Optional[str]) -> _ModelBudget:
+        key = (provider, model or "")
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = _ModelBudget(*self.rate_limits.get(key, FALLBACK_RATE_LIMIT))
+            self._budgets[key] = budget
+        return budget
+
+    def _enter_queue(self, provider: str, model: Optional[str]) -> Tuple[_ModelBudget, float]:
+        with self._lock:
+            budget = self._budget(provider, model)
+            budget.queue_depth += 1
+        return budget, time.monotonic()
+
+    def _leave_queue(self, budget: _ModelBudget, start: float) -> float:
+        waited = time.monotonic() - start
+        with self._lock:
+            budget.queue_depth -= 1
+            budget.total_requests += 1
+            budget.total_wait_seconds += waited
+            budget.max_wait_seconds = max(budget.max_wait_seconds, waited)
+        return waited
+
+    def _try_take(self, budget: _ModelBudget, estimated_tokens: int) -> float:
+        """
+        :return: 0 if the budget was taken, otherwise how long to wait before trying again
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(budget.blocked_until - now,
+                       budget.requests.wait_time(1, now),
+                       budget.tokens.wait_time(estimated_tokens, now))
+            if wait <= 0:
+                budget.requests.consume(1, now)
+                budget.tokens.consume(estimated_tokens, now)
+            return wait
+
+    def _handle_failure(self, provider: str, model: Optional[str], error: Exception, attempt: int) -> float:
+        """
+        Re raises anything that isn't a rate limit, or if it is out of retries.
+        :return: how long to wait before the retry
+        """
+        if not is_rate_limit_error(error) or attempt >= self.max_retries:
+            raise error
+        retry_after = get_retry_after_seconds(error)
+        if retry_after is None:
+            backoff = min(self.max_backoff_seconds, self.base_backoff_seconds * (2 ** attempt))
+            delay = random.uniform(backoff / 2, backoff)
+        else:
+            delay = retry_after + random.uniform(0, self.base_backoff_seconds)
+        with self._lock:
+            budget = self._budget(provider, model)
+            budget.rate_limited += 1
+            budget.blocked_until = max(budget.blocked_until, time.monotonic() + delay)
+        log_it(logger, error=None, custom_message=f"{provider}/{model} was rate limited, retrying in {delay:.1f}s "
+                                                  f"(attempt {attempt + 1} of {self.max_retries})",
+               log_level="warning")
+        return delay
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    :return: True if the provider said we sent too many requests
+    """
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def get_retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Reads the retry-after-ms or Retry-After header off the providers error response
+    :return: the seconds to wait, or None if the provider didn't say
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_request_tokens(input_text: str, kwargs: Dict[str, Any]) -> int:
+    """
+    Token count of a request for the budget, the prompt counted by global_code.token_counter plus the completion
+    """
+    return count_tokens(input_text) + int(kwargs.get("max_tokens", DEFAULT_COMPLETION_TOKENS))
+
+
+_request_scheduler: Optional[RequestScheduler] = None
+
+
+def get_request_scheduler() -> RequestScheduler:
+    """
+    Returns the scheduler used by make_multi_provider_call.
+    The defaults can be overridden from the RATE_LIMITS section of config.yaml, EX:
+    RATE_LIMITS:
+      openai/gpt-4-0125-preview:
+        RPM: 500
+        TPM: 300000
+    :return: the RequestScheduler
+    """
+    global _request_scheduler
+    if _request_scheduler is None:
+        rate_limits = dict(DEFAULT_RATE_LIMITS)
+        for name, limits in (State.config.get("RATE_LIMITS") or {}).items():
+            provider, model = name.split("/", 1)
+            rate_limits[(provider, model)] = (int(limits["RPM"]), int(limits["TPM"]))
+        _request_scheduler = RequestScheduler(rate_limits=rate_limits)
+    return _request_scheduler
+
+
+def configure_request_scheduler(**kwargs) -> RequestScheduler:
+    """
+    Replaces the scheduler used by make_multi_provider_call
+    :param kwargs: the arguments of RequestScheduler
+    :return: the new RequestScheduler
+    """
+    global _request_scheduler
+    _request_scheduler = RequestScheduler(**kwargs)
+    return _request_scheduler
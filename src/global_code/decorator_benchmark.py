@@ -0,0 +1,64 @@
+"""
+Checks that the decorators in helpful_functions add almost nothing to the functions they wrap.
+Everything slow (finding the file, making the loggers) happens once when the function is decorated,
+a call only pays for the timer and recording into the metrics registry.
+To use (from the src folder):
+    python -m global_code.decorator_benchmark
+It exits with 1 if any decorator costs more than the budget per call.
+"""
+import sys
+import time
+from typing import Callable, Dict
+
+from global_code.helpful_functions import log_exceptions, benchmark_function, benchmark_and_log_exceptions
+
+DECORATOR_OVERHEAD_BUDGET_MICROSECONDS = 5.0
+
+
+def _noop(value: int) -> int:
+    return value
+
+
+def measure_call_time(func: Callable[[int], int], calls: int = 20000, runs: int = 5) -> float:
+    """
+    :param func: the function to time
+    :param calls: how many calls are timed in a run
+    :param runs: how many times to measure, the fastest run is used to ignore noise
+    :return: the time of one call in microseconds
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter_ns()
+        for value in range(calls):
+            func(value)
+        timings.append((time.perf_counter_ns() - start) / calls / 1000)
+    return min(timings)
+
+
+def measure_decorator_overhead(calls: int = 20000) -> Dict[str, float]:
+    """
+    :return: decorator name -> microseconds it adds to every call
+    """
+    decorators = {
+        "log_exceptions": log_exceptions(file_prefix="decorator_benchmark_le_"),
+        "benchmark_function": benchmark_function(file_prefix="decorator_benchmark_bm_"),
+        "benchmark_and_log_exceptions": benchmark_and_log_exceptions(file_prefix="decorator_benchmark_ble_"),
+    }
+    baseline = measure_call_time(_noop, calls)
+    return {name: max(0.0, measure_call_time(decorator(_noop), calls) - baseline)
+            for name, decorator in decorators.items()}
+
+
+def check_decorator_overhead(budget_microseconds: float = DECORATOR_OVERHEAD_BUDGET_MICROSECONDS) -> bool:
+    """
+    :return: True if every decorator is under budget
+    """
+    under_budget = True
+    for name, overhead in measure_decorator_overhead().items():
+        print(f"{name} adds {overhead:.2f}us per call (budget {budget_microseconds:.2f}us)")
+        under_budget = under_budget and overhead <= budget_microseconds
+    return under_budget
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_decorator_overhead() else 1)
@@ -1,43 +1,60 @@
 """
 This is a universal Page to be used across projects
 """
+import atexit
+import functools
 import logging
 import os
+import queue
+import threading
 import traceback
 import inspect
 import time
-from typing import Optional, Callable, Any
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Callable, Any, Dict, Tuple
 
-import yaml
 # Optional Imports:
-# These 3 for the database connection
-import pymysql.cursors
+# pymysql (for the database connection) and yaml are imported where they are used, so they don't slow down startup
 from dotenv import load_dotenv
 
+from global_code.metrics import get_metrics_registry, LatencyHistogram, Counter
+
 load_dotenv()
 
 
 def log_exceptions(file_prefix: Optional[str] = None):
     """
         Logs and exceptions that occur in the function
+        Works on normal and async functions, the logger is made once when the function is decorated
         To use:
         from helpful_functions import log_exceptions
-        @log_exceptions
+        @log_exceptions()
         def some_function(*args, *kwargs):
     """
 
     def decorator(func: Callable):
-        def wrapper(*args, **kwargs):
-            calling_frame = inspect.stack()[1]
-            file_path: str = calling_frame[1]
-            file_name: str = func.__name__
-
-            if file_prefix is not None:
-                file_name = file_prefix + file_name
+        personal_logger2 = PersonalLogger(_function_file_path(func), _decorated_function_name(func, file_prefix))
+        personal_logger2.create_logger_error()
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                result: Optional[Any] = None
+                try:
+                    result = await func(*args, **kwargs)
+                except CustomError as custom_error:
+                    personal_logger2.log_it(custom_error)
+                    raise custom_error
+                except Exception as e:
+                    personal_logger2.log_it(e)
+                    raise e
+                finally:
+                    return result
 
-            personal_logger2 = PersonalLogger(file_path, file_name)
-            py_logger_object: logging.Logger = personal_logger2.create_logger_error()
+            return async_wrapper
 
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
             result: Optional[Any] = None
             try:
                 result = func(*args, **kwargs)
@@ -57,34 +74,46 @@ def log_exceptions(file_prefix: Optional[str] = None):
 
 def benchmark_function(file_prefix: Optional[str] = None):
     """
-    Benchmarks your function, and creates a benchmark log file
+    Benchmarks your function, every call is recorded in the metrics registry (global_code.metrics) as
+    function_duration_seconds, function_calls_total and function_errors_total with the label function=<name>
+    Works on normal and async functions, the metrics are looked up once when the function is decorated
     :param file_prefix: if you want to add a suffix to the function name
     :return:
     To use:
-        from helpful_functions import benchmark_logs
-        @benchmark_logs
+        from helpful_functions import benchmark_function
+        @benchmark_function()
         def some_function(**args, **kwargs):
     """
 
     def decorator(func: Callable):
+        duration, calls, errors = _function_metrics(_decorated_function_name(func, file_prefix))
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start_time = time.perf_counter_ns()
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException:
+                    errors.inc()
+                    raise
+                finally:
+                    duration.observe_ns(time.perf_counter_ns() - start_time)
+                    calls.inc()
+
+            return async_wrapper
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            calling_frame = inspect.stack()[1]
-            file_path: str = calling_frame[1]
-            file_name: str = func.__name__
-
-            if file_prefix is not None:
-                file_name = file_prefix + file_name
-
-            personal_logger2 = PersonalLogger(file_path, file_name)
-            bm_logger: logging.Logger = personal_logger2.create_benchmark()
-            start_time = time.time()
-
-            result: Any = func(*args, **kwargs)
-
-            end_time_section1 = time.time()
-            time_section1 = end_time_section1 - start_time
-            bm_logger.debug(f"{file_name} took {time_section1} seconds")
-            return result
+            start_time = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                errors.inc()
+                raise
+            finally:
+                duration.observe_ns(time.perf_counter_ns() - start_time)
+                calls.inc()
 
         return wrapper
 
@@ -93,41 +122,60 @@ def benchmark_function(file_prefix: Optional[str] = None):
 
 def benchmark_and_log_exceptions(file_prefix: Optional[str] = None):
     """
-        Benchmarks your function
+        Benchmarks your function into the metrics registry (the same metrics as benchmark_function),
+        and logs the exceptions that occur in it
+        Works on normal and async functions, the loggers are made once when the function is decorated
         To use: from helpful_functions import benchmark_and_log_exceptions
-        @benchmark_and_log_exceptions
+        @benchmark_and_log_exceptions()
         def some_function(**args, **kwargs):
     """
 
     def decorator(func: Callable):
-        def wrapper(*args, **kwargs):
-            calling_frame = inspect.stack()[1]
-            file_path: str = calling_frame[1]
-            file_name: str = func.__name__
-
-            if file_prefix is not None:
-                file_name = file_prefix + file_name
-
-            personal_logger2 = PersonalLogger(file_path, file_name)
-            bm_logger: logging.Logger = personal_logger2.create_benchmark()
+        file_name = _decorated_function_name(func, file_prefix)
+        duration, calls, errors = _function_metrics(file_name)
+
+        personal_logger2 = PersonalLogger(_function_file_path(func), file_name)
+        personal_logger2.create_logger_error()
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                result: Optional[Any] = None
+
+                start_time = time.perf_counter_ns()
+                try:
+                    result = await func(*args, **kwargs)
+                except CustomError as custom_error:
+                    errors.inc()
+                    personal_logger2.log_it(custom_error)
+                    raise
+                except Exception as e:
+                    errors.inc()
+                    personal_logger2.log_it(e)
+                finally:
+                    duration.observe_ns(time.perf_counter_ns() - start_time)
+                    calls.inc()
+                    return result
 
-            personal_logger_object = PersonalLogger(file_path, file_name)
-            logger2: logging.Logger = personal_logger_object.create_logger_error()
+            return async_wrapper
 
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
             result: Optional[Any] = None
 
-            start_time = time.time()
+            start_time = time.perf_counter_ns()
             try:
                 result = func(*args, **kwargs)
             except CustomError as custom_error:
+                errors.inc()
                 personal_logger2.log_it(custom_error)
                 raise
             except Exception as e:
+                errors.inc()
                 personal_logger2.log_it(e)
             finally:
-                end_time_section1 = time.time()
-                time_section1 = end_time_section1 - start_time
-                bm_logger.debug(f"{file_name} took {time_section1} seconds")
+                duration.observe_ns(time.perf_counter_ns() - start_time)
+                calls.inc()
                 return result
 
         return wrapper
@@ -135,6 +183,33 @@ def benchmark_and_log_exceptions(file_prefix: Optional[str] = None):
     return decorator
 
 
+def _function_file_path(func: Callable) -> str:
+    """
+    The file the function is written in, the log files go next to it.
+    Read off the code object so the stack never has to be inspected.
+    """
+    code = getattr(inspect.unwrap(func), "__code__", None)
+    if code is not None:
+        return code.co_filename
+    return inspect.getfile(func)
+
+
+def _decorated_function_name(func: Callable, file_prefix: Optional[str]) -> str:
+    if file_prefix is not None:
+        return file_prefix + func.__name__
+    return func.__name__
+
+
+def _function_metrics(file_name: str) -> Tuple[LatencyHistogram, Counter, Counter]:
+    """
+    :return: the duration histogram, calls counter and errors counter of the function
+    """
+    registry = get_metrics_registry()
+    return (registry.histogram("function_duration_seconds", "How long the function took", function=file_name),
+            registry.counter("function_calls_total", "How many times the function was called", function=file_name),
+            registry.counter("function_errors_total", "How many times the function raised", function=file_name))
+
+
 class PersonalLogger:
     """
     really shitty logger class
@@ -161,36 +236,9 @@ class PersonalLogger:
         is fully DEBUG LEVEL LOGGER
         :return:
         """
-        caller_dir = os.path.dirname(os.path.abspath(self.file_path))
-
-        logs_dir = os.path.join(caller_dir, 'logs')
-
-        os.makedirs(logs_dir, exist_ok=True)
-
-        # Create a subfolder named after the calling file (without extension)
-        calling_file_name = os.path.splitext(os.path.basename(self.file_path))[0]
-        file_logs_dir = os.path.join(logs_dir, calling_file_name)
-
-        os.makedirs(file_logs_dir, exist_ok=True)
-        log_file = os.path.join(file_logs_dir, f'BM_{self.name_of_function}.log')
-
-        logger = logging.getLogger(self.name_of_function)
-
-        # Create a file handler and set the formatter
-        handler = logging.FileHandler(log_file)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-
-        # Set the logging level to capture all levels (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-        logger.setLevel(logging.DEBUG)
-
-        # Add the file handler to the logger
-        logger.addHandler(handler)
-        # Logs to console!!!!!
-        # logger.addHandler(console_handler)
+        log_file = _log_file_path(self.file_path, f'BM_{self.name_of_function}')
+        # Logs to console!!!!! (log_to_console=True)
+        logger = _get_cached_logger(self.name_of_function, log_file, log_to_console=False)
         self.py_logger_object = logger
         return logger
 
@@ -209,35 +257,8 @@ class PersonalLogger:
             log_it(logger, e)
         """
 
-        caller_dir = os.path.dirname(os.path.abspath(self.file_path))
-
-        logs_dir = os.path.join(caller_dir, 'logs')
-
-        os.makedirs(logs_dir, exist_ok=True)
-
-        # Create a subfolder named after the calling file (without extension)
-        calling_file_name = os.path.splitext(os.path.basename(self.file_path))[0]
-        file_logs_dir = os.path.join(logs_dir, calling_file_name)
-
-        os.makedirs(file_logs_dir, exist_ok=True)
-        log_file = os.path.join(file_logs_dir, f'{self.name_of_function}.log')
-
-        logger = logging.getLogger(self.name_of_function)
-
-        # Create a file handler and set the formatter
-        handler = logging.FileHandler(log_file)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-
-        # Set the logging level to capture all levels (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-        logger.setLevel(logging.DEBUG)
-
-        # Add the file handler to the logger
-        logger.addHandler(handler)
-        logger.addHandler(console_handler)
+        log_file = _log_file_path(self.file_path, self.name_of_function)
+        logger = _get_cached_logger(self.name_of_function, log_file, log_to_console=True)
         self.py_logger_object = logger
 
         return logger
@@ -276,6 +297,8 @@ class MySQLConnection:
         # )
         # with connection.cursor() as cur:
         #     cur.execute('CREATE DATABASE swarm_db;')
+        import pymysql.cursors
+
         connection = pymysql.connect(
             host=host or os.getenv("MYSQL_HOST"),
             port=port or int(os.getenv("MYSQL_PORT")),
@@ -399,6 +422,31 @@ def count_lines_of_code(directory: str) -> int:
     return total_lines
 
 
+def atomic_write_text(file_path: str, text: str, fsync: bool = False) -> None:
+    """
+    Writes the file to a temporary file in the same folder and renames it over file_path,
+    so anyone reading the file sees the old or the new content, never half of it
+    :param file_path: the file to write
+    :param text: the new content of the file
+    :param fsync: flush the content to disk before the rename, so it also survives a crash of the machine
+    :return: None
+    """
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary_path, "w") as temporary_file:
+            temporary_file.write(text)
+            if fsync:
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+
+
 def create_logger_error(file_path: str, name_of_log_file: str, log_to_console: bool = False,
                         log_to_file: bool = True) -> logging.Logger:
     """
@@ -422,41 +470,156 @@ def create_logger_error(file_path: str, name_of_log_file: str, log_to_console: b
     except Exception as e:
         log_it(logger, e)
     """
-    caller_dir = os.path.dirname(os.path.abspath(file_path))
+    log_file = _log_file_path(file_path, name_of_log_file)
+    if log_to_file:
+        # TODO ADD THIS CAPABILITY
+        pass
+    return _get_cached_logger(name_of_log_file, log_file, log_to_console=log_to_console)
+
+
+# ---------------------------------------------------------------------------
+# Logging subsystem
+# Every logger, file handler and console handler is made once and cached by name/path, so calling
+# create_logger_error (or the decorators) over and over doesn't add more handlers or open more files.
+# Loggers only put records on a queue, a background QueueListener thread writes them to the files,
+# so the code that logs never waits on the disk.
+# ---------------------------------------------------------------------------
+LOG_FORMATTER = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_listener: Optional[QueueListener] = None
+_logging_lock = threading.RLock()
+_cached_loggers: Dict[str, logging.Logger] = {}
+_queue_handlers: Dict[str, "_InProcessQueueHandler"] = {}
+_file_handlers: Dict[str, logging.FileHandler] = {}
+_console_handler: Optional[logging.StreamHandler] = None
+# logger name -> the handlers the listener writes its records to
+_log_routes: Dict[str, Tuple[logging.Handler, ...]] = {}
+_log_file_paths: Dict[Tuple[str, str], str] = {}
+
+
+class _InProcessQueueHandler(QueueHandler):
+    """
+    The records never leave the process, so they don't need to be formatted and copied on the logging thread,
+    the listener formats them when it writes them
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _RoutingHandler(logging.Handler):
+    """
+    Runs on the listener thread, sends every record to the handlers of the logger that made it
+    """
 
-    logs_dir = os.path.join(caller_dir, 'logs')
+    def handle(self, record: logging.LogRecord) -> bool:
+        for handler in _log_routes.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
 
-    os.makedirs(logs_dir, exist_ok=True)
 
-    # Create a subfolder named after the calling file (without extension)
-    calling_file_name = os.path.splitext(os.path.basename(file_path))[0]
-    file_logs_dir = os.path.join(logs_dir, calling_file_name)
+def _log_file_path(file_path: str, name_of_log_file: str) -> str:
+    """
+    The log file goes in logs/<calling file name>/ next to the calling file, the folders are only made once
+    """
+    key = (file_path, name_of_log_file)
+    log_file = _log_file_paths.get(key)
+    if log_file is None:
+        caller_dir = os.path.dirname(os.path.abspath(file_path))
 
-    os.makedirs(file_logs_dir, exist_ok=True)
-    log_file = os.path.join(file_logs_dir, f'{name_of_log_file}.log')
+        # Create a subfolder named after the calling file (without extension)
+        calling_file_name = os.path.splitext(os.path.basename(file_path))[0]
+        file_logs_dir = os.path.join(caller_dir, 'logs', calling_file_name)
 
-    logger = logging.getLogger(name_of_log_file)
+        os.makedirs(file_logs_dir, exist_ok=True)
+        log_file = os.path.join(file_logs_dir, f'{name_of_log_file}.log')
+        _log_file_paths[key] = log_file
+    return log_file
 
-    # Sets the file path to the log file, and sets the format of the log file
-    handler = logging.FileHandler(log_file)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
 
-    # Sets the format of the console log
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
+def _get_cached_logger(name: str, log_file: Optional[str], log_to_console: bool) -> logging.Logger:
+    """
+    Returns the logger for name, adding the file/console handler to it if it doesn't already write there
+    """
+    global _log_listener, _console_handler
+    with _logging_lock:
+        if _log_listener is None:
+            _log_listener = QueueListener(_log_queue, _RoutingHandler(), respect_handler_level=False)
+            _log_listener.start()
+
+        logger = _cached_loggers.get(name)
+        if logger is None:
+            logger = logging.getLogger(name)
+            # levels (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+            logger.setLevel(logging.DEBUG)
+            queue_handler = _InProcessQueueHandler(_log_queue)
+            logger.addHandler(queue_handler)
+            _queue_handlers[name] = queue_handler
+            _cached_loggers[name] = logger
+
+        routes = list(_log_routes.get(name, ()))
+        if log_file is not None:
+            file_handler = _file_handlers.get(log_file)
+            if file_handler is None:
+                # The handler is what will write to the log file
+                file_handler = logging.FileHandler(log_file)
+                file_handler.setFormatter(LOG_FORMATTER)
+                _file_handlers[log_file] = file_handler
+            if file_handler not in routes:
+                routes.append(file_handler)
+        if log_to_console:
+            if _console_handler is None:
+                # Sets the format of the console log
+                _console_handler = logging.StreamHandler()
+                _console_handler.setFormatter(LOG_FORMATTER)
+            if _console_handler not in routes:
+                routes.append(_console_handler)
+        _log_routes[name] = tuple(routes)
+        return logger
 
-    # levels (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-    logger.setLevel(logging.DEBUG)
 
-    # The handler is what will write to the log file
-    logger.addHandler(handler)
-    if log_to_console:
-        logger.addHandler(console_handler)
-    if log_to_file:
-        # TODO ADD THIS CAPABILITY
-        pass
-    return logger
+def flush_logging() -> None:
+    """
+    Blocks until every record logged so far has been written, and flushes the log files.
+    :return: None
+    """
+    if _log_listener is None:
+        return
+    _log_queue.join()
+    with _logging_lock:
+        handlers = list(_file_handlers.values()) + ([_console_handler] if _console_handler is not None else [])
+    for handler in handlers:
+        handler.flush()
+
+
+def shutdown_logging() -> None:
+    """
+    Writes every record that is left, stops the listener thread and closes every log file.
+    Runs automatically at exit. Loggers made after this start the subsystem again.
+    :return: None
+    """
+    global _log_listener, _console_handler
+    with _logging_lock:
+        if _log_listener is None:
+            return
+        _log_listener.stop()
+        _log_listener = None
+        for name, queue_handler in _queue_handlers.items():
+            _cached_loggers[name].removeHandler(queue_handler)
+        for file_handler in _file_handlers.values():
+            file_handler.close()
+        if _console_handler is not None:
+            _console_handler.flush()
+        _cached_loggers.clear()
+        _queue_handlers.clear()
+        _file_handlers.clear()
+        _log_routes.clear()
+        _console_handler = None
+
+
+atexit.register(shutdown_logging)
 
 
 def log_it(logger: logging.Logger, error: Optional[Exception] = None, custom_message: Optional[str] = None,
@@ -536,20 +699,12 @@ def create_logger_simple(file_name: str, name: str) -> logging.Logger:
     # is broken
     # ---------------------------------------------------------------------------
 
-    logger = logging.getLogger(name)
-
     caller_dir = os.path.dirname(os.path.abspath(file_name))  # this line is probably broken
     logs_dir = os.path.join(caller_dir, "../utils/logs")
     os.makedirs(logs_dir, exist_ok=True)  # Create the "logs" folder if it doesn't exist
 
     log_file = os.path.join(logs_dir, f"{name}.log")
-    handler = logging.FileHandler(log_file)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
-    return logger
+    return _get_cached_logger(name, log_file, log_to_console=False)
 
 
 def load_config(config_path: str = "config.yaml") -> dict[str, Any]:
@@ -557,5 +712,7 @@ def load_config(config_path: str = "config.yaml") -> dict[str, Any]:
     :param config_path: config foler
     :return: the dict structure of the yaml file
     """
+    import yaml
+
     with open(config_path, 'r') as file:
         return yaml.safe_load(file)
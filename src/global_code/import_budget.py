@@ -0,0 +1,67 @@
+"""
+Checks that importing the project stays fast.
+Importing should never load a config file, build an API client or pull in a heavy package,
+those all happen the first time they are used.
+To use (from the src folder):
+    python -m global_code.import_budget
+It exits with 1 and lists the slowest imports if `import main` is over budget.
+"""
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+IMPORT_TIME_BUDGET_SECONDS = 0.5
+SRC_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import_time(module: str = "main", runs: int = 3) -> float:
+    """
+    Imports the module in a fresh interpreter, so nothing is already imported
+    :param module: the module to import
+    :param runs: how many times to measure, the fastest run is used to ignore noise
+    :return: the import time in seconds
+    """
+    code = ("import time; start = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - start)")
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], cwd=SRC_DIRECTORY, check=True,
+                                capture_output=True, text=True)
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+    return min(timings)
+
+
+def slowest_imports(module: str = "main", top: int = 15) -> List[Tuple[int, str]]:
+    """
+    Uses python -X importtime to find what is slow to import
+    :return: (cumulative microseconds, imported module) slowest first
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=SRC_DIRECTORY,
+                            check=True, capture_output=True, text=True)
+    imports = []
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # import time: self [us] | cumulative | imported package
+        _, cumulative, imported = line[len("import time:"):].split("|", 2)
+        imports.append((int(cumulative.strip()), imported.rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def check_import_time_budget(module: str = "main", budget_seconds: float = IMPORT_TIME_BUDGET_SECONDS) -> bool:
+    """
+    :return: True if importing the module is under budget
+    """
+    import_time = measure_import_time(module)
+    print(f"import {module} took {import_time:.3f}s (budget {budget_seconds:.3f}s)")
+    if import_time <= budget_seconds:
+        return True
+    print("Slowest imports (cumulative microseconds):")
+    for cumulative, imported in slowest_imports(module):
+        print(f"{cumulative:>10} {imported}")
+    return False
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_import_time_budget() else 1)
@@ -0,0 +1,298 @@
+"""
+In process metrics, so timings can be added up across runs instead of read out of log files one line at a time.
+benchmark_function (and benchmark_and_log_exceptions) record every call here:
+    function_duration_seconds{function="..."}  latency histogram
+    function_calls_total{function="..."}       counter
+    function_errors_total{function="..."}      counter
+To use:
+    from global_code.metrics import get_metrics_registry
+    registry = get_metrics_registry()
+    registry.counter("docker_builds_total", "How many images were built").inc()
+    with registry.time("docker_step_duration_seconds", step="build"):
+        build()
+    print(registry.to_prometheus())
+    registry.write("/path/to/folder")  # metrics.prom and metrics.json
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple, List, Iterator, Union
+
+# The histogram keeps 2 ** SUB_BUCKET_BITS buckets per power of two, so a recorded value is off by at most
+# 1 / 2 ** (SUB_BUCKET_BITS - 1) (~1.6%) no matter how big it is
+SUB_BUCKET_BITS = 7
+DEFAULT_QUANTILES: Tuple[float, ...] = (0.5, 0.9, 0.95, 0.99)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    """
+    A number that only goes up
+    """
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """
+    A number that can go up and down, EX: how many containers are running
+    """
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value -= amount
+
+
+class LatencyHistogram:
+    """
+    HDR style histogram of durations.
+    Values are recorded in nanoseconds into log-linear buckets (a fixed number of linear buckets per power of two),
+    so it is small and fast to record into, and every quantile is within ~1.6% of the real value.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum_ns = 0
+        self.min_ns: Optional[int] = None
+        self.max_ns = 0
+        self._buckets: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def observe_ns(self, duration_ns: int) -> None:
+        """
+        :param duration_ns: the duration in nanoseconds
+        :return: None
+        """
+        duration_ns = max(0, int(duration_ns))
+        bucket = _bucket_index(duration_ns)
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.sum_ns += duration_ns
+            if self.min_ns is None or duration_ns < self.min_ns:
+                self.min_ns = duration_ns
+            if duration_ns > self.max_ns:
+                self.max_ns = duration_ns
+
+    def observe(self, duration_seconds: float) -> None:
+        self.observe_ns(int(duration_seconds * 1_000_000_000))
+
+    def quantile(self, quantile: float) -> float:
+        """
+        :param quantile: between 0 and 1, EX: 0.99
+        :return: the duration in seconds, 0 if nothing was recorded
+        """
+        return self.quantiles([quantile])[quantile]
+
+    def quantiles(self, quantiles: Union[List[float], Tuple[float, ...]] = DEFAULT_QUANTILES) -> Dict[float, float]:
+        """
+        Works out several quantiles with one pass over the buckets
+        :return: quantile -> duration in seconds
+        """
+        with self._lock:
+            buckets = sorted(self._buckets.items())
+            count, min_ns, max_ns = self.count, self.min_ns, self.max_ns
+        results: Dict[float, float] = {}
+        if count == 0:
+            return {quantile: 0.0 for quantile in quantiles}
+        for quantile in quantiles:
+            # The rank of the value, 1 based, the same as the nearest rank method
+            rank = max(1, min(count, int(quantile * count + 0.999999)))
+            seen = 0
+            value_ns = max_ns
+            for bucket, bucket_count in buckets:
+                seen += bucket_count
+                if seen >= rank:
+                    lowest, highest = _bucket_range(bucket)
+                    value_ns = (lowest + highest) // 2
+                    break
+            # The real min and max are known exactly, never report outside them
+            results[quantile] = min(max(value_ns, min_ns), max_ns) / 1_000_000_000
+        return results
+
+    def snapshot(self, quantiles: Union[List[float], Tuple[float, ...]] = DEFAULT_QUANTILES) -> Dict[str, Any]:
+        with self._lock:
+            count, sum_ns, min_ns, max_ns = self.count, self.sum_ns, self.min_ns, self.max_ns
+        return {
+            "count": count,
+            "sum_seconds": sum_ns / 1_000_000_000,
+            "mean_seconds": sum_ns / count / 1_000_000_000 if count else 0.0,
+            "min_seconds": (min_ns or 0) / 1_000_000_000,
+            "max_seconds": max_ns / 1_000_000_000,
+            "quantiles": {str(quantile): value for quantile, value in self.quantiles(quantiles).items()},
+        }
+
+
+def _bucket_index(value: int) -> int:
+    """
+    Values under 2 ** SUB_BUCKET_BITS get a bucket each,
+    above that every power of two is split into 2 ** (SUB_BUCKET_BITS - 1) buckets
+    """
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    if shift <= 0:
+        return value
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def _bucket_range(bucket: int) -> Tuple[int, int]:
+    """
+    :return: the lowest and highest value that goes in the bucket
+    """
+    shift = bucket >> SUB_BUCKET_BITS
+    if shift == 0:
+        return bucket, bucket
+    lowest = (bucket - (shift << SUB_BUCKET_BITS)) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+
+class MetricsRegistry:
+    """
+    Holds every counter, gauge and histogram, each one is found by its name and labels.
+    Getting a metric is a dict lookup, so hot code should get it once and keep it.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Dict[Labels, Union[Counter, Gauge, LatencyHistogram]]] = {}
+        self._types: Dict[str, str] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str = "", **labels: str) -> Counter:
+        return self._get_metric(name, "counter", Counter, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = "", **labels: str) -> Gauge:
+        return self._get_metric(name, "gauge", Gauge, help_text, labels)
+
+    def histogram(self, name: str, help_text: str = "", **labels: str) -> LatencyHistogram:
+        return self._get_metric(name, "histogram", LatencyHistogram, help_text, labels)
+
+    @contextlib.contextmanager
+    def time(self, name: str, help_text: str = "", **labels: str) -> Iterator[LatencyHistogram]:
+        """
+        Times the block into the histogram, EX: with registry.time("docker_step_duration_seconds", step="build"):
+        """
+        histogram = self.histogram(name, help_text, **labels)
+        start_time = time.perf_counter_ns()
+        try:
+            yield histogram
+        finally:
+            histogram.observe_ns(time.perf_counter_ns() - start_time)
+
+    def to_prometheus(self, quantiles: Union[List[float], Tuple[float, ...]] = DEFAULT_QUANTILES) -> str:
+        """
+        Exports every metric in the Prometheus text format.
+        Histograms are exported as summaries (quantiles, _sum and _count) since the buckets are not fixed.
+        :return: the text to serve on /metrics or write to a .prom file
+        """
+        lines: List[str] = []
+        for name, metric_type, help_text, metrics in self._sorted_metrics():
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {'summary' if metric_type == 'histogram' else metric_type}")
+            for labels, metric in metrics:
+                if isinstance(metric, LatencyHistogram):
+                    for quantile, value in metric.quantiles(quantiles).items():
+                        lines.append(f"{name}{_format_labels(labels + (('quantile', str(quantile)),))} {value!r}")
+                    snapshot = metric.snapshot(())
+                    lines.append(f"{name}_sum{_format_labels(labels)} {snapshot['sum_seconds']!r}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {snapshot['count']}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value!r}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, quantiles: Union[List[float], Tuple[float, ...]] = DEFAULT_QUANTILES) -> Dict[str, Any]:
+        """
+        :return: every metric as a json serializable dict
+        """
+        metrics_snapshot: Dict[str, Any] = {}
+        for name, metric_type, help_text, metrics in self._sorted_metrics():
+            metrics_snapshot[name] = {
+                "type": metric_type,
+                "help": help_text,
+                "values": [{"labels": dict(labels),
+                            **(metric.snapshot(quantiles) if isinstance(metric, LatencyHistogram)
+                               else {"value": metric.value})}
+                           for labels, metric in metrics],
+            }
+        return {"created_at": time.time(), "metrics": metrics_snapshot}
+
+    def write(self, directory: str) -> Tuple[str, str]:
+        """
+        Writes metrics.prom and metrics.json to the directory
+        :return: the paths of the two files
+        """
+        os.makedirs(directory, exist_ok=True)
+        prometheus_path = os.path.join(directory, "metrics.prom")
+        json_path = os.path.join(directory, "metrics.json")
+        with open(prometheus_path, "w") as prometheus_file:
+            prometheus_file.write(self.to_prometheus())
+        with open(json_path, "w") as json_file:
+            json.dump(self.snapshot(), json_file, indent=2)
+        return prometheus_path, json_path
+
+    def reset(self) -> None:
+        with self._lock:
+            self._metrics.clear()
+            self._types.clear()
+            self._help.clear()
+
+    def _get_metric(self, name: str, metric_type: str, metric_class: type, help_text: str,
+                    labels: Dict[str, str]) -> Any:
+        key: Labels = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        metric = self._metrics.get(name, {}).get(key)
+        if metric is not None:
+            return metric
+        with self._lock:
+            existing_type = self._types.setdefault(name, metric_type)
+            if existing_type != metric_type:
+                raise ValueError(f"Metric {name} is a {existing_type}, not a {metric_type}")
+            if help_text:
+                self._help.setdefault(name, help_text)
+            return self._metrics.setdefault(name, {}).setdefault(key, metric_class())
+
+    def _sorted_metrics(self) -> List[Tuple[str, str, str, List[Tuple[Labels, Any]]]]:
+        with self._lock:
+            return [(name, self._types[name], self._help.get(name, ""), sorted(metrics.items()))
+                    for name, metrics in sorted(self._metrics.items())]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{_escape_label_value(value)}"' for label, value in labels) + "}"
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_metrics_registry = MetricsRegistry()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """
+    Returns the registry every decorator and step records into
+    :return: the MetricsRegistry
+    """
+    return _metrics_registry
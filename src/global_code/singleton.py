@@ -1,16 +1,34 @@
 import os
+import threading
+from typing import Optional
 
-from langchain_community.llms.ollama import Ollama
-from langchain_openai import ChatOpenAI
 from global_code.helpful_functions import load_config
 
 
+class _LazyConfig:
+    """
+    Loads config.yaml the first time State.config is read, instead of when State is imported.
+    So importing a module that uses State doesn't need a config file, only using the config does.
+    """
+
+    def __init__(self):
+        self._config: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance, owner) -> dict:
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    self._config = load_config()
+        return self._config
+
+
 class State:
     """
     Singleton class for storing the state of the game.
     """
 
-    config: dict = load_config()
+    config: dict = _LazyConfig()
     # os.environ['OPENAI_API_KEY'] = config['OPENAI']['API_KEY']
     # os.environ['REPLICATE_API_KEY'] = config['REPLICATE_API_KEY']
     #
@@ -0,0 +1,36 @@
+"""
+Local approximate tokenizer, the one every token count of the project uses (prompt budgets, rate limits, costs).
+It needs no network call and no tokenizer model.
+To use:
+    from global_code.token_counter import count_tokens
+    tokens = count_tokens(prompt)
+"""
+import math
+import re
+
+# Words are split into tokens of about this many characters, close to what the BPE tokenizers of the models do
+CHARACTERS_PER_WORD_TOKEN = 4
+# A word, a number, a symbol or a run of whitespace, every match is counted on its own
+TOKEN_PATTERN = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]|\s+")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Approximate token count, without a network call or a tokenizer model.
+    Every word counts as a token per CHARACTERS_PER_WORD_TOKEN characters, every number per 3 digits,
+    every symbol as one, and whitespace is free except for new lines.
+    :param text: the text to count
+    :return: the approximate number of tokens
+    """
+    tokens = 0
+    for piece in TOKEN_PATTERN.findall(text):
+        first_character = piece[0]
+        if first_character.isalpha():
+            tokens += math.ceil(len(piece) / CHARACTERS_PER_WORD_TOKEN)
+        elif first_character.isdigit():
+            tokens += math.ceil(len(piece) / 3)
+        elif first_character.isspace():
+            tokens += piece.count("\n")
+        else:
+            tokens += 1
+    return tokens
@@ -0,0 +1,201 @@
+"""
+Resumable workflows, a workflow is a DAG of steps and the output of every step is checkpointed to disk.
+Running the workflow again skips every step that already finished with the same inputs,
+so a crash (or a failed LLM call) near the end doesn't throw away the docker build that came before it.
+Steps that don't depend on each other run at the same time.
+A step is called with the workflow params it asked for and the outputs of the steps it depends on, as keyword arguments.
+Its output has to be json serializable, it is what gets checkpointed.
+To use:
+    workflow = Workflow("my_workflow", "/path/to/.workflow")
+    workflow.add_step("scope", create_scope, inputs=["description"])
+    workflow.add_step("design", create_design, depends_on=["scope"], inputs=["description"])
+    outputs = workflow.run(description="a todo app")
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from global_code.helpful_functions import create_logger_error, log_it, CustomError, atomic_write_text
+from global_code.metrics import get_metrics_registry
+
+logger = create_logger_error(os.path.abspath(__file__), "workflow", log_to_console=True, log_to_file=True)
+
+CHECKPOINT_EXTENSION = ".json"
+
+
+class WorkflowStep:
+    """
+    One step of a workflow
+    """
+
+    def __init__(self, name: str, func: Callable[..., Any], depends_on: List[str], inputs: List[str],
+                 checkpoint: bool = True):
+        self.name = name
+        self.func = func
+        self.depends_on = depends_on
+        self.inputs = inputs
+        self.checkpoint = checkpoint
+
+
+class Workflow:
+    """
+    A DAG of steps, checkpointed to checkpoint_folder (one json file per step)
+    """
+
+    def __init__(self, name: str, checkpoint_folder: str, max_workers: int = 4):
+        """
+        :param name: the name of the workflow, used in the logs and metrics
+        :param checkpoint_folder: where the output of every step is saved
+        :param max_workers: the max number of steps running at the same time
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.name = name
+        self.checkpoint_folder = checkpoint_folder
+        self.max_workers = max_workers
+        self.steps: Dict[str, WorkflowStep] = {}
+        self._checkpoint_lock = threading.Lock()
+
+    def add_step(self, name: str, func: Callable[..., Any], depends_on: Optional[List[str]] = None,
+                 inputs: Optional[List[str]] = None, checkpoint: bool = True) -> "Workflow":
+        """
+        :param name: the name of the step, the steps depending on it get its output as this keyword argument
+        :param func: called with the inputs and the outputs of depends_on as keyword arguments
+        :param depends_on: the steps that have to finish first, they have to be added before this one
+        :param inputs: the workflow params the step uses, the step runs again if one of them changes
+        :param checkpoint: False to run the step every time, for steps that are cheap or have no output
+        :return: the workflow, so add_step can be chained
+        """
+        if name in self.steps:
+            raise ValueError(f"The step {name} was already added to {self.name}")
+        for dependency in depends_on or []:
+            if dependency not in self.steps:
+                raise ValueError(f"The step {name} depends on {dependency}, which isn't in {self.name}")
+        self.steps[name] = WorkflowStep(name, func, list(depends_on or []), list(inputs or []), checkpoint)
+        return self
+
+    def run(self, **params: Any) -> Dict[str, Any]:
+        """
+        Runs every step that isn't checkpointed yet, a step starts as soon as everything it depends on finished.
+        If a step fails, the steps already running finish (and are checkpointed), nothing new is started.
+        CAN RAISE AN ERROR: CustomError if a step failed, the error of the step is its __cause__
+        :param params: the workflow params, the steps get the ones in their inputs
+        :return: step name -> output
+        """
+        for step in self.steps.values():
+            missing_inputs = [step_input for step_input in step.inputs if step_input not in params]
+            if missing_inputs:
+                raise ValueError(f"The step {step.name} needs the params {missing_inputs}")
+
+        outputs: Dict[str, Any] = {}
+        pending: Dict[str, WorkflowStep] = dict(self.steps)
+        running: Dict[Future, str] = {}
+        failure: Optional[BaseException] = None
+        failed_step: Optional[str] = None
+        resumed: List[str] = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if failure is None:
+                    for step in [step for step in pending.values()
+                                 if all(dependency in outputs for dependency in step.depends_on)]:
+                        del pending[step.name]
+                        kwargs = {step_input: params[step_input] for step_input in step.inputs}
+                        kwargs.update({dependency: outputs[dependency] for dependency in step.depends_on})
+                        fingerprint = _fingerprint(kwargs)
+                        checkpoint = self._load_checkpoint(step.name) if step.checkpoint else None
+                        if checkpoint is not None and checkpoint.get("fingerprint") == fingerprint:
+                            outputs[step.name] = checkpoint.get("output")
+                            resumed.append(step.name)
+                            continue
+                        running[executor.submit(self._run_step, step, kwargs, fingerprint)] = step.name
+                    if any(all(dependency in outputs for dependency in step.depends_on)
+                           for step in pending.values()):
+                        # A resumed step made more steps ready
+                        continue
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step_name = running.pop(future)
+                    try:
+                        outputs[step_name] = future.result()
+                    except Exception as e:
+                        if failure is None:
+                            failure, failed_step = e, step_name
+
+        if resumed:
+            log_it(logger, error=None, custom_message=f"{self.name} resumed from the checkpoints of {resumed}",
+                   log_level="info")
+        if failure is not None:
+            raise CustomError(f"The step {failed_step} of {self.name} failed, run it again to resume from it: "
+                              f"{failure}", error_type="workflow_step_failed") from failure
+        return outputs
+
+    def completed_steps(self) -> Set[str]:
+        """
+        :return: the steps that have a checkpoint, even if their inputs changed since
+        """
+        return {name for name, step in self.steps.items()
+                if step.checkpoint and self._load_checkpoint(name) is not None}
+
+    def reset(self, step_names: Optional[List[str]] = None) -> None:
+        """
+        Deletes the checkpoints, so the steps run again
+        :param step_names: the steps to reset, None for every step
+        """
+        for name in step_names if step_names is not None else list(self.steps):
+            try:
+                os.remove(self._checkpoint_path(name))
+            except FileNotFoundError:
+                pass
+
+    def _run_step(self, step: WorkflowStep, kwargs: Dict[str, Any], fingerprint: str) -> Any:
+        start_time = time.perf_counter_ns()
+        try:
+            output = step.func(**kwargs)
+        except Exception as e:
+            log_it(logger, error=e, custom_message=f"The step {step.name} of {self.name} failed", log_level="error")
+            raise
+        finally:
+            get_metrics_registry().histogram("workflow_step_duration_seconds", "How long a workflow step took",
+                                             workflow=self.name, step=step.name
+                                             ).observe_ns(time.perf_counter_ns() - start_time)
+        if step.checkpoint:
+            self._save_checkpoint(step.name, fingerprint, output)
+        return output
+
+    def _checkpoint_path(self, step_name: str) -> str:
+        return os.path.join(self.checkpoint_folder, step_name + CHECKPOINT_EXTENSION)
+
+    def _load_checkpoint(self, step_name: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._checkpoint_path(step_name), "r") as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log_it(logger, error=e, custom_message=f"The checkpoint of {step_name} can't be read, running it again",
+                   log_level="warning")
+            return None
+        return checkpoint if isinstance(checkpoint, dict) else None
+
+    def _save_checkpoint(self, step_name: str, fingerprint: str, output: Any) -> None:
+        """
+        Written to a temporary file first and renamed, so a crash never leaves half a checkpoint
+        """
+        with self._checkpoint_lock:
+            os.makedirs(self.checkpoint_folder, exist_ok=True)
+        atomic_write_text(self._checkpoint_path(step_name),
+                          json.dumps({"step": step_name, "fingerprint": fingerprint, "finished_at": time.time(),
+                                      "output": output}))
+
+
+def _fingerprint(kwargs: Dict[str, Any]) -> str:
+    """
+    :return: a hash of everything the step is called with
+    """
+    return hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
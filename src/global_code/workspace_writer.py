@@ -0,0 +1,132 @@
+"""
+Batched, atomic writes of generated project files.
+The outputs of a generation phase are collected with add and written together by flush:
+    every file is written to a temporary file, fsynced and renamed over the real one (atomic_write_text),
+    the files are written by a thread pool, so on a network filesystem the round trips overlap,
+    every folder is fsynced once after all of its files are renamed, instead of once per file.
+An interrupted run leaves every file either the old version or the new one, never half written.
+With max_pending_files, add flushes by itself once that many files are waiting, so a long phase (EX: code generation)
+writes its files as they finish instead of all at the end, and a crash only loses what wasn't flushed yet.
+To use:
+    with WorkspaceWriter(project_path) as writer:
+        writer.add("src/App.js", app_code)
+        writer.add("src/App.css", css_code)
+    print(writer.manifest)  # relative path -> sha256 of the content
+"""
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from global_code.helpful_functions import create_logger_error, log_it, atomic_write_text
+from global_code.metrics import get_metrics_registry
+
+logger = create_logger_error(os.path.abspath(__file__), "workspace_writer", log_to_console=True, log_to_file=True)
+
+
+class WorkspaceWriter:
+    """
+    Collects the files of a generation phase and writes them in one batch
+    """
+
+    def __init__(self, root: str, max_workers: int = 8, fsync: bool = True, max_pending_files: Optional[int] = None):
+        """
+        :param root: the folder relative paths are resolved against, the manifest is relative to it
+        :param max_workers: how many files are written at the same time
+        :param fsync: False to skip the fsyncs, the writes are still atomic but may not survive a crash of the machine
+        :param max_pending_files: add flushes once this many files are waiting, 1 writes every file as it is added,
+        None only writes on flush
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if max_pending_files is not None and max_pending_files < 1:
+            raise ValueError("max_pending_files must be at least 1")
+        self.root = os.path.abspath(root)
+        self.max_workers = max_workers
+        self.fsync = fsync
+        self.max_pending_files = max_pending_files
+        # relative path -> sha256 of every file written by this writer
+        self.manifest: Dict[str, str] = {}
+        self._pending: Dict[str, str] = {}
+        self._pending_lock = threading.Lock()
+        self._manifest_lock = threading.Lock()
+
+    def add(self, file_path: str, text: str) -> str:
+        """
+        Adds a file to the next flush, adding the same file again replaces its content. Thread safe
+        If max_pending_files are waiting, they are flushed before this returns
+        :param file_path: absolute, or relative to root
+        :param text: the content of the file
+        :return: the absolute path of the file
+        """
+        absolute_path = os.path.abspath(os.path.join(self.root, file_path))
+        with self._pending_lock:
+            self._pending[absolute_path] = text
+            should_flush = self.max_pending_files is not None and len(self._pending) >= self.max_pending_files
+        if should_flush:
+            self.flush()
+        return absolute_path
+
+    def flush(self) -> Dict[str, str]:
+        """
+        Writes every added file, the folders are made if they don't exist. Thread safe, flushes running at the same
+        time write different files
+        :return: the manifest of this flush, relative path -> sha256 of the content
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return {}
+        start_time = time.perf_counter_ns()
+        files_by_folder: Dict[str, List[str]] = {}
+        for file_path in pending:
+            files_by_folder.setdefault(os.path.dirname(file_path), []).append(file_path)
+        for folder in files_by_folder:
+            os.makedirs(folder, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+            hashes = dict(zip(pending, executor.map(self._write_file, pending, pending.values())))
+            if self.fsync:
+                # Every rename of the folder is in, one fsync makes all of them durable
+                list(executor.map(_fsync_folder, files_by_folder))
+
+        flush_manifest = {os.path.relpath(file_path, self.root): content_hash
+                          for file_path, content_hash in hashes.items()}
+        with self._manifest_lock:
+            self.manifest.update(flush_manifest)
+        registry = get_metrics_registry()
+        registry.histogram("workspace_flush_duration_seconds", "How long writing a batch of files took"
+                           ).observe_ns(time.perf_counter_ns() - start_time)
+        registry.counter("workspace_files_written_total", "How many files the workspace writers wrote"
+                         ).inc(len(flush_manifest))
+        log_it(logger, error=None, custom_message=f"Wrote {len(flush_manifest)} files in {len(files_by_folder)} "
+                                                  f"folders of {self.root}", log_level="debug")
+        return flush_manifest
+
+    def _write_file(self, file_path: str, text: str) -> str:
+        atomic_write_text(file_path, text, fsync=self.fsync)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def __enter__(self) -> "WorkspaceWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> Optional[bool]:
+        # Whatever was generated before an error is still written
+        self.flush()
+        return None
+
+
+def _fsync_folder(folder: str) -> None:
+    try:
+        folder_descriptor = os.open(folder, os.O_RDONLY)
+    except OSError:
+        # Folders can't be opened on some systems (EX: windows), the files themselves are already fsynced
+        return
+    try:
+        os.fsync(folder_descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(folder_descriptor)
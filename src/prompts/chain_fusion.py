@@ -0,0 +1,101 @@
+"""
+Chain fusion for the draft + refine prompts (ReactPrompts.create_scope and ReactPrompts.designer).
+two_pass: a draft call, then a refine call that gets the whole draft back as input (two round trips)
+fused: one call that writes the draft, critiques it and writes the final version, only the final version is kept
+The mode of every stage is set in the CHAIN_FUSION section of config.yaml, EX:
+CHAIN_FUSION:
+  create_scope: fused
+  designer: two_pass
+"""
+import os
+import re
+import threading
+from typing import Dict, Optional
+
+from global_code.helpful_functions import create_logger_error, log_it
+from global_code.singleton import State
+
+logger = create_logger_error(os.path.abspath(__file__), "chain_fusion", log_to_console=True, log_to_file=True)
+
+TWO_PASS = "two_pass"
+FUSED = "fused"
+CHAIN_MODES = [TWO_PASS, FUSED]
+DEFAULT_CHAIN_MODE = TWO_PASS
+
+DRAFT_HEADER = "### DRAFT"
+CRITIQUE_HEADER = "### CRITIQUE"
+FINAL_HEADER = "### FINAL"
+_FINAL_SECTION = re.compile(rf"^\s*{re.escape(FINAL_HEADER)}\s*$", re.MULTILINE)
+
+_chain_modes: Optional[Dict[str, str]] = None
+_chain_modes_lock = threading.Lock()
+
+
+def get_chain_mode(stage: str) -> str:
+    """
+    :param stage: the name of the prompt, EX: create_scope
+    :return: TWO_PASS or FUSED
+    """
+    global _chain_modes
+    if _chain_modes is None:
+        with _chain_modes_lock:
+            if _chain_modes is None:
+                fusion_config: Dict[str, str] = State.config.get("CHAIN_FUSION") or {}
+                _chain_modes = {stage_name: _check_mode(mode) for stage_name, mode in fusion_config.items()}
+    return _chain_modes.get(stage, DEFAULT_CHAIN_MODE)
+
+
+def configure_chain_fusion(**stage_modes: str) -> Dict[str, str]:
+    """
+    Sets the mode of the stages instead of the CHAIN_FUSION config,
+    EX: configure_chain_fusion(create_scope="fused", designer="fused")
+    The stages that aren't given keep the mode an earlier call gave them, or two_pass
+    :return: stage -> mode
+    """
+    global _chain_modes
+    checked_modes = {stage: _check_mode(mode) for stage, mode in stage_modes.items()}
+    with _chain_modes_lock:
+        _chain_modes = {**(_chain_modes or {}), **checked_modes}
+        return dict(_chain_modes)
+
+
+def create_fused_prompt(draft_prompt: str, refine_instructions: str) -> str:
+    """
+    :param draft_prompt: the prompt of the draft call
+    :param refine_instructions: what the refine call is asked to do with the draft
+    :return: the prompt that drafts, critiques and refines in one answer
+    """
+    return f'''{draft_prompt}
+
+Self Review:
+
+After writing the document above as a draft, review it against the following instructions, then write the final, refined document:
+{refine_instructions}
+
+Output Format (follow it exactly, every header on its own line):
+{DRAFT_HEADER}
+The complete first draft of the document.
+{CRITIQUE_HEADER}
+A short list of the problems found in the draft by following the review instructions.
+{FINAL_HEADER}
+The complete refined document, with every problem fixed. It has to stand on its own, do not refer to the draft.
+'''
+
+
+def extract_final_section(response: str) -> str:
+    """
+    :param response: the answer to a fused prompt
+    :return: the final document, the whole response if the model didn't follow the format
+    """
+    final_headers = list(_FINAL_SECTION.finditer(response))
+    if not final_headers:
+        log_it(logger, error=None, custom_message="The fused answer has no final section, keeping all of it",
+               log_level="warning")
+        return response.strip()
+    return response[final_headers[-1].end():].strip()
+
+
+def _check_mode(mode: str) -> str:
+    if mode not in CHAIN_MODES:
+        raise ValueError(f"Unsupported chain mode: {mode}, must be one of {CHAIN_MODES}")
+    return mode
@@ -0,0 +1,79 @@
+"""
+Compares the two_pass and fused modes of the draft + refine prompts (create_scope and designer) on real LLM calls.
+The cache is turned off so every call reaches the LLM. Tokens are counted the same way the rate limiter does
+(global_code.token_counter.count_tokens).
+To use (from the src folder, it needs the OPENAI key of config.yaml):
+    python -m prompts.chain_fusion_benchmark "Todo app" "A todo app with lists, due dates and reminders" 3
+"""
+import sys
+from typing import Dict
+
+from api_calls.llm_cache import configure_llm_cache
+from global_code.metrics import get_metrics_registry
+from prompts.chain_fusion import CHAIN_MODES
+from prompts.react_frontend import ReactPrompts
+
+CHAIN_STAGES = ["create_scope", "designer"]
+
+
+def compare_chain_modes(project_name: str, project_description: str,
+                        runs: int = 1) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """
+    Runs create_scope and designer runs times in every mode
+    :return: mode -> stage -> {calls, mean_seconds, p50_seconds, input_tokens, output_tokens, result_characters},
+    everything but the latencies is per run
+    """
+    configure_llm_cache(mode="off")
+    registry = get_metrics_registry()
+    registry.reset()
+    for chain_mode in CHAIN_MODES:
+        for _ in range(runs):
+            scope = ReactPrompts.create_scope(project_name=project_name, project_description=project_description,
+                                              chain_mode=chain_mode)
+            ReactPrompts.designer(project_name=project_name, project_description=project_description,
+                                  design_blueprint=scope, chain_mode=chain_mode)
+
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for chain_mode in CHAIN_MODES:
+        for stage in CHAIN_STAGES:
+            durations = registry.histogram("prompt_chain_duration_seconds", stage=stage, mode=chain_mode).snapshot()
+            results.setdefault(chain_mode, {})[stage] = {
+                "calls": _per_run(registry.counter("prompt_chain_calls_total", stage=stage, mode=chain_mode).value,
+                                  runs),
+                "mean_seconds": durations["mean_seconds"],
+                "p50_seconds": durations["quantiles"]["0.5"],
+                "input_tokens": _per_run(registry.counter("prompt_chain_input_tokens_total", stage=stage,
+                                                          mode=chain_mode).value, runs),
+                "output_tokens": _per_run(registry.counter("prompt_chain_output_tokens_total", stage=stage,
+                                                           mode=chain_mode).value, runs),
+                "result_characters": _per_run(registry.counter("prompt_chain_result_characters_total", stage=stage,
+                                                               mode=chain_mode).value, runs),
+            }
+    return results
+
+
+def format_comparison(results: Dict[str, Dict[str, Dict[str, float]]]) -> str:
+    """
+    :return: the results of compare_chain_modes as a table
+    """
+    lines = [f"{'mode':<10}{'stage':<14}{'calls':>7}{'mean s':>9}{'p50 s':>9}{'in tok':>9}{'out tok':>9}"
+             f"{'result chars':>14}"]
+    for chain_mode, stages in results.items():
+        for stage, stage_results in stages.items():
+            lines.append(f"{chain_mode:<10}{stage:<14}{stage_results['calls']:>7.1f}"
+                         f"{stage_results['mean_seconds']:>9.2f}{stage_results['p50_seconds']:>9.2f}"
+                         f"{stage_results['input_tokens']:>9.0f}{stage_results['output_tokens']:>9.0f}"
+                         f"{stage_results['result_characters']:>14.0f}")
+    return "\n".join(lines)
+
+
+def _per_run(total: float, runs: int) -> float:
+    return total / runs if runs else 0.0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    print(format_comparison(compare_chain_modes(sys.argv[1], sys.argv[2],
+                                                runs=int(sys.argv[3]) if len(sys.argv) > 3 else 1)))
@@ -1,31 +1,290 @@
 import json
 import os
+import re
+from typing import Optional, Iterator, Callable, Any, Dict, List, Tuple, Union, get_args, get_origin
 
 from global_code.helpful_functions import CustomError, create_logger_error, log_it
+from global_code.metrics import get_metrics_registry
 logger = create_logger_error(file_path=os.path.abspath(__file__), name_of_log_file='cleaning_llm_outputs',
                                  log_to_console=True, log_to_file=True)
 
 
-def clean_and_convert_llm_response(response: str) -> dict:
+def clean_and_convert_llm_response(response: str, expected_shape: Any = None) -> dict:
     """
     Extracts the JSON portion of the LLM response and converts it to a dictionary.
+    Common defects are repaired (see extract_json), so most bad responses don't need to be asked for again.
+    CAN RAISE AN ERROR: CustomError(error_type="soft_error") if there is no JSON with the expected shape in the response
     :param response: the response from an LLM
+    :param expected_shape: the type the JSON has to be, EX: Dict[str, str], None for any dict
     :return: the JSON in the response
     """
-    # More robustly strip the markdown code block delimiters and potential trailing spaces or new lines
+    extraction = extract_json(response, dict if expected_shape is None else expected_shape)
+    if extraction is None:
+        log_it(logger=logger, error=None, custom_message=f"JSON msg that broke: {response}", log_level="info")
+        raise CustomError("soft_error", error_type="soft_error")
+    for repair in extraction.repairs:
+        get_metrics_registry().counter("json_repairs_total", "How many LLM responses needed a JSON repair",
+                                       repair=repair).inc()
+    if extraction.repairs:
+        log_it(logger=logger, error=None, custom_message=f"Repaired the JSON of an LLM response: {extraction.repairs}",
+               log_level="info")
+    return extraction.value
+
+
+class JsonExtraction:
+    """
+    The JSON found in a response by extract_json, and what had to be repaired to get it
+    """
+
+    def __init__(self, value: Any, repairs: List[str]):
+        self.value = value
+        # Empty if the response was valid JSON, otherwise the names of the repairs in the order they were applied
+        self.repairs = repairs
+
+
+def extract_json(response: str, expected_shape: Any = None) -> Optional[JsonExtraction]:
+    """
+    Finds the JSON in an LLM response without asking the LLM again. In order it tries:
+        the whole response
+        every JSON object or array in it (after code fences, prose, ...), repairing the defects LLMs make:
+            code_fence: the JSON is in a ``` block
+            extracted: there is text around the JSON
+            trailing_comma: a comma before } or ]
+            comments: // or /* */ comments
+            single_quotes: 'strings' instead of "strings"
+            python_literals: True, False or None instead of true, false or null
+            control_characters: raw new lines or tabs in a string
+            closed_brackets: the response was cut off, the open strings and brackets are closed
+            unwrapped: the value is wrapped in an object with one key, EX: {"files": {...}}
+            merged_objects: the response has several objects, each with part of the value, they are merged
+    Every candidate is checked against expected_shape, the first one that matches is returned
+    (merged with the objects after it that match too).
+    :param response: the response from an LLM
+    :param expected_shape: the type the JSON has to be (EX: Dict[str, str], List[str], dict), None for anything
+    :return: the JsonExtraction, None if no JSON with the shape was found
+    """
     try:
-        output = json.loads(response)
-        return output
-    except Exception as e:
+        value = json.loads(response)
+        if matches_shape(value, expected_shape):
+            return JsonExtraction(value, [])
+    except ValueError:
         pass
-    try:
-        start_index = response.index('{')
-        end_index = response.rindex('}') + 1
-        json_str = response[start_index:end_index]
-        return json.loads(json_str)
-    except Exception as e:
-        log_it(logger=logger, error=None, custom_message=f"JSON msg that broke: {response}", log_level="info")
-        raise CustomError("soft_error")
+
+    fenced = _FENCED_BLOCK.search(response)
+    if fenced is not None:
+        extraction = _extract_from_text(fenced.group(1), ["code_fence"], expected_shape)
+        if extraction is not None:
+            return extraction
+    return _extract_from_text(response, [], expected_shape)
+
+
+def matches_shape(value: Any, expected_shape: Any) -> bool:
+    """
+    :param value: a decoded JSON value
+    :param expected_shape: a type or typing hint, EX: Dict[str, str], List[Dict[str, Any]], Optional[str], None for any
+    :return: True if the value has the shape
+    """
+    if expected_shape is None or expected_shape is Any:
+        return True
+    origin = get_origin(expected_shape)
+    arguments = get_args(expected_shape)
+    if origin is Union:
+        return any(matches_shape(value, argument) for argument in arguments)
+    if origin in (dict, Dict):
+        if not isinstance(value, dict):
+            return False
+        key_shape, value_shape = arguments if arguments else (None, None)
+        return all(matches_shape(key, key_shape) and matches_shape(item, value_shape) for key, item in value.items())
+    if origin in (list, List):
+        return isinstance(value, list) and all(matches_shape(item, arguments[0] if arguments else None)
+                                               for item in value)
+    if expected_shape is type(None):
+        return value is None
+    if expected_shape is float:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if expected_shape is int:
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, expected_shape)
+
+
+_FENCED_BLOCK = re.compile(r"```[a-zA-Z]*\s*\n(.*?)(?:\n```|$)", re.DOTALL)
+_CLOSING_BRACKETS = {"{": "}", "[": "]"}
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _extract_from_text(text: str, base_repairs: List[str], expected_shape: Any) -> Optional[JsonExtraction]:
+    """
+    Tries every JSON value in the text, in order, see extract_json
+    """
+    # Every value found, (value, repairs), and if it had the shape as is
+    found: List[Tuple[Any, List[str], bool]] = []
+    position = 0
+    while True:
+        start = _next_opening_bracket(text, position)
+        if start == -1:
+            break
+        end, value, repairs = _decode_value(text, start)
+        if end is None:
+            position = start + 1
+            continue
+        repairs = base_repairs + (["extracted"] if text[:start].strip() or text[end:].strip() else []) + repairs
+        if matches_shape(value, expected_shape):
+            found.append((value, repairs, True))
+        else:
+            unwrapped = _unwrap(value, expected_shape)
+            if unwrapped is not None:
+                found.append((unwrapped, repairs + ["unwrapped"], True))
+            else:
+                found.append((value, repairs, False))
+        position = end
+
+    matching = [(value, repairs) for value, repairs, has_shape in found if has_shape]
+    if matching and not isinstance(matching[0][0], dict):
+        return JsonExtraction(*matching[0])
+    objects = [(value, repairs) for value, repairs, _ in found if isinstance(value, dict)]
+    if len(objects) > 1:
+        merged: Dict[str, Any] = {}
+        merged_repairs: List[str] = []
+        for value, repairs in objects:
+            merged.update(value)
+            for repair in repairs:
+                _add_repair(merged_repairs, repair)
+        if matches_shape(merged, expected_shape):
+            return JsonExtraction(merged, merged_repairs + ["merged_objects"])
+    return JsonExtraction(*matching[0]) if matching else None
+
+
+def _next_opening_bracket(text: str, position: int) -> int:
+    object_start, array_start = text.find("{", position), text.find("[", position)
+    if object_start == -1 or array_start == -1:
+        return max(object_start, array_start)
+    return min(object_start, array_start)
+
+
+def _decode_value(text: str, start: int) -> Tuple[Optional[int], Any, List[str]]:
+    """
+    Decodes the JSON value that starts at text[start], repairing it if needed
+    :return: where the value ends (None if it couldn't be decoded), the value, the repairs applied
+    """
+    end, repaired, repairs = _scan_value(text, start)
+    for strict in (True, False):
+        try:
+            value = json.JSONDecoder(strict=strict).decode(repaired)
+        except ValueError:
+            continue
+        return end, value, repairs + ([] if strict else ["control_characters"])
+    return None, None, []
+
+
+def _scan_value(text: str, start: int) -> Tuple[int, str, List[str]]:
+    """
+    One pass over the value that starts at text[start], it finds where the value ends and repairs it on the way,
+    everything in a string is copied as is.
+    :return: where the value ends, the repaired value, the repairs applied
+    """
+    output: List[str] = []
+    repairs: List[str] = []
+    open_brackets: List[str] = []
+    # The quote the string being read started with, None outside of strings
+    string_quote: Optional[str] = None
+    index = start
+    while index < len(text):
+        character = text[index]
+        if string_quote is not None:
+            if character == "\\" and string_quote == "'" and text.startswith("'", index + 1):
+                output.append("'")
+                index += 2
+                continue
+            if character == "\\":
+                output.append(text[index:index + 2])
+                index += 2
+                continue
+            if character == string_quote:
+                output.append('"')
+                string_quote = None
+            elif character == '"':
+                output.append('\\"')
+            else:
+                output.append(character)
+            index += 1
+            continue
+
+        if character in "\"'":
+            string_quote = character
+            if character == "'":
+                _add_repair(repairs, "single_quotes")
+            output.append('"')
+            index += 1
+            continue
+        elif character in _CLOSING_BRACKETS:
+            open_brackets.append(_CLOSING_BRACKETS[character])
+        elif character in "}]":
+            if _drop_trailing_comma(output):
+                _add_repair(repairs, "trailing_comma")
+            if open_brackets:
+                open_brackets.pop()
+            output.append(character)
+            index += 1
+            if not open_brackets:
+                return index, "".join(output), repairs
+            continue
+        elif text.startswith("//", index):
+            line_end = text.find("\n", index)
+            index = len(text) if line_end == -1 else line_end
+            _add_repair(repairs, "comments")
+            continue
+        elif text.startswith("/*", index):
+            comment_end = text.find("*/", index + 2)
+            index = len(text) if comment_end == -1 else comment_end + 2
+            _add_repair(repairs, "comments")
+            continue
+        elif character.isalpha():
+            word_end = index
+            while word_end < len(text) and text[word_end].isalpha():
+                word_end += 1
+            word = text[index:word_end]
+            if word in _PYTHON_LITERALS:
+                output.append(_PYTHON_LITERALS[word])
+                _add_repair(repairs, "python_literals")
+            else:
+                output.append(word)
+            index = word_end
+            continue
+        output.append(character)
+        index += 1
+
+    # The response ended inside the value, it was cut off
+    if string_quote is not None:
+        output.append('"')
+    _drop_trailing_comma(output)
+    output.extend(reversed(open_brackets))
+    _add_repair(repairs, "closed_brackets")
+    return len(text), "".join(output), repairs
+
+
+def _drop_trailing_comma(output: List[str]) -> bool:
+    position = len(output) - 1
+    while position >= 0 and output[position].isspace():
+        position -= 1
+    if position >= 0 and output[position] == ",":
+        del output[position]
+        return True
+    return False
+
+
+def _add_repair(repairs: List[str], repair: str) -> None:
+    if repair not in repairs:
+        repairs.append(repair)
+
+
+def _unwrap(value: Any, expected_shape: Any) -> Any:
+    """
+    :return: the value inside an object with one key, if it has the shape, else None
+    """
+    if expected_shape is None or not isinstance(value, dict) or len(value) != 1:
+        return None
+    inner_value = next(iter(value.values()))
+    return inner_value if matches_shape(inner_value, expected_shape) else None
 
 
 def extract_code_from_output(lm_output: str) -> str:
@@ -48,3 +307,127 @@ def extract_code_from_output(lm_output: str) -> str:
     code_block = "\n" + code_block + "\n"
     return code_block
 
+
+class IncrementalCodeExtractor:
+    """
+    Fence aware code extractor for streamed LLM output.
+    Feed it the response a piece at a time and it gives back the code of the first ``` block as it forms,
+    without waiting for the whole response. Once done is True the closing fence has arrived and the rest
+    of the response can be cancelled.
+    To use:
+        extractor = IncrementalCodeExtractor()
+        for piece in stream:
+            new_code = extractor.feed(piece)
+            if extractor.done:
+                break
+    """
+    fence = "```"
+
+    def __init__(self):
+        self._buffer = ""
+        self._code_start: Optional[int] = None
+        self._code_end: Optional[int] = None
+        self._emitted = 0
+
+    @property
+    def done(self) -> bool:
+        return self._code_end is not None
+
+    @property
+    def started(self) -> bool:
+        return self._code_start is not None
+
+    def feed(self, piece: str) -> str:
+        """
+        Adds the next piece of the response
+        :param piece: the next piece of the response
+        :return: the code that became available with this piece (can be empty)
+        """
+        if self.done:
+            return ""
+        self._buffer += piece
+
+        if self._code_start is None:
+            fence_start = self._buffer.find(self.fence)
+            if fence_start == -1:
+                return ""
+            # The opening fence line (EX: ```jsx) has to be complete before the code starts
+            line_end = self._buffer.find("\n", fence_start)
+            if line_end == -1:
+                return ""
+            self._code_start = line_end + 1
+            self._emitted = self._code_start
+
+        if self._buffer.startswith(self.fence, self._code_start):
+            self._code_end = self._code_start
+        else:
+            closing_fence = self._buffer.find("\n" + self.fence, self._code_start)
+            if closing_fence != -1:
+                self._code_end = closing_fence
+
+        if self._code_end is not None:
+            safe_end = self._code_end
+        else:
+            # Hold back anything that could be the start of the closing fence
+            safe_end = len(self._buffer) - self._partial_fence_length()
+        new_code = self._buffer[self._emitted:safe_end]
+        self._emitted = max(self._emitted, safe_end)
+        return new_code
+
+    def finish(self) -> str:
+        """
+        Call this when the response has ended.
+        :return: any code that was being held back. If there never was a fence, the whole response is the code
+        """
+        if self._code_start is None:
+            self._code_start = 0
+            self._emitted = 0
+        if self._code_end is None:
+            self._code_end = len(self._buffer)
+        new_code = self._buffer[self._emitted:self._code_end]
+        self._emitted = self._code_end
+        return new_code
+
+    @property
+    def code(self) -> str:
+        """
+        :return: the code so far, formatted the same way as extract_code_from_output
+        """
+        if self._code_start is None:
+            return ""
+        return "\n" + self._buffer[self._code_start:self._emitted].strip() + "\n"
+
+    def _partial_fence_length(self) -> int:
+        closing_fence = "\n" + self.fence
+        for length in range(len(closing_fence) - 1, 0, -1):
+            if self._buffer.endswith(closing_fence[:length]):
+                return length
+        return 0
+
+
+def extract_code_from_stream(stream: Iterator[str],
+                             on_code: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Reads a streamed LLM response until the code block is closed, then closes the stream so the
+    trailing prose is never generated.
+    :param stream: the streamed response, EX: make_multi_provider_call_stream(...)
+    :param on_code: called with every new piece of code as soon as it is available
+    :return: the code block, formatted the same way as extract_code_from_output
+    """
+    extractor = IncrementalCodeExtractor()
+    try:
+        for piece in stream:
+            new_code = extractor.feed(piece)
+            if new_code and on_code is not None:
+                on_code(new_code)
+            if extractor.done:
+                break
+        else:
+            new_code = extractor.finish()
+            if new_code and on_code is not None:
+                on_code(new_code)
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    return extractor.code
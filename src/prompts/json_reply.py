@@ -1,25 +1,37 @@
-from typing import Callable
+from typing import Any, Callable
 from global_code.helpful_functions import CustomError
+from global_code.metrics import get_metrics_registry
 from prompts.cleaning_outputs import clean_and_convert_llm_response
 
 
-def try_json_response(api_call: Callable, *args, **kwargs) -> dict:
+def try_json_response(api_call: Callable, *args, expected_shape: Any = None, **kwargs) -> dict:
     """
     Tries to call the function and return the JSON response.
     If the attempt fails three times, it's probably a bad prompt. Does not deal with the api call.
-    The code that tries to get the JSON is very bad.
+    Most broken JSON is repaired without calling the LLM again (see cleaning_outputs.extract_json),
+    only a response with no JSON of the expected shape in it is retried.
+    Retries are sent with refresh_cache=True so a cached bad response isn't returned again.
+    Any other CustomError (EX: a replay miss of the LLM cache, a provider that isn't supported) is raised right away,
+    asking again can't help.
     CAN RAISE AN ERROR
     :param api_call: The api call to the LLM
     :param args: the arguments to pass to the function
+    :param expected_shape: the type the JSON has to be, EX: Dict[str, str], None for any dict
     :param kwargs: the keyword arguments to pass to the function
     :return: the JSON response from the function
     """
-    for _ in range(3):
+    for attempt in range(3):
         try:
+            if attempt > 0:
+                kwargs["refresh_cache"] = True
+                get_metrics_registry().counter("json_reprompts_total",
+                                               "How many times an LLM was asked again for JSON").inc()
             response: str = api_call(*args, **kwargs)  # This is the api call to an LLM
-            converted_json: dict = clean_and_convert_llm_response(response)
+            converted_json: dict = clean_and_convert_llm_response(response, expected_shape=expected_shape)
             return converted_json
-        except CustomError:
+        except CustomError as e:
+            if e.error_type != "soft_error":
+                raise
             continue
         except Exception as e:
             raise CustomError("Prompt Failed")
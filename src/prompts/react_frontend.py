@@ -1,21 +1,102 @@
+import json
 import os
-from typing import Dict, Union, Optional, List
+from typing import Dict, Union, Optional, List, Callable, Iterator
 
-from api_calls.call_any_llm import make_multi_provider_call
-from prompts.cleaning_outputs import clean_and_convert_llm_response, extract_code_from_output
+from api_calls.call_any_llm import make_multi_provider_call, make_multi_provider_call_stream
+from api_calls.model_router import get_model_router, REFINE
+from api_calls.openai_call import OPENAI_MAX_COMPLETION_TOKENS
+from prompts.cleaning_outputs import clean_and_convert_llm_response, extract_code_from_output, \
+    extract_code_from_stream
 from prompts.json_reply import try_json_response
-from global_code.helpful_functions import create_logger_error, log_it
+from prompts.chain_fusion import get_chain_mode, create_fused_prompt, extract_final_section, FUSED
+from prompts.token_budget import fit_prompt, TEXT, CODE
+from global_code.token_counter import count_tokens
+from global_code.metrics import get_metrics_registry
+from global_code.helpful_functions import create_logger_error, log_it, benchmark_function
 logger = create_logger_error(os.path.abspath(__file__), "react_prompts",
                              log_to_console=True, log_to_file=True)
 
+
+def _draft_and_refine(stage: str, draft_prompt: str, create_refine_prompt: Callable[[str], str],
+                      refine_instructions: str, draft_temperature: float, refine_temperature: float,
+                      chain_mode: Optional[str] = None) -> str:
+    """
+    Runs a draft + refine prompt chain, as two calls or fused into one (see prompts.chain_fusion)
+    :param stage: the name of the prompt, the mode is looked up with it
+    :param draft_prompt: the prompt of the draft
+    :param create_refine_prompt: makes the refine prompt from the draft
+    :param refine_instructions: the part of the refine prompt that says what to do with the draft
+    :param chain_mode: two_pass or fused, None for the CHAIN_FUSION config
+    :return: the refined answer
+    """
+    chain_mode = chain_mode or get_chain_mode(stage)
+    registry = get_metrics_registry()
+    with registry.time("prompt_chain_duration_seconds", "How long a draft + refine chain took", stage=stage,
+                       mode=chain_mode):
+        if chain_mode == FUSED:
+            # One call does both, between the temperature of the draft and the one of the refine
+            prompts = [create_fused_prompt(draft_prompt, refine_instructions)]
+            answers = [make_multi_provider_call(call_type="llm", provider="openai", input_text=prompts[0],
+                                                task="refine",
+                                                config={"type_of_response": "text_only"},
+                                                temperature=(draft_temperature + refine_temperature) / 2)]
+            refined_answer = extract_final_section(answers[0])
+        else:
+            prompts = [draft_prompt]
+            answers = [make_multi_provider_call(call_type="llm", provider="openai", input_text=draft_prompt,
+                                                task="draft",
+                                                config={"type_of_response": "text_only"},
+                                                temperature=draft_temperature)]
+            prompts.append(create_refine_prompt(answers[0]))
+            answers.append(make_multi_provider_call(call_type="llm", provider="openai", input_text=prompts[1],
+                                                    task="refine",
+                                                    config={"type_of_response": "text_only"},
+                                                    temperature=refine_temperature))
+            refined_answer = answers[1]
+    registry.counter("prompt_chain_calls_total", "LLM calls made by draft + refine chains", stage=stage,
+                     mode=chain_mode).inc(len(prompts))
+    registry.counter("prompt_chain_input_characters_total", "Characters sent by draft + refine chains", stage=stage,
+                     mode=chain_mode).inc(sum(len(chain_prompt) for chain_prompt in prompts))
+    registry.counter("prompt_chain_output_characters_total", "Characters received by draft + refine chains",
+                     stage=stage, mode=chain_mode).inc(sum(len(str(answer)) for answer in answers))
+    registry.counter("prompt_chain_result_characters_total", "Characters of the refined answers", stage=stage,
+                     mode=chain_mode).inc(len(refined_answer))
+    registry.counter("prompt_chain_input_tokens_total", "Tokens sent by draft + refine chains", stage=stage,
+                     mode=chain_mode).inc(sum(count_tokens(chain_prompt) for chain_prompt in prompts))
+    registry.counter("prompt_chain_output_tokens_total", "Tokens received by draft + refine chains", stage=stage,
+                     mode=chain_mode).inc(sum(count_tokens(str(answer)) for answer in answers))
+    return refined_answer
+
+
+def _previous_files_text(previous_directories: Dict[str, Dict[str, str]]) -> str:
+    """
+    The files an earlier run made for the directories, for an incremental run to keep them stable
+    :param previous_directories: directory name -> {file name: description}
+    :return: the section of the prompt, empty if there are no files
+    """
+    directories_text = "\n".join(f"    {directory_name}: {json.dumps(files)}"
+                                  for directory_name, files in previous_directories.items() if files)
+    if not directories_text:
+        return ""
+    return f'''
+Existing Files (from the last version of the project):
+{directories_text}
+
+    Keep the file names and descriptions of the existing files word for word, unless the blueprint of their directory no longer needs the file or needs it to do something else.
+    Only add, remove or change the files for what changed in the blueprint.
+'''
+
+
 class ReactPrompts:
     def __init__(self):
         self._components = []
 
     @staticmethod
-    def create_scope(project_name: str, project_description: str) -> str:
+    @benchmark_function(file_prefix="ReactPrompts.")
+    def create_scope(project_name: str, project_description: str, chain_mode: Optional[str] = None) -> str:
         """
         Creates a project scope document for the project.
+        chain_mode: two_pass (a draft call and a refine call) or fused (one call), None for the CHAIN_FUSION config
 
         Returns:
         str: The content of the project scope document.
@@ -50,22 +131,7 @@ Using the project name and description provided above, create a detailed project
     Conclusion:
         Summarize the scope document, emphasizing the project's goals and how the outlined scope will achieve them.
 '''
-        first_blueprint: str = (make_multi_provider_call(call_type="llm", provider="openai",
-                                                  input_text=project_scope_content,
-                                                  config={"model": "gpt-3.5-turbo-0125",
-                                                          "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.8}))
-
-        refine_prompt = f'''
-Project Name: {project_name}
-
-Project Description: {project_description}
-
-Initial Project Scope Document:
-{first_blueprint}
-
-Instructions for AI:
-
+        refine_instructions = '''
 Given the project name, description, and the initial project scope document provided above, proceed with a detailed review and refinement of the scope document focusing on the React frontend development. Your refinements should address the following objectives:
 
     Accuracy Verification:
@@ -95,15 +161,35 @@ Given the project name, description, and the initial project scope document prov
     Conclusive Summary:
         Provide a concise summary of the key refinements made to the scope document, emphasizing the improvements and their intended impact on the project.
 '''
-        refined_blueprint: str = (make_multi_provider_call(call_type="llm", provider="openai",
-                                                  input_text=project_scope_content,
-                                                  config={"model": "gpt-3.5-turbo-0125",
-                                                          "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.2}))
-        return refined_blueprint
+
+        def create_refine_prompt(first_blueprint: str) -> str:
+            return f'''
+Project Name: {project_name}
+
+Project Description: {project_description}
+
+Initial Project Scope Document:
+{first_blueprint}
+
+Instructions for AI:
+{refine_instructions}'''
+
+        return _draft_and_refine("create_scope", project_scope_content, create_refine_prompt, refine_instructions,
+                                 draft_temperature=0.8, refine_temperature=0.2, chain_mode=chain_mode)
 
     @staticmethod
-    def designer(project_name: str, project_description: str, design_blueprint: str) -> str:
+    @benchmark_function(file_prefix="ReactPrompts.")
+    def designer(project_name: str, project_description: str, design_blueprint: str,
+                 chain_mode: Optional[str] = None) -> str:
+        """
+        Creates the design narratives of every page of the project.
+        :param project_name: The name of the project.
+        :param project_description: The description of the project.
+        :param design_blueprint: The scope of the project.
+        :param chain_mode: two_pass (a draft call and a refine call) or fused (one call), None for the CHAIN_FUSION
+        config
+        :return: The design of the project.
+        """
         prompt = f'''
 Project Name: {project_name}
 
@@ -128,18 +214,7 @@ Design Deliverables:
     - Comprehensive Design Narratives: Submit detailed textual descriptions for each page, covering all the design conceptualization requirements mentioned above. These narratives should collectively paint a vivid picture of what the website will look like, providing a clear guide for the development process.
 
 '''
-        first_design_blueprint: str = (make_multi_provider_call(call_type="llm", provider="openai",
-                                                  input_text=prompt,
-                                                  config={"model": "gpt-3.5-turbo-0125",
-                                                          "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.9}))
-
-        refine_prompt = f'''
-Given Project Name: {project_name}
-
-Initial Design Concepts Received:
-- Here, summarize or insert the design concept narratives provided from the previous stage. This should include descriptions for each page, covering functionality, aesthetics, layout, and user interface elements.
-
+        refine_instructions = f'''
 Evaluation and Refinement Criteria:
 
 1. Alignment with Project Vision:
@@ -164,14 +239,20 @@ Refinement Deliverables:
 
 - Refined Design Narratives: Based on the evaluation criteria, provide revised narratives for each page that incorporate suggested improvements. These narratives should detail the optimized design concept, ensuring it is both innovative and closely aligned with the project's vision.
 '''
-        refined_blueprint: str = (make_multi_provider_call(call_type="llm", provider="openai",
-                                                  input_text=refine_prompt,
-                                                  config={"model": "gpt-3.5-turbo-0125",
-                                                          "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.2}))
-        return refined_blueprint
+
+        def create_refine_prompt(first_design_blueprint: str) -> str:
+            return f'''
+Given Project Name: {project_name}
+
+Initial Design Concepts Received:
+{first_design_blueprint}
+{refine_instructions}'''
+
+        return _draft_and_refine("designer", prompt, create_refine_prompt, refine_instructions,
+                                 draft_temperature=0.9, refine_temperature=0.2, chain_mode=chain_mode)
 
     @staticmethod
+    @benchmark_function(file_prefix="ReactPrompts.")
     def create_high_level_structure(project_reqs: str, design_blueprint: str) -> Dict[str, str]:
         """
         Creates a high-level structure for the project.
@@ -179,7 +260,8 @@ Refinement Deliverables:
         :param design_blueprint: The design blueprint.
         :return: A dictionary containing the high-level structure of the project.
         """
-        prompt = f'''
+        def build_prompt(project_reqs: str, design_blueprint: str) -> str:
+            return f'''
 Project Requirements Overview:
     {project_reqs}
 
@@ -208,11 +290,23 @@ Instructions:
     Figure out what every directory will contain or if it will be empty.
     Only talk at a high level, no need to go into the details of the files in the directories.
 '''
+        # The compacted requirements and design are used by every prompt of the chain, so they have to fit the
+        # smallest model of the chain, with room for its completion and the structure the later prompts add
+        chain_models = ["gpt-4-0125-preview"] + [model for provider, model
+                                                 in get_model_router().task_routes[REFINE].candidates
+                                                 if provider == "openai"]
+        fitted = fit_prompt("create_high_level_structure", build_prompt,
+                            {"project_reqs": project_reqs, "design_blueprint": design_blueprint},
+                            {"project_reqs": TEXT, "design_blueprint": TEXT},
+                            models=chain_models, reserved_tokens=2 * OPENAI_MAX_COMPLETION_TOKENS)
+        prompt = fitted.prompt
+        project_reqs, design_blueprint = fitted.parts["project_reqs"], fitted.parts["design_blueprint"]
         first_high_level_structure: str = (make_multi_provider_call(call_type="llm", provider="openai",
                                                   input_text=prompt,
+                                                  task="draft",
                                                   config={"model": "gpt-4-0125-preview",
                                                           "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.9}))
+                                                  temperature=0.9))
 
         refine_prompt = f'''
 Project Requirements Overview:
@@ -255,9 +349,10 @@ Output:
 '''
         refined_structure: str = (make_multi_provider_call(call_type="llm", provider="openai",
                                                   input_text=refine_prompt,
+                                                  task="refine",
                                                   config={"model": "gpt-4-0125-preview",
                                                           "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.4}))
+                                                  temperature=0.4))
         last_refine_prompt = f'''
     Requirements: {project_reqs}
     
@@ -294,9 +389,9 @@ Output:
 '''
         refined_structure: str = (make_multi_provider_call(call_type="llm", provider="openai",
                                                   input_text=last_refine_prompt,
-                                                  config={"model": "gpt-3.5-turbo-0125",
-                                                          "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.1}))
+                                                  task="refine",
+                                                  config={"type_of_response": "text_only"},
+                                                  temperature=0.1))
 
         ensure_structure_aligns_with_project_reqs = f'''
 Client Requirements Overview:
@@ -326,8 +421,8 @@ Deliverables:
 '''
         new_and_ensured_structure: str = (make_multi_provider_call(call_type="llm", provider="openai",
                                                     input_text=ensure_structure_aligns_with_project_reqs,
-                                                    config={"model": "gpt-3.5-turbo-0125",
-                                                            "type_of_response": "function_calling"}))
+                                                    task="refine",
+                                                    config={"type_of_response": "function_calling"}))
 
         jsonify_prompt = f'''
 Objective: Create a JSON structure that outlines the purpose and role of specific directories within a React frontend project. This structure should serve as a clear blueprint for development, indicating what each directory is intended to house or accomplish.
@@ -370,15 +465,20 @@ Instructions:
         json_structure: Dict[str, str] = try_json_response(
             make_multi_provider_call,
             call_type="llm", provider="openai", input_text=jsonify_prompt,
-            config={"model": "gpt-3.5-turbo-0125", "type_of_response": "function_calling"})
+            task="json",
+            config={"type_of_response": "function_calling"},
+            expected_shape=Dict[str, str])
         return json_structure
 
     @staticmethod
-    def create_directory(directory_name: str, directory_blueprint: str) -> Dict[str, str]:
+    @benchmark_function(file_prefix="ReactPrompts.")
+    def create_directory(directory_name: str, directory_blueprint: str,
+                         previous_files: Optional[Dict[str, str]] = None) -> Dict[str, str]:
         """
         Creates a directory within the project.
         :param directory_name: Directory name.
         :param directory_blueprint: Directory blueprint.
+        :param previous_files: the files an earlier run made for the directory, they are kept if they still fit.
         :return: The files created within the directory.
         """
         blueprint_for_dir_creation_prompt = f'''
@@ -408,9 +508,9 @@ Instructions:
 '''
         first_directory: str = (make_multi_provider_call(call_type="llm", provider="openai",
                                                   input_text=blueprint_for_dir_creation_prompt,
-                                                  config={"model": "gpt-3.5-turbo-0125",
-                                                          "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.5}))
+                                                  task="draft",
+                                                  config={"type_of_response": "text_only"},
+                                                  temperature=0.5))
 
         refine_prompt = f'''
 Objective: Generate a concise, actionable blueprint for a React project subdirectory, focusing on file creation with clear, purpose-driven descriptions. This streamlined approach aims to facilitate the development process by outlining essential files without assuming imports.
@@ -435,9 +535,9 @@ Instructions:
 '''
         refined_directory: str = (make_multi_provider_call(call_type="llm", provider="openai",
                                                   input_text=refine_prompt,
-                                                  config={"model": "gpt-3.5-turbo-0125",
-                                                          "type_of_response": "text_only"},
-                                                  kwargs={"temperature": 0.2}))
+                                                  task="refine",
+                                                  config={"type_of_response": "text_only"},
+                                                  temperature=0.2))
 
         create_files_prompt = f'''
 Objective: Transform the refined blueprint of a React project subdirectory into a JSON object. Each key in the JSON object should correspond to a JavaScript file name within the subdirectory, and the associated value should describe the file's functionality and purpose.
@@ -458,21 +558,101 @@ Instructions:
         Validate the JSON to check for syntax errors before finalizing.
         Ensure the JSON has strings for both keys and values, with no nested objects or arrays.
         Be as verbose as needed for all descriptions of files and directories.
-'''
+{_previous_files_text({directory_name: previous_files or {}})}'''
         files_created: Dict[str, str] = try_json_response(
             make_multi_provider_call,
             call_type="llm", provider="openai", input_text=create_files_prompt,
-            config={"model": "gpt-3.5-turbo-0125", "type_of_response": "function_calling"})
+            task="json",
+            config={"type_of_response": "function_calling"},
+            expected_shape=Dict[str, str])
 
         return files_created
 
     @staticmethod
+    @benchmark_function(file_prefix="ReactPrompts.")
+    def create_all_directories(directory_blueprints: Dict[str, str],
+                               previous_directories: Optional[Dict[str, Dict[str, str]]] = None
+                               ) -> Dict[str, Dict[str, str]]:
+        """
+        The files of every directory with one call, instead of the three calls per directory of create_directory.
+        CAN RAISE AN ERROR: CustomError if the response has no JSON of the right shape after the retries
+        :param directory_blueprints: Directory name -> directory blueprint.
+        :param previous_directories: Directory name -> the files an earlier run made for it, kept if they still fit.
+        :return: Directory name -> the files created within the directory (file name -> description).
+        """
+        directories_text = "\n".join(f"    {directory_name}: {directory_blueprint}"
+                                      for directory_name, directory_blueprint in directory_blueprints.items())
+        example_json = ", ".join(f'"{directory_name}": {{"FileName.js": "Description of the file"}}'
+                                 for directory_name in directory_blueprints)
+        create_all_directories_prompt = f'''
+Objective: Create a concise, actionable blueprint of every listed subdirectory of a React project, as one JSON object. The blueprint identifies the necessary files of each subdirectory and describes them, assuming there will be no imports in any of the files.
+
+Directories:
+{directories_text}
+
+Instructions:
+
+    Blueprint Generation, for every directory:
+        Identify Essential Files: List only the necessary files, focusing on only .js. DO NOT suggest the creation of more directories.
+        Merge Similar Functions: Where possible, combine files with overlapping functionalities to reduce redundancy.
+        Clarify File Purposes: For each file, provide a description of its purpose and functionality, including any specific components, hooks, or utilities it defines.
+        Remember, no imports or external dependencies should be assumed or included in the file descriptions.
+
+    JSON Formatting:
+        The keys of the JSON object are the directory names, exactly as listed above, every directory has to be there.
+        The value of each directory is a JSON object, its keys are the JavaScript file names (with the file extension) and its values are strings describing the file.
+        Ensure the JSON object is correctly formatted, with proper use of quotes and commas.
+        Be as verbose as needed for all descriptions of files.
+
+    Example of the format:
+{{{example_json}}}
+{_previous_files_text(previous_directories or {})}'''
+        directories_created: Dict[str, Dict[str, str]] = try_json_response(
+            make_multi_provider_call,
+            call_type="llm", provider="openai", input_text=create_all_directories_prompt,
+            task="json",
+            config={"type_of_response": "function_calling"},
+            expected_shape=Dict[str, Dict[str, str]])
+        return directories_created
+
+    @staticmethod
+    @benchmark_function(file_prefix="ReactPrompts.")
     def create_component_code(description_of_code: str) -> str:
         """
         Creates the code for a component.
         :param description_of_code: The description of the component's functionality.
         :return: The code for the component.
         """
+        prompt = ReactPrompts._component_code_prompt(description_of_code)
+        component_code2: str = make_multi_provider_call(call_type="llm", provider="openai",
+                                                 input_text=prompt,
+                                                 task="code",
+                                                 config={"type_of_response": "code_only"},
+                                                 temperature=0.7)
+        component_code: str = extract_code_from_output(component_code2)
+        return component_code
+
+    @staticmethod
+    @benchmark_function(file_prefix="ReactPrompts.")
+    def create_component_code_streaming(description_of_code: str,
+                                        on_code: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Streaming version of create_component_code.
+        Returns as soon as the code block is closed and cancels the rest of the response.
+        :param description_of_code: The description of the component's functionality.
+        :param on_code: called with every new piece of code as soon as the model writes it
+        :return: The code for the component.
+        """
+        prompt = ReactPrompts._component_code_prompt(description_of_code)
+        stream: Iterator[str] = make_multi_provider_call_stream(call_type="llm", provider="openai",
+                                                                input_text=prompt,
+                                                                task="code",
+                                                                config={"type_of_response": "code_only"},
+                                                                temperature=0.7)
+        return extract_code_from_stream(stream, on_code=on_code)
+
+    @staticmethod
+    def _component_code_prompt(description_of_code: str) -> str:
         prompt = f'''
 Objective: Create a comprehensive React component file based on the provided description.
 
@@ -488,15 +668,10 @@ Output Specifications:
     Styling: DO NOT CREATE STYLES. They will be added later.
     Export Statement: Export the component at the end of the file.
 '''
-        component_code2: str = make_multi_provider_call(call_type="llm", provider="openai",
-                                                 input_text=prompt,
-                                                 config={"model": "gpt-3.5-turbo-0125",
-                                                         "type_of_response": "code_only"},
-                                                 kwargs={"temperature": 0.7})
-        component_code: str = extract_code_from_output(component_code2)
-        return component_code
+        return prompt
 
     @staticmethod
+    @benchmark_function(file_prefix="ReactPrompts.")
     def create_css_code(description_of_code: str, component_code: str) -> str:
         """
         Creates the code for css.
@@ -504,7 +679,8 @@ Output Specifications:
         :param component_code: The code for the component.
         :return: The code for the css file.
         """
-        prompt = f'''
+        def build_prompt(component_code: str) -> str:
+            return f'''
 Objective: Create a CSS or styled-components file for a React component based on the provided description and component requirements.
 
 
@@ -525,15 +701,18 @@ Output Specifications:
         Ensure the file is ready to be linked or imported into the React component.
 
 '''
+        prompt = fit_prompt("create_css_code", build_prompt, {"component_code": component_code},
+                            {"component_code": CODE}).prompt
         css_code_output: str = make_multi_provider_call(call_type="llm", provider="openai",
                                                         input_text=prompt,
-                                                        config={"model": "gpt-3.5-turbo-0125",
-                                                                "type_of_response": "code_only"},
-                                                        kwargs={"temperature": 0.7})
+                                                        task="code",
+                                                        config={"type_of_response": "code_only"},
+                                                        temperature=0.7)
         css_code: str = extract_code_from_output(css_code_output)
         return css_code
 
     @staticmethod
+    @benchmark_function(file_prefix="ReactPrompts.")
     def create_js_test_code(description_of_code: str, component_code: str) -> str:
         """
         Creates the code for the js test.
@@ -541,7 +720,8 @@ Output Specifications:
         :param component_code: The code for the component.
         :return: The code for the test file.
         """
-        prompt = f'''
+        def build_prompt(component_code: str) -> str:
+            return f'''
 Title: Generate a Test File for a React Component Using Jest and React Testing Library
 
 Objective: Create a test file for a specified React component that covers its functionality, props, and user interactions using Jest and React Testing Library.
@@ -563,15 +743,18 @@ Output Specifications:
     Assertions: Use assertions to check if the component behaves as expected under various conditions (e.g., expect statements).
     Cleanup: Ensure tests clean up after themselves to prevent side effects between tests.
 '''
+        prompt = fit_prompt("create_js_test_code", build_prompt, {"component_code": component_code},
+                            {"component_code": CODE}).prompt
         test_code_output: str = make_multi_provider_call(call_type="llm", provider="openai",
                                                         input_text=prompt,
-                                                        config={"model": "gpt-3.5-turbo-0125",
-                                                                "type_of_response": "code_only"},
-                                                        kwargs={"temperature": 0.7})
+                                                        task="code",
+                                                        config={"type_of_response": "code_only"},
+                                                        temperature=0.7)
         test_code: str = extract_code_from_output(test_code_output)
         return test_code
 
     @staticmethod
+    @benchmark_function(file_prefix="ReactPrompts.")
     def create_js_view(description_of_view: str, component_code: List[str]) -> str:
         """
         Creates the code for a view.
@@ -579,7 +762,8 @@ Output Specifications:
         :param component_code: All the components that will be used in the view.
         :return: The code for the view file.
         """
-        prompt = f'''
+        def build_prompt(component_code: str) -> str:
+            return f'''
 Title: Generate a JavaScript View
 
 Objective: Create a JavaScript (JS) view file based on the provided description, incorporating given React components and specifying their arrangement and functionality within the view.
@@ -597,11 +781,13 @@ Output Specifications:
     Additional Features: Include any routing, data fetching, or context provision as required by the view's description.
     Export Statement: Export the view component for use in the application.
 '''
+        prompt = fit_prompt("create_js_view", build_prompt, {"component_code": "\n\n".join(component_code)},
+                            {"component_code": CODE}).prompt
         test_code_output: str = make_multi_provider_call(call_type="llm", provider="openai",
                                                         input_text=prompt,
-                                                        config={"model": "gpt-3.5-turbo-0125",
-                                                                "type_of_response": "code_only"},
-                                                        kwargs={"temperature": 0.7})
+                                                        task="code",
+                                                        config={"type_of_response": "code_only"},
+                                                        temperature=0.7)
         test_code: str = extract_code_from_output(test_code_output)
         return test_code
 
@@ -0,0 +1,317 @@
+"""
+Token budgets for the prompts that embed earlier outputs (requirements, designs, component code).
+Every budgeted prompt is measured with the local approximate tokenizer (global_code.token_counter) before it is sent.
+If it is over the budget of its stage, the embedded parts are compacted until it fits:
+    dedupe: paragraphs of a text part that are already in an earlier text part are dropped
+    whitespace: runs of spaces and blank lines are collapsed
+    sections: only the headings and the first sentence of every paragraph of a text part are kept
+    signatures: a code part is cut down to its imports, exports, declarations and the class names it uses
+    truncate: the part is cut at its share of the budget
+The budget of every stage is set in the TOKEN_BUDGETS section of config.yaml, EX:
+TOKEN_BUDGETS:
+  create_css_code: 3000
+  create_js_view: 6000
+To use:
+    fitted = fit_prompt("create_css_code", build_prompt, {"component_code": component_code}, {"component_code": CODE})
+    send(fitted.prompt)
+"""
+import math
+import os
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from api_calls.openai_call import OPENAI_CONTEXT_WINDOWS
+from global_code.helpful_functions import create_logger_error, log_it
+from global_code.metrics import get_metrics_registry
+from global_code.singleton import State
+from global_code.token_counter import count_tokens, TOKEN_PATTERN
+
+logger = create_logger_error(os.path.abspath(__file__), "token_budget", log_to_console=True, log_to_file=True)
+
+# The kinds of parts, they decide how a part is compacted
+TEXT = "text"
+CODE = "code"
+
+# A stage that isn't here, and isn't in TOKEN_BUDGETS, gets the budget of the models it is sent to (see fit_prompt)
+DEFAULT_STAGE_BUDGETS: Dict[str, int] = {
+    "create_css_code": 3000,
+    "create_js_test_code": 3000,
+    "create_js_view": 6000,
+}
+TRUNCATION_MARKER = "\n[...]"
+# How many times the parts are cut down again if the prompt is still over (the token count is approximate)
+MAX_FIT_ROUNDS = 3
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+_DECLARATION = re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\b"
+                          r"|^\s*(?:export\s+)?(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?(?:\(|\w+\s*=>|function|React\.|styled)"
+                          r"|^\s*(?:export\s+)?(?:default\s+)?class\s+\w+"
+                          r"|^\s*(?:import|export)\b"
+                          r"|\.propTypes\s*=|\.defaultProps\s*=")
+_CLASS_NAMES = re.compile(r"className\s*=\s*[\"'{`]+([^\"'`}]+)")
+_TEST_IDS = re.compile(r"data-testid\s*=\s*[\"'{`]+([^\"'`}]+)")
+
+
+class TokenBudgetReport:
+    """
+    What fit_prompt did to a prompt
+    """
+
+    def __init__(self, stage: str, budget: Optional[int], original_tokens: int, final_tokens: int,
+                 strategies: List[str]):
+        self.stage = stage
+        self.budget = budget
+        self.original_tokens = original_tokens
+        self.final_tokens = final_tokens
+        # The compaction strategies applied, in order, empty if the prompt fit as it was
+        self.strategies = strategies
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.original_tokens - self.final_tokens
+
+    @property
+    def fits(self) -> bool:
+        return self.budget is None or self.final_tokens <= self.budget
+
+
+class FittedPrompt:
+    """
+    A prompt that fits its budget, and the parts it was built from (compacted if they had to be)
+    """
+
+    def __init__(self, prompt: str, parts: Dict[str, str], report: TokenBudgetReport):
+        self.prompt = prompt
+        self.parts = parts
+        self.report = report
+
+
+def fit_prompt(stage: str, build_prompt: Callable[..., str], parts: Dict[str, str],
+               part_kinds: Dict[str, str], budget: Optional[int] = None, models: Optional[List[str]] = None,
+               reserved_tokens: int = 0) -> FittedPrompt:
+    """
+    Builds the prompt, and compacts its parts if it is over the budget of the stage
+    :param stage: the name of the prompt, EX: create_css_code
+    :param build_prompt: makes the prompt from the parts, called with them as keyword arguments
+    :param parts: part name -> text, everything in the prompt that can be compacted
+    :param part_kinds: part name -> TEXT or CODE, parts that aren't in it are never compacted
+    :param budget: the max tokens of the prompt, None for the budget of the stage
+    :param models: the models the prompt (or the prompts made from its parts) can be sent to, a stage without a
+    budget gets get_model_budget(models, reserved_tokens)
+    :param reserved_tokens: see get_model_budget
+    :return: the FittedPrompt
+    """
+    budget = get_stage_budget(stage) if budget is None else budget
+    if budget is None and models:
+        budget = get_model_budget(models, reserved_tokens)
+    prompt = build_prompt(**parts)
+    original_tokens = count_tokens(prompt)
+    strategies: List[str] = []
+    compacted_parts = dict(parts)
+    if budget is not None and original_tokens > budget:
+        compacted_parts = _deduplicate_parts(compacted_parts, part_kinds, strategies)
+        prompt = build_prompt(**compacted_parts)
+        for _ in range(MAX_FIT_ROUNDS):
+            prompt_tokens = count_tokens(prompt)
+            if prompt_tokens <= budget:
+                break
+            compacted_parts = _compact_parts(compacted_parts, part_kinds, prompt_tokens - budget, strategies)
+            prompt = build_prompt(**compacted_parts)
+
+    report = TokenBudgetReport(stage, budget, original_tokens, count_tokens(prompt), strategies)
+    _record(report)
+    return FittedPrompt(prompt, compacted_parts, report)
+
+
+def deduplicate_paragraphs(text: str, seen_paragraphs: set) -> str:
+    """
+    Drops the paragraphs of the text that are in seen_paragraphs, and adds the rest to it
+    :return: the text without the repeated paragraphs
+    """
+    kept_paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        normalized = " ".join(paragraph.split()).lower()
+        if not normalized:
+            continue
+        if normalized in seen_paragraphs:
+            continue
+        seen_paragraphs.add(normalized)
+        kept_paragraphs.append(paragraph.strip("\n"))
+    return "\n\n".join(kept_paragraphs)
+
+
+def collapse_whitespace(text: str) -> str:
+    """
+    :return: the text with runs of spaces made into one and no blank lines
+    """
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+def extract_sections(text: str) -> str:
+    """
+    Keeps the headings and the first sentence of every paragraph
+    :return: the outline of the text
+    """
+    kept_lines = []
+    for line in collapse_whitespace(text).splitlines():
+        if _is_heading(line):
+            kept_lines.append(line)
+            continue
+        first_sentence = _SENTENCE_END.split(line, maxsplit=1)[0]
+        kept_lines.append(first_sentence)
+    return "\n".join(kept_lines)
+
+
+def summarize_code(code: str) -> str:
+    """
+    Signature only summary of component code: the imports, exports and declarations (without their bodies),
+    and the class names and test ids used in the JSX, what the css and test prompts need
+    :return: the summary
+    """
+    kept_lines = [line.rstrip() for line in code.splitlines() if _DECLARATION.search(line)]
+    class_names = sorted({class_name for match in _CLASS_NAMES.findall(code) for class_name in match.split()})
+    test_ids = sorted(set(_TEST_IDS.findall(code)))
+    if class_names:
+        kept_lines.append(f"// classNames used: {', '.join(class_names)}")
+    if test_ids:
+        kept_lines.append(f"// data-testid used: {', '.join(test_ids)}")
+    return "\n".join(kept_lines)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    :return: the start of the text that fits in max_tokens, with TRUNCATION_MARKER if anything was cut
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - count_tokens(TRUNCATION_MARKER))
+    tokens = 0
+    end = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        tokens += count_tokens(match.group())
+        if tokens > budget:
+            break
+        end = match.end()
+    return text[:end].rstrip() + TRUNCATION_MARKER
+
+
+_stage_budgets: Optional[Dict[str, int]] = None
+_stage_budgets_lock = threading.Lock()
+
+
+def get_stage_budget(stage: str) -> Optional[int]:
+    """
+    :param stage: the name of the prompt, EX: create_css_code
+    :return: the max tokens of its prompts, None if it has no budget
+    """
+    global _stage_budgets
+    if _stage_budgets is None:
+        with _stage_budgets_lock:
+            if _stage_budgets is None:
+                budget_config: Dict[str, int] = State.config.get("TOKEN_BUDGETS") or {}
+                _stage_budgets = {**DEFAULT_STAGE_BUDGETS,
+                                  **{stage_name: int(budget) for stage_name, budget in budget_config.items()}}
+    return _stage_budgets.get(stage)
+
+
+def get_model_budget(models: List[str], reserved_tokens: int = 0) -> Optional[int]:
+    """
+    The most tokens a prompt can have and still fit in the context window of every one of the models
+    :param models: the models, the ones without a known context window are skipped
+    :param reserved_tokens: the tokens to leave for the completion (and anything else added to the prompt later)
+    :return: the budget, None if no model has a known context window
+    """
+    context_windows = [OPENAI_CONTEXT_WINDOWS[model] for model in models if model in OPENAI_CONTEXT_WINDOWS]
+    if not context_windows:
+        return None
+    return max(0, min(context_windows) - reserved_tokens)
+
+
+def configure_token_budgets(**stage_budgets: Optional[int]) -> Dict[str, int]:
+    """
+    Sets the budget of the stages instead of the TOKEN_BUDGETS config, EX: configure_token_budgets(create_css_code=2000)
+    None removes the budget of the stage
+    :return: stage -> budget
+    """
+    global _stage_budgets
+    with _stage_budgets_lock:
+        budgets = dict(DEFAULT_STAGE_BUDGETS if _stage_budgets is None else _stage_budgets)
+        for stage, budget in stage_budgets.items():
+            if budget is None:
+                budgets.pop(stage, None)
+            else:
+                budgets[stage] = int(budget)
+        _stage_budgets = budgets
+        return dict(budgets)
+
+
+def _deduplicate_parts(parts: Dict[str, str], part_kinds: Dict[str, str], strategies: List[str]) -> Dict[str, str]:
+    seen_paragraphs: set = set()
+    deduplicated_parts = dict(parts)
+    for name, text in parts.items():
+        if part_kinds.get(name) != TEXT:
+            continue
+        deduplicated_parts[name] = deduplicate_paragraphs(text, seen_paragraphs)
+        if count_tokens(deduplicated_parts[name]) < count_tokens(text) and "dedupe" not in strategies:
+            strategies.append("dedupe")
+    return deduplicated_parts
+
+
+def _compact_parts(parts: Dict[str, str], part_kinds: Dict[str, str], tokens_over: int,
+                   strategies: List[str]) -> Dict[str, str]:
+    """
+    Cuts every compactable part down, each one by its share of tokens_over (bigger parts lose more)
+    """
+    part_tokens = {name: count_tokens(text) for name, text in parts.items() if name in part_kinds}
+    total_part_tokens = sum(part_tokens.values())
+    if total_part_tokens == 0:
+        return parts
+    compacted_parts = dict(parts)
+    for name, tokens in part_tokens.items():
+        part_budget = max(0, tokens - math.ceil(tokens_over * tokens / total_part_tokens))
+        compacted_parts[name] = _compact_part(parts[name], part_kinds[name], part_budget, strategies)
+    return compacted_parts
+
+
+def _compact_part(text: str, kind: str, max_tokens: int, strategies: List[str]) -> str:
+    steps: List[Tuple[str, Callable[[str], str]]] = \
+        [("signatures", summarize_code)] if kind == CODE else [("whitespace", collapse_whitespace),
+                                                               ("sections", extract_sections)]
+    for strategy, compact in steps:
+        if count_tokens(text) <= max_tokens:
+            return text
+        compacted = compact(text)
+        if count_tokens(compacted) < count_tokens(text):
+            text = compacted
+            if strategy not in strategies:
+                strategies.append(strategy)
+    if count_tokens(text) > max_tokens:
+        text = truncate_to_tokens(text, max_tokens)
+        if "truncate" not in strategies:
+            strategies.append("truncate")
+    return text
+
+
+def _is_heading(line: str) -> bool:
+    stripped = line.strip()
+    return stripped.startswith("#") or (stripped.endswith(":") and len(stripped) <= 80) \
+        or (stripped.startswith("**") and stripped.endswith("**"))
+
+
+def _record(report: TokenBudgetReport) -> None:
+    registry = get_metrics_registry()
+    registry.counter("prompt_tokens_total", "Approximate tokens of the budgeted prompts sent",
+                     stage=report.stage).inc(report.final_tokens)
+    if not report.strategies:
+        return
+    registry.counter("prompt_tokens_saved_total", "Approximate tokens removed by prompt compaction",
+                     stage=report.stage).inc(report.saved_tokens)
+    for strategy in report.strategies:
+        registry.counter("prompt_compactions_total", "How many prompts each compaction strategy was used on",
+                         stage=report.stage, strategy=strategy).inc()
+    log_it(logger, error=None, custom_message=f"Compacted the {report.stage} prompt from {report.original_tokens} to "
+                                              f"{report.final_tokens} tokens (budget {report.budget}) with "
+                                              f"{report.strategies}",
+           log_level="info" if report.fits else "warning")
@@ -0,0 +1,243 @@
+"""
+Runs docker-compose projects in the background and streams their logs.
+`docker-compose up --build -d` is run detached, then `docker-compose logs -f` is followed, stdout and stderr are read
+line by line into a ring buffer (only the last max_log_lines are kept) on an event loop in a background thread,
+so nothing blocks the caller and a long running dev server never fills up memory.
+The project is ready when a line of the container logs matches ready_pattern (the output of the build isn't matched),
+or ready_url answers.
+To use:
+    handle = start_compose(project_path, ready_url="http://localhost:80")
+    if handle.wait_ready(timeout=120):
+        print(handle.tail(20))
+    handle.stop()
+"""
+import asyncio
+import concurrent.futures
+import os
+import re
+import signal
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from typing import Deque, List, Optional, Pattern, Union
+
+from global_code.helpful_functions import create_logger_error, log_it
+from global_code.metrics import get_metrics_registry
+
+logger = create_logger_error(os.path.abspath(__file__), "compose_supervisor", log_to_console=True, log_to_file=True)
+
+# What the CRA dev server, webpack and nginx print once they are serving
+DEFAULT_READY_PATTERN = r"Compiled successfully|webpack compiled|ready for start up|start worker process"
+DEFAULT_MAX_LOG_LINES = 2000
+HTTP_PROBE_INTERVAL_SECONDS = 0.5
+# Longest log line that is kept, anything longer is dropped
+MAX_LOG_LINE_BYTES = 1024 * 1024
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _get_supervisor_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop every compose project is supervised on, it runs in a daemon thread that is started on first use
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="compose_supervisor", daemon=True).start()
+        return _loop
+
+
+class ComposeHandle:
+    """
+    A running docker-compose project, returned by start_compose.
+    Every method is thread safe and can be called from any thread.
+    """
+
+    def __init__(self, project_path: str, ready_pattern: Optional[Union[str, Pattern]] = DEFAULT_READY_PATTERN,
+                 ready_url: Optional[str] = None, max_log_lines: int = DEFAULT_MAX_LOG_LINES):
+        self.project_path = project_path
+        self.ready_pattern: Optional[Pattern] = re.compile(ready_pattern) if isinstance(ready_pattern, str) \
+            else ready_pattern
+        self.ready_url = ready_url
+        self.logs: Deque[str] = deque(maxlen=max_log_lines)
+        self.return_code: Optional[int] = None
+        self.error: Optional[str] = None
+        self.ready_after_seconds: Optional[float] = None
+        self._started_at = time.monotonic()
+        self._ready = threading.Event()
+        self._done = threading.Event()
+        self._processes: List[asyncio.subprocess.Process] = []
+        self._stopping = False
+        self._loop = _get_supervisor_loop()
+        self._future: Optional[concurrent.futures.Future] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def done(self) -> bool:
+        """
+        True once the containers stopped, or compose failed
+        """
+        return self._done.is_set()
+
+    def tail(self, lines: int = 50) -> List[str]:
+        """
+        :param lines: how many of the last lines to return
+        :return: the last lines of the build output and the container logs
+        """
+        logs = list(self.logs)
+        return logs[-lines:] if lines > 0 else []
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks until the project is ready, compose stops, or the timeout runs out
+        :return: True if the project is ready
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._ready.is_set() and not self._done.is_set():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            self._ready.wait(HTTP_PROBE_INTERVAL_SECONDS if remaining is None
+                             else min(remaining, HTTP_PROBE_INTERVAL_SECONDS))
+        return self._ready.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        Blocks until the containers stop (or compose failed)
+        :return: the return code of compose, None if it is still running
+        """
+        self._done.wait(timeout)
+        return self.return_code
+
+    def stop(self, timeout: Optional[float] = 120) -> Optional[int]:
+        """
+        Runs docker-compose down and stops following the logs
+        :return: the return code of docker-compose down
+        """
+        return asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result(timeout)
+
+    def _start(self) -> "ComposeHandle":
+        self._future = asyncio.run_coroutine_threadsafe(self._supervise(), self._loop)
+        return self
+
+    async def _supervise(self) -> None:
+        try:
+            up = await self._spawn("docker-compose", "up", "--build", "-d")
+            # The build prints "Compiled successfully" too (npm run build), so only the container logs can mean ready
+            up_code = await self._follow(up, match_ready=False)
+            if up_code != 0:
+                self.return_code = up_code
+                self.error = f"docker-compose up failed with {up_code}"
+                log_it(logger, error=None, custom_message=f"{self.error} in {self.project_path}:\n"
+                                                          + "\n".join(self.tail(20)), log_level='critical')
+                return
+            if self._stopping:
+                return
+
+            follow = await self._spawn("docker-compose", "logs", "-f", "--no-color")
+            probe = asyncio.ensure_future(self._probe_http()) if self.ready_url else None
+            try:
+                self.return_code = await self._follow(follow)
+            finally:
+                if probe is not None:
+                    probe.cancel()
+        except Exception as e:
+            self.error = str(e)
+            log_it(logger, error=e, custom_message=f"Supervising docker-compose in {self.project_path} failed",
+                   log_level='critical')
+        finally:
+            self._done.set()
+
+    async def _spawn(self, *command: str) -> asyncio.subprocess.Process:
+        process = await asyncio.create_subprocess_exec(*command, cwd=self.project_path,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE,
+                                                       limit=MAX_LOG_LINE_BYTES,
+                                                       # Its own process group, so stop() can end its children too
+                                                       start_new_session=True)
+        self._processes.append(process)
+        return process
+
+    async def _follow(self, process: asyncio.subprocess.Process, match_ready: bool = True) -> int:
+        """
+        Reads stdout and stderr of the process line by line until it exits
+        :param match_ready: False to not match the lines against ready_pattern
+        :return: the return code of the process
+        """
+        await asyncio.gather(self._read_lines(process.stdout, match_ready),
+                             self._read_lines(process.stderr, match_ready))
+        return await process.wait()
+
+    async def _read_lines(self, stream: asyncio.StreamReader, match_ready: bool) -> None:
+        while True:
+            try:
+                raw_line = await stream.readline()
+            except ValueError:
+                # The line is longer than MAX_LOG_LINE_BYTES, readline already dropped it
+                continue
+            if not raw_line:
+                return
+            line = raw_line.decode("utf-8", errors="replace").rstrip("\r\n")
+            self.logs.append(line)
+            if match_ready and self.ready_pattern is not None and not self._ready.is_set() \
+                    and self.ready_pattern.search(line):
+                self._mark_ready()
+
+    async def _probe_http(self) -> None:
+        while not self._ready.is_set():
+            if await asyncio.to_thread(_http_answers, self.ready_url):
+                self._mark_ready()
+                return
+            await asyncio.sleep(HTTP_PROBE_INTERVAL_SECONDS)
+
+    def _mark_ready(self) -> None:
+        self.ready_after_seconds = time.monotonic() - self._started_at
+        self._ready.set()
+        get_metrics_registry().histogram("compose_ready_duration_seconds",
+                                         "How long docker-compose took to be ready").observe(self.ready_after_seconds)
+
+    async def _stop(self) -> Optional[int]:
+        self._stopping = True
+        down = await self._spawn("docker-compose", "down")
+        down_code = await self._follow(down, match_ready=False)
+        for process in self._processes:
+            if process.returncode is None:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        return down_code
+
+
+def _http_answers(url: str) -> bool:
+    """
+    :return: True if anything answered on the url, an error status still means the server is up
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=2):
+            return True
+    except urllib.error.HTTPError:
+        return True
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def start_compose(project_path: str, ready_pattern: Optional[Union[str, Pattern]] = DEFAULT_READY_PATTERN,
+                  ready_url: Optional[str] = None, max_log_lines: int = DEFAULT_MAX_LOG_LINES) -> ComposeHandle:
+    """
+    Starts the docker-compose project in the background, returns right away.
+    :param project_path: the folder with the docker-compose.yaml
+    :param ready_pattern: the project is ready once a log line matches it, None to only use ready_url
+    :param ready_url: the project is ready once this url answers, EX: http://localhost:80
+    :param max_log_lines: how many lines of logs to keep
+    :return: the handle of the project
+    """
+    return ComposeHandle(project_path, ready_pattern=ready_pattern, ready_url=ready_url,
+                         max_log_lines=max_log_lines)._start()
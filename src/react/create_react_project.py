@@ -1,35 +1,178 @@
+import hashlib
+import json
 import os
 import subprocess
+from typing import Optional
 
-from global_code.helpful_functions import log_it, create_logger_error
+from global_code.helpful_functions import log_it, create_logger_error, benchmark_function, CustomError
+from global_code.metrics import get_metrics_registry
+from global_code.workflow import Workflow
+from prompts.react_frontend import ReactPrompts
 from react.setup_react_project import setup_project_react
-from react.structure_create_react import create_react_ai_structure, \
-    create_react_physical_structure
-from react.run_website import run_react_website
+from react.structure_create_react import create_react_physical_structure, load_previous_structure, \
+    plan_react_structure, write_structure_artifacts
+from react.run_website import run_react_website, DOCKER_STEP_METRIC
+
+# The scaffold image has create-react-app and every library already installed, it is built once per
+# (node version, project type, ui lib, state management lib, scaffold version) and reused by every project.
+# Change SCAFFOLD_REVISION when setup_project.sh, seed_project.sh or Dockerfile.setup change to build a new image,
+# the pinned versions are in SCAFFOLD_VERSION already so changing one of them builds a new image too.
+SCAFFOLD_NODE_VERSION = "20.11.1"
+SCAFFOLD_CREATE_REACT_APP_VERSION = "5.0.1"
+# Every package setup_project.sh installs, at the exact version it installs
+SCAFFOLD_PACKAGE_VERSIONS = {
+    "create-next-app": "14.1.0",
+    "gatsby-cli": "5.13.3",
+    "react": "18.2.0",
+    "react-dom": "18.2.0",
+    "@mui/material": "5.15.10",
+    "@mui/icons-material": "5.15.10",
+    "@emotion/react": "11.11.3",
+    "@emotion/styled": "11.11.0",
+    "antd": "5.14.1",
+    "@chakra-ui/react": "2.8.2",
+    "framer-motion": "11.0.5",
+    "redux": "5.0.1",
+    "react-redux": "9.1.0",
+    "mobx": "6.12.0",
+    "mobx-react": "9.1.0",
+    "jest": "29.7.0",
+    "@testing-library/react": "14.2.1",
+    "eslint": "8.56.0",
+    "prettier": "3.2.5",
+    "@storybook/react": "7.6.17",
+    "husky": "9.0.11",
+    "dotenv": "16.4.5",
+}
+SCAFFOLD_REVISION = "3"
+SCAFFOLD_VERSION = SCAFFOLD_REVISION + "-" + hashlib.sha256(json.dumps(
+    {"node": SCAFFOLD_NODE_VERSION, "create-react-app": SCAFFOLD_CREATE_REACT_APP_VERSION,
+     "packages": SCAFFOLD_PACKAGE_VERSIONS}, sort_keys=True).encode()).hexdigest()[:8]
+SCAFFOLD_IMAGE_NAME = "create_react_scaffold"
+# Where the checkpoints of the workflow are kept, in the project folder
+WORKFLOW_FOLDER = ".workflow"
 
 
 def main_workflow_to_create_react_app(projects_folder: str, project_name: str, description_to_build: str,
-                                      host_os_project_path: str):
+                                      host_os_project_path: str, use_template_store: bool = True,
+                                      incremental: bool = False, resume: bool = True, overlap_planning: bool = True,
+                                      batch_directories: bool = True):
     """
     This function will run the main workflow to create a React project.
+    Every step is checkpointed in <project>/.workflow, running it again resumes at the first step that didn't finish.
     :param projects_folder: The folder to create the project in.
     :param project_name: The name of the project to create.
     :param description_to_build: The description of the project to build.
     :param host_os_project_path: The path to the project on the host OS. WILL BE THE HIGH LEVEL WITH ALL OTHER PROJECTS
+    :param use_template_store: clone the scaffold from the template store (react.template_store) instead of
+    running the docker setup and setup_project_react for this project
+    :param incremental: the project was made before, only make again the folders and files whose blueprint changed
+    :param resume: False to ignore the checkpoints of an earlier run and run every step again
+    :param overlap_planning: plan the structure (every LLM call up to the file list) while the project is being
+    scaffolded, so the run takes as long as the slower of the two instead of both added together.
+    False plans after the scaffold finished
+    :param batch_directories: make the files of every folder with one LLM call, only the folders it gets wrong are
+    made one by one
     :return:
     """
     # Create the project folder
     project_path = os.path.join(projects_folder, project_name)
     os.makedirs(project_path, exist_ok=True)
     run_react_website
-    create_setup_project_sh(project_path)
-    create_setup_docker(project_path)
-    run_setup_docker_for_react(project_path, project_name, host_os_project_path)
-    setup_project_react(projects_folder, project_name, host_os_project_path)
+    workflow = create_react_app_workflow(projects_folder, project_name, host_os_project_path,
+                                         overlap_planning=overlap_planning)
+    if not resume:
+        workflow.reset()
+    try:
+        workflow.run(description_to_build=description_to_build, use_template_store=use_template_store,
+                     incremental=incremental, batch_directories=batch_directories)
+    finally:
+        # metrics.prom and metrics.json, the timings of every prompt and docker step of this run
+        get_metrics_registry().write(os.path.join(project_path, '.metrics'))
+
+
+def create_react_app_workflow(projects_folder: str, project_name: str, host_os_project_path: str,
+                              overlap_planning: bool = True) -> Workflow:
+    """
+    The steps of main_workflow_to_create_react_app. Planning only needs the description, so it runs at the same time
+    as the docker scaffold, the two are joined when the structure is written to the project:
+        setup_sh, setup_dockerfile -> docker_scaffold -> setup_project
+        previous_structure, scope -> design -> structure_plan
+        setup_project, structure_plan -> structure_artifacts -> physical_structure
+    The workflow params are description_to_build, use_template_store, incremental and batch_directories.
+    :param projects_folder: The folder to create the project in.
+    :param project_name: The name of the project to create.
+    :param host_os_project_path: The path to the project on the host OS. WILL BE THE HIGH LEVEL WITH ALL OTHER PROJECTS
+    :param overlap_planning: False to start planning (scope) only once setup_project finished
+    :return: the Workflow, checkpointed in <project>/.workflow
+    """
+    # Imported here, template_store uses the setup functions of this file
+    from react.template_store import create_project_from_template
 
+    project_path = os.path.join(projects_folder, project_name)
     proj_proj_path = os.path.join(project_path, project_name)
-    structure = create_react_ai_structure(proj_proj_path, project_name, description_to_build, host_os_project_path)
-    create_react_physical_structure(proj_proj_path, structure=structure)
+
+    def setup_sh():
+        create_setup_project_sh(project_path)
+        create_seed_project_sh(project_path)
+
+    def setup_dockerfile():
+        create_setup_docker(project_path)
+
+    def docker_scaffold(setup_sh, setup_dockerfile, use_template_store: bool) -> str:
+        if use_template_store and create_project_from_template(projects_folder, project_name, host_os_project_path):
+            return "template"
+        if not run_setup_docker_for_react(project_path, project_name, host_os_project_path):
+            raise CustomError(f"The docker scaffold of {project_name} failed", error_type="docker_scaffold")
+        return "docker"
+
+    def setup_project(docker_scaffold: str):
+        # A project cloned from the template store is already set up
+        if docker_scaffold == "docker":
+            setup_project_react(projects_folder, project_name, host_os_project_path)
+
+    def scope(description_to_build: str, setup_project=None) -> str:
+        return ReactPrompts.create_scope(project_name=project_name, project_description=description_to_build)
+
+    def design(scope: str, description_to_build: str) -> str:
+        return ReactPrompts.designer(project_name=project_name, project_description=description_to_build,
+                                     design_blueprint=scope)
+
+    def previous_structure(incremental: bool, description_to_build: str):
+        # Checkpointed before structure_artifacts writes the new structure, description_to_build is only an input
+        # so a new description reads it again
+        return load_previous_structure(proj_proj_path) if incremental else None
+
+    def structure_plan(previous_structure, scope: str, design: str, description_to_build: str,
+                       batch_directories: bool):
+        return plan_react_structure(proj_proj_path, project_name, description_to_build,
+                                    previous_structure=previous_structure, scope_blueprint=scope,
+                                    design_blueprint=design, batch_directories=batch_directories)
+
+    def structure_artifacts(structure_plan, setup_project, description_to_build: str):
+        write_structure_artifacts(proj_proj_path, structure_plan, description_to_build)
+        return structure_plan["structure"]
+
+    def physical_structure(structure_artifacts, previous_structure):
+        return create_react_physical_structure(proj_proj_path, structure=structure_artifacts,
+                                               previous_structure=previous_structure)
+
+    return (Workflow("create_react_app", os.path.join(project_path, WORKFLOW_FOLDER))
+            .add_step("setup_sh", setup_sh)
+            .add_step("setup_dockerfile", setup_dockerfile)
+            .add_step("docker_scaffold", docker_scaffold, depends_on=["setup_sh", "setup_dockerfile"],
+                      inputs=["use_template_store"])
+            .add_step("setup_project", setup_project, depends_on=["docker_scaffold"])
+            .add_step("previous_structure", previous_structure, inputs=["incremental", "description_to_build"])
+            .add_step("scope", scope, depends_on=[] if overlap_planning else ["setup_project"],
+                      inputs=["description_to_build"])
+            .add_step("design", design, depends_on=["scope"], inputs=["description_to_build"])
+            .add_step("structure_plan", structure_plan, depends_on=["previous_structure", "scope", "design"],
+                      inputs=["description_to_build", "batch_directories"])
+            .add_step("structure_artifacts", structure_artifacts, depends_on=["structure_plan", "setup_project"],
+                      inputs=["description_to_build"])
+            .add_step("physical_structure", physical_structure,
+                      depends_on=["structure_artifacts", "previous_structure"]))
 
 
 def create_setup_project_sh(project_path: str):
@@ -38,16 +181,16 @@ def create_setup_project_sh(project_path: str):
     :param project_path: The path to the project.
     :return:
     """
-    content = '''
+    content = f'''
 #!/bin/bash
 
 # Create the project based on the project type
 if [ "$PROJECT_TYPE" = "cra" ]; then
-    npx create-react-app $PROJECT_NAME
+    npx --yes create-react-app@${{CREATE_REACT_APP_VERSION:-{SCAFFOLD_CREATE_REACT_APP_VERSION}}} $PROJECT_NAME
 elif [ "$PROJECT_TYPE" = "next" ]; then
-    npx create-next-app $PROJECT_NAME
+    npx --yes {_pinned("create-next-app")} $PROJECT_NAME
 elif [ "$PROJECT_TYPE" = "gatsby" ]; then
-    npx gatsby new $PROJECT_NAME
+    npx --yes {_pinned("gatsby-cli")} new $PROJECT_NAME
 else
     echo "Invalid project type. Please choose 'cra', 'next', or 'gatsby'."
     exit 1
@@ -57,13 +200,18 @@ fi
 # Navigate to the project directory
 cd $PROJECT_NAME
 
+# Pin React, create-react-app installs the latest one
+if [ "$PROJECT_TYPE" = "cra" ]; then
+    npm install --save-exact {_pinned("react", "react-dom")}
+fi
+
 # Add the UI library
 if [ "$UI_LIB" == "material-ui" ]; then
-    npm install @mui/material @mui/icons-material @emotion/react @emotion/styled
+    npm install --save-exact {_pinned("@mui/material", "@mui/icons-material", "@emotion/react", "@emotion/styled")}
 elif [ "$UI_LIB" == "ant-design" ]; then
-    npm install antd
+    npm install --save-exact {_pinned("antd")}
 elif [ "$UI_LIB" == "chakra-ui" ]; then
-    npm install @chakra-ui/react @emotion/react @emotion/styled framer-motion
+    npm install --save-exact {_pinned("@chakra-ui/react", "@emotion/react", "@emotion/styled", "framer-motion")}
 else
     echo "Invalid UI library. Please choose 'material-ui', 'ant-design', or 'chakra-ui'."
     exit 1
@@ -71,18 +219,18 @@ fi
 
 # Add the state management library
 if [ "$STATE_MANAGEMENT_LIB" == "redux" ]; then
-    npm install redux react-redux
+    npm install --save-exact {_pinned("redux", "react-redux")}
 elif [ "$STATE_MANAGEMENT_LIB" == "mobx" ]; then
-    npm install mobx mobx-react
+    npm install --save-exact {_pinned("mobx", "mobx-react")}
 fi
 
 # Add testing tools
-npm install --save-dev jest @testing-library/react
+npm install --save-dev --save-exact {_pinned("jest", "@testing-library/react")}
 
 # Add development tools
-npm install --save-dev eslint prettier @storybook/react husky dotenv
+npm install --save-dev --save-exact {_pinned("eslint", "prettier", "@storybook/react", "husky", "dotenv")}
 
-chmod -R 755 $PROJECT_NAME
+chmod -R 755 .
 
 echo "Project $PROJECT_NAME created successfully."
 
@@ -92,39 +240,141 @@ echo "Project $PROJECT_NAME created successfully."
         setup_project_sh.write(content)
 
 
+def _pinned(*packages: str) -> str:
+    """
+    :return: the packages with their version of SCAFFOLD_PACKAGE_VERSIONS, EX: antd@5.14.1
+    """
+    return " ".join(f"{package}@{SCAFFOLD_PACKAGE_VERSIONS[package]}" for package in packages)
+
+
+def create_seed_project_sh(project_path: str):
+    """
+    Create a seed_project.sh file, the command of the scaffold image.
+    It copies the template that was made when the image was built into /app/$PROJECT_NAME,
+    so a new project never runs create-react-app or npm install.
+    :param project_path: The path to the project.
+    :return:
+    """
+    content = '''#!/bin/bash
+set -e
+
+if [ -e "/app/$PROJECT_NAME/package.json" ]; then
+    echo "Project $PROJECT_NAME already exists."
+    exit 0
+fi
+
+# Clone the template, node_modules included, out of the image. Hardlinks can't reach from the image into the
+# mounted projects folder, a reflink can when both are on the same copy on write filesystem (btrfs, xfs),
+# anything else is copied
+mkdir -p "/app/$PROJECT_NAME"
+cp -r --reflink=auto --preserve=mode,timestamps,links /opt/scaffold/template/. "/app/$PROJECT_NAME/"
+
+cd "/app/$PROJECT_NAME"
+npm pkg set name="$PROJECT_NAME"
+
+echo "Project $PROJECT_NAME created successfully."
+'''
+    seed = os.path.join(project_path, 'seed_project.sh')
+    with open(seed, 'w') as seed_project_sh:
+        seed_project_sh.write(content)
+
+
 def create_setup_docker(project_path: str):
     """
-    Create a setup_docker.sh file.
+    Create the Dockerfile.setup file of the scaffold image.
+    The template project is made while the image is built (with the npm cache mounted, so rebuilds don't download
+    everything again), the container only has to copy it.
     :return:
     """
-    content = '''
-# Use an official Node.js runtime as a parent image
-FROM node:latest
+    content = '''# syntax=docker/dockerfile:1
+# Use a pinned Node.js runtime so every scaffold is the same
+ARG NODE_VERSION=20.11.1
+FROM node:${NODE_VERSION}
 
-# Set the working directory in the container
-WORKDIR /app
+ARG PROJECT_TYPE=cra
+ARG UI_LIB=material-ui
+ARG STATE_MANAGEMENT_LIB=redux
+ARG CREATE_REACT_APP_VERSION=5.0.1
 
-# Copy a script into the container to set up the project
-COPY setup_project.sh /app/
+# Build the template project with every library installed
+WORKDIR /opt/scaffold
+COPY setup_project.sh seed_project.sh /opt/scaffold/
+RUN chmod +x /opt/scaffold/setup_project.sh /opt/scaffold/seed_project.sh
+RUN --mount=type=cache,target=/root/.npm \\
+    PROJECT_NAME=template /bin/bash /opt/scaffold/setup_project.sh
 
-# Make the script executable
-RUN chmod +x /app/setup_project.sh
+WORKDIR /app
 
-# Run the script to set up the project based on environment variables
-CMD ["/bin/bash", "/app/setup_project.sh"]
+# Copy the template into the mounted projects folder as $PROJECT_NAME
+CMD ["/bin/bash", "/opt/scaffold/seed_project.sh"]
 '''
     setup = os.path.join(project_path, 'Dockerfile.setup')
     with open(setup, 'w') as setup_docker_sh:
         setup_docker_sh.write(content)
 
 
-def run_setup_docker_for_react(project_path: str, project_name: str, host_os_project_path: str):
+def get_scaffold_image_tag(project_type: str = "cra", ui_lib: str = "material-ui",
+                           state_management_lib: str = "redux") -> str:
+    """
+    :return: the tag of the scaffold image for these settings
+    """
+    return (f"{SCAFFOLD_IMAGE_NAME}:node{SCAFFOLD_NODE_VERSION}-{project_type}-{ui_lib}-{state_management_lib}"
+            f"-v{SCAFFOLD_VERSION}")
+
+
+def ensure_scaffold_image(project_path: str, project_type: str = "cra", ui_lib: str = "material-ui",
+                          state_management_lib: str = "redux") -> Optional[str]:
     """
-    Run the Dockerfile.setup file to set up the project.
+    Builds the scaffold image if it isn't already built.
+    :param project_path: The path to the project, it has Dockerfile.setup, setup_project.sh and seed_project.sh in it.
+    :return: the tag of the image, None if it couldn't be built
+    """
+    logger = create_logger_error(os.path.abspath(__file__), 'run_project', log_to_console=True,
+                                 log_to_file=True)
+    image_tag = get_scaffold_image_tag(project_type, ui_lib, state_management_lib)
+
+    inspect_command = ["docker", "image", "inspect", image_tag]
+    if subprocess.run(inspect_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+        log_it(logger, error=None, custom_message=f"Reusing the scaffold image {image_tag}", log_level='info')
+        return image_tag
+
+    build_command = ["docker", "build", "-f", "Dockerfile.setup", "-t", image_tag,
+                     "--build-arg", f"NODE_VERSION={SCAFFOLD_NODE_VERSION}",
+                     "--build-arg", f"PROJECT_TYPE={project_type}",
+                     "--build-arg", f"UI_LIB={ui_lib}",
+                     "--build-arg", f"STATE_MANAGEMENT_LIB={state_management_lib}",
+                     "--build-arg", f"CREATE_REACT_APP_VERSION={SCAFFOLD_CREATE_REACT_APP_VERSION}",
+                     "."]
+    try:
+        log_it(logger, error=None, custom_message=f"Building the scaffold image {image_tag}, this only happens once...",
+               log_level='info')
+        with get_metrics_registry().time(DOCKER_STEP_METRIC, step='scaffold_build'):
+            # BuildKit is needed for the npm cache mount
+            subprocess.run(build_command, check=True, cwd=project_path, env={**os.environ, "DOCKER_BUILDKIT": "1"})
+    except subprocess.CalledProcessError:
+        log_it(logger, error=None, custom_message="Failed to build the scaffold image. Please check your Dockerfile.",
+               log_level='critical')
+        return None
+    except Exception as e:
+        log_it(logger, error=e, custom_message="An unexpected error occurred during the build process",
+               log_level='critical')
+        return None
+    return image_tag
+
+
+@benchmark_function()
+def run_setup_docker_for_react(project_path: str, project_name: str, host_os_project_path: str,
+                               project_type: str = "cra", ui_lib: str = "material-ui",
+                               state_management_lib: str = "redux") -> bool:
+    """
+    Sets up the project from the scaffold image, the image is only built the first time.
     :param project_path: The path to the project.
     :param project_name: The name of the project.
     :param host_os_project_path: The path to the project on the host OS. WILL BE THE HIGH LEVEL WITH ALL OTHER PROJECTS
-    :return:
+    :param project_type: cra, next or gatsby
+    :param ui_lib: material-ui, ant-design or chakra-ui
+    :param state_management_lib: redux or mobx
+    :return: True if the project was set up
     """
     logger = create_logger_error(os.path.abspath(__file__), 'run_project', log_to_console=True,
                                  log_to_file=True)
@@ -135,45 +385,40 @@ def run_setup_docker_for_react(project_path: str, project_name: str, host_os_pro
     except subprocess.CalledProcessError:
         what_to_log = "Docker is not installed or not found in PATH. Please ensure Docker is properly installed."
         log_it(logger, error=None, custom_message=what_to_log, log_level='critical')
-        return
+        return False
     except Exception as e:
         what_to_log = "An unexpected error occurred while verifying Docker installation"
         log_it(logger, error=e, custom_message=what_to_log, log_level='critical')
-        return
+        return False
 
-    # Step 1: Build the Docker container
-    build_command = ["docker", "build", "-f", "Dockerfile.setup", "-t", f"{project_name}_setup", "."]
-    try:
-        log_it(logger, error=None, custom_message="Building Docker container for the Python project...",
-               log_level='info')
-        subprocess.run(build_command, check=True, cwd=project_path)
-    except subprocess.CalledProcessError:
-        log_it(logger, error=None, custom_message="Failed to build the Docker container. Please check your Dockerfile.",
-               log_level='critical')
-        return
-    except Exception as e:
-        log_it(logger, error=e, custom_message="An unexpected error occurred during the build process",
-               log_level='critical')
-        return
+    # Step 1: Get the scaffold image, it is only built if it doesn't exist yet
+    image_tag = ensure_scaffold_image(project_path, project_type, ui_lib, state_management_lib)
+    if image_tag is None:
+        return False
 
-    # Step 2: Run the Docker container
+    # Step 2: Run the Docker container, it copies the template into the project folder
     host_os_proj_path = os.path.join(host_os_project_path, project_name)
-    # docker run -v "$(pwd)":/app -e PROJECT_TYPE=cra -e PROJECT_NAME=my-react-app -e UI_LIB=material-ui -e STATE_MANAGEMENT_LIB=redux react-project-setup
-    run_command = ["docker", "run", "-u", "1000:1000", "-v", f'{host_os_proj_path}:/app', "-e", "PROJECT_TYPE=cra", "-e", f"PROJECT_NAME={project_name}",
-                   "-e", "UI_LIB=material-ui", "-e", "STATE_MANAGEMENT_LIB=redux", f"{project_name}_setup"]
+    # docker run -v "$(pwd)":/app -e PROJECT_NAME=my-react-app create_react_scaffold:<tag>
+    # The container only clones the template, it never runs npm, so no npm cache is mounted
+    run_command = ["docker", "run", "--rm", "-u", "1000:1000", "-v", f'{host_os_proj_path}:/app',
+                   "-e", f"PROJECT_TYPE={project_type}",
+                   "-e", f"PROJECT_NAME={project_name}", "-e", f"UI_LIB={ui_lib}",
+                   "-e", f"STATE_MANAGEMENT_LIB={state_management_lib}", image_tag]
     try:
         log_it(logger, error=None, custom_message="Running the React Setup",
                log_level='info')
-        subprocess.run(run_command, check=True, cwd=project_path)
+        with get_metrics_registry().time(DOCKER_STEP_METRIC, step='setup_run'):
+            subprocess.run(run_command, check=True, cwd=project_path)
     except subprocess.CalledProcessError:
         log_it(logger, error=None,
                custom_message="Failed to run the Docker container. Please check if the container's entry "
                               "point is correctly set up.",
                log_level='critical')
-        return
+        return False
     except Exception as e:
         log_it(logger, error=e, custom_message="An unexpected error occurred while running the container",
                log_level='critical')
-        return
+        return False
     log_it(logger, error=None, custom_message="Python project ran successfully in a Docker container.",
            log_level='info')
+    return True
@@ -1,66 +1,168 @@
 import os
-from global_code.helpful_functions import CustomError
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from global_code.helpful_functions import CustomError, atomic_write_text
+
+# section -> (start marker, end marker), a marker is a whole line of the file
+SECTION_MARKERS: Dict[str, Tuple[str, str]] = {
+    'import': ('// IMPORTS\n', '// END IMPORTS\n'),
+    'code': ('// CODE\n', '// END CODE\n'),
+    'function': ('// FUNCTION CODE\n', '// END FUNCTION CODE\n'),
+}
+# read_js_file calls the import section imports
+SECTION_ALIASES: Dict[str, str] = {'imports': 'import'}
+_ALL_MARKERS = {marker for markers in SECTION_MARKERS.values() for marker in markers}
+
+
+class JsDocument:
+    """
+    A JS file made by create_base_js_file, held in memory.
+    The file is read and its section markers are found once, the line of every marker is kept up to date as the
+    sections are edited, so an edit never scans the file again. Any number of edits are written with one flush,
+    which replaces the file atomically (temporary file + rename).
+    EX:
+        document = JsDocument.load(file_path)
+        document.edit('import', False, "import React from 'react';")
+        document.edit('code', True, component_code)
+        document.flush()
+    """
+
+    def __init__(self, file_path: str, text: str):
+        self.file_path = file_path
+        self.lines: List[str] = text.splitlines(keepends=True)
+        self.dirty = False
+        # (st_mtime_ns, st_size) of the file when it was read or flushed, None if it was never on disk
+        self.stamp: Optional[Tuple[int, int]] = None
+        self._marker_lines: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._index_markers()
+
+    @classmethod
+    def load(cls, file_path: str) -> "JsDocument":
+        with open(file_path, 'r') as file:
+            document = cls(file_path, file.read())
+        document.stamp = _file_stamp(file_path)
+        return document
+
+    def read(self, section: str) -> str:
+        """
+        :param section: 'import' (or 'imports'), 'code', 'function' or 'all'
+        :return: the lines of the section, without the markers
+        """
+        with self._lock:
+            if section == 'all':
+                return ''.join(self.lines)
+            start, end = self._section_lines(section)
+            return ''.join(self.lines[start + 1:end])
+
+    def edit(self, section: str, rewrite_or_append: bool, new_string: str) -> None:
+        """
+        Changes the section in memory, flush writes it to the file
+        :param section: 'import', 'code' or 'function'
+        :param rewrite_or_append: True to replace the whole section, False to add to the end of it
+        :param new_string: The change to make.
+        """
+        with self._lock:
+            start, end = self._section_lines(section)
+            new_line = new_string + '\n'
+            if rewrite_or_append:
+                removed = self.lines[start + 1:end]
+                self.lines[start + 1:end] = [new_line]
+                shift = 1 - len(removed)
+                markers_moved = any(line in _ALL_MARKERS for line in removed)
+            else:
+                self.lines.insert(end, new_line)
+                shift = 1
+                markers_moved = False
+            if markers_moved or any(marker.rstrip('\n') in new_string for marker in _ALL_MARKERS):
+                # The edit removed or added markers, the only case where the file is scanned again
+                self._index_markers()
+            else:
+                for marker, line_number in self._marker_lines.items():
+                    if line_number >= end:
+                        self._marker_lines[marker] = line_number + shift
+            self.dirty = True
+
+    def edit_many(self, edits: List[Tuple[str, bool, str]]) -> None:
+        """
+        :param edits: (section, rewrite_or_append, new_string) for every edit, in order
+        """
+        with self._lock:
+            for section, rewrite_or_append, new_string in edits:
+                self.edit(section, rewrite_or_append, new_string)
+
+    def flush(self) -> bool:
+        """
+        Writes the document to its file if it was edited, atomically
+        :return: True if the file was written
+        """
+        with self._lock:
+            if not self.dirty:
+                return False
+            atomic_write_text(self.file_path, ''.join(self.lines))
+            self.dirty = False
+            self.stamp = _file_stamp(self.file_path)
+            return True
+
+    def _section_lines(self, section: str) -> Tuple[int, int]:
+        section = SECTION_ALIASES.get(section, section)
+        if section not in SECTION_MARKERS:
+            raise CustomError(f"Incorrect section {section}", error_type="js_section")
+        start_marker, end_marker = SECTION_MARKERS[section]
+        start, end = self._marker_lines.get(start_marker), self._marker_lines.get(end_marker)
+        if start is None or end is None or end <= start:
+            raise CustomError(f"{self.file_path} has no {section} section", error_type="js_section")
+        return start, end
+
+    def _index_markers(self) -> None:
+        # The last marker of each kind wins, the same as the old line by line scan
+        self._marker_lines = {line: line_number for line_number, line in enumerate(self.lines)
+                              if line in _ALL_MARKERS}
+
+
+_document_cache: Dict[str, JsDocument] = {}
+_document_cache_lock = threading.Lock()
+
+
+def load_js_document(file_path: str) -> JsDocument:
+    """
+    The cached JsDocument of the file, it is only read again if the file changed on disk (mtime or size)
+    :param file_path: The path to the JS file.
+    :return: the JsDocument, flush it after editing it so the cache matches the file
+    """
+    file_path = os.path.abspath(file_path)
+    stamp = _file_stamp(file_path)
+    with _document_cache_lock:
+        document = _document_cache.get(file_path)
+        if document is not None and (document.dirty or document.stamp == stamp):
+            return document
+    document = JsDocument.load(file_path)
+    with _document_cache_lock:
+        _document_cache[file_path] = document
+    return document
+
+
+def _file_stamp(file_path: str) -> Optional[Tuple[int, int]]:
+    try:
+        file_stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size
 
 
 def change_js_file(file_path: str, type_of_change: str, rewrite_or_append: bool, new_string: str):
     """
     Modify a JS file to either change the imports section or the code section.
+    To make several changes to the same file, edit load_js_document(file_path) and flush it once.
     :param file_path: The path to the JS file.
     :param type_of_change: Either 'import' or 'code', or 'function'
     :param rewrite_or_append: Either True for rewrite or False for append.
     :param new_string: The change to make.
     """
-    # Read the original file content
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-    # Define markers for import and code sections
-    import_start_marker = '// IMPORTS\n'
-    import_end_marker = '// END IMPORTS\n'
-    code_start_marker = '// CODE\n'
-    code_end_marker = '// END CODE\n'
-    function_start_marker = '// FUNCTION CODE\n'
-    function_end_marker = '// END FUNCTION CODE\n'
-    # Initialize variables to track the positions of the sections
-    import_start_pos, import_end_pos, code_start_pos, code_end_pos, function_start_pos, function_end_pos = 0, 0, 0, 0, 0, 0
-
-    # Find the positions of the import and code sections
-    for i, line in enumerate(lines):
-        if line == import_start_marker:
-            import_start_pos = i
-        elif line == import_end_marker:
-            import_end_pos = i
-        elif line == code_start_marker:
-            code_start_pos = i
-        elif line == code_end_marker:
-            code_end_pos = i
-        elif line == function_start_marker:
-            function_start_pos = i
-        elif line == function_end_marker:
-            function_end_pos = i
-
-    # Perform the required operation based on type_of_change and rewrite_or_append
-    if type_of_change == 'import':
-        if rewrite_or_append:  # Rewrite the entire import section
-            lines = lines[:import_start_pos + 1] + [new_string + '\n'] + lines[import_end_pos:]
-        else:  # Append to the import section
-            lines.insert(import_end_pos, new_string + '\n')
-    elif type_of_change == 'code':
-        if rewrite_or_append:  # Rewrite the entire code section
-            lines = lines[:code_start_pos + 1] + [new_string + '\n'] + lines[code_end_pos:]
-        else:  # Append to the code section
-            lines.insert(code_end_pos, new_string + '\n')
-    elif type_of_change == 'function':
-        if rewrite_or_append:  # Rewrite the entire code section
-            lines = lines[:function_start_pos + 1] + [new_string + '\n'] + lines[function_end_pos:]
-        else:  # Append to the code section
-            lines.insert(function_end_pos, new_string + '\n')
-    # Write the modified content back to the file
-    with open(file_path, 'w') as file:
-        file.writelines(lines)
-
-# Commenting out function calls to adhere to instructions
-# change_python_file('example.py', 'import', False, 'import numpy as np')
+    document = load_js_document(file_path)
+    document.edit(type_of_change, rewrite_or_append, new_string)
+    document.flush()
 
 
 def read_js_file(file_path: str, what_to_read: str) -> str:
@@ -70,45 +172,20 @@ def read_js_file(file_path: str, what_to_read: str) -> str:
     :param what_to_read: Either 'code', 'imports', 'all'
     :return: The specified section of the file as a string.
     """
-    # Read the entire file content
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-    # Define markers for import and code sections
-    import_start_marker = '// IMPORTS\n'
-    import_end_marker = '// END IMPORTS\n'
-    code_start_marker = '// CODE\n'
-    code_end_marker = '// END CODE\n'
-
-    # Initialize variables to track the positions of the sections
-    import_start_pos, import_end_pos, code_start_pos, code_end_pos = 0, 0, 0, 0
-
-    # Find the positions of the import and code sections
-    for i, line in enumerate(lines):
-        if line == import_start_marker:
-            import_start_pos = i
-        elif line == import_end_marker:
-            import_end_pos = i
-        elif line == code_start_marker:
-            code_start_pos = i
-        elif line == code_end_marker:
-            code_end_pos = i
-
-    # Extract the specified section based on what_to_read
-    if what_to_read == 'imports':
-        section_lines = lines[import_start_pos + 1:import_end_pos]
-    elif what_to_read == 'code':
-        section_lines = lines[code_start_pos + 1:code_end_pos]
-    elif what_to_read == 'all':
-        section_lines = lines
-    else:
+    if what_to_read not in ('code', 'imports', 'all'):
         raise CustomError("Incorrect value for what_to_read")
-
-    # Convert the list of lines back into a single string
-    return ''.join(section_lines)
+    return load_js_document(file_path).read(what_to_read)
 
 
 def create_base_js_file(file_path: str, description: str = '', code: str = '', imports: str = ''):
+    with open(file_path, 'w') as file:
+        file.write(create_base_js_text(description=description, code=code, imports=imports))
+
+
+def create_base_js_text(description: str = '', code: str = '', imports: str = '') -> str:
+    """
+    :return: the content create_base_js_file writes, for writing it some other way (EX: a WorkspaceWriter)
+    """
     base_file = f'''
 ////////////////////////////////////////////////////////////////////////////////////////
 // Telomere
@@ -135,5 +212,4 @@ def create_base_js_file(file_path: str, description: str = '', code: str = '', i
 // Telomere
 ////////////////////////////////////////////////////////////////////////////////////////
 '''
-    with open(file_path, 'w') as file:
-        file.write(base_file)
+    return base_file
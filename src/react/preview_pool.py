@@ -0,0 +1,329 @@
+"""
+Pool of warm preview containers.
+Every container is a plain node image with the whole projects folder mounted at /projects, so it can serve any
+project without being rebuilt or restarted, a preview only starts the dev server of the project inside it
+(hot swap). Each container has its own port, so previews of different projects never collide.
+Containers nobody used for idle_timeout_seconds are removed, and started again when they are needed.
+To use:
+    slot = get_preview_pool().preview(project_path)
+    print(slot.url)
+    get_preview_pool().release(slot)
+"""
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from global_code.helpful_functions import create_logger_error, log_it, CustomError
+from global_code.metrics import get_metrics_registry
+from global_code.singleton import State
+from react.create_react_project import SCAFFOLD_NODE_VERSION
+
+logger = create_logger_error(os.path.abspath(__file__), "preview_pool", log_to_console=True, log_to_file=True)
+
+PREVIEW_CONTAINER_PREFIX = "create_react_preview"
+PREVIEW_CONTAINER_PORT = 3000
+# Where the projects folder is mounted in the preview containers
+PREVIEW_PROJECTS_MOUNT = "/projects"
+READY_PROBE_INTERVAL_SECONDS = 0.2
+# How long the old dev server has to stop (and free the port) before it is killed with SIGKILL, and again before
+# the swap fails
+STOP_TIMEOUT_SECONDS = 10
+# Run in the container with: the project folder, the port, how many probes to wait, the seconds between probes.
+# The dev server runs in its own session so all of its processes are stopped together
+SWAP_SCRIPT = """
+if [ -f /tmp/preview.pid ]; then
+    pgid="$(cat /tmp/preview.pid)"
+    kill -TERM -"$pgid" 2>/dev/null
+    probes=0
+    while kill -0 -"$pgid" 2>/dev/null || curl -s -o /dev/null "http://localhost:$2"; do
+        probes=$((probes + 1))
+        if [ "$probes" -eq "$3" ]; then
+            kill -KILL -"$pgid" 2>/dev/null
+        elif [ "$probes" -ge $(($3 * 2)) ]; then
+            echo "The old dev server didn't stop, port $2 is still in use" >&2
+            exit 1
+        fi
+        sleep "$4"
+    done
+    rm -f /tmp/preview.pid
+fi
+cd "$1" && setsid sh -c 'echo $$ > /tmp/preview.pid; exec npm start' > /tmp/preview.log 2>&1 &
+"""
+
+
+class PreviewSlot:
+    """
+    One warm container of the pool
+    """
+
+    def __init__(self, index: int, container_name: str, port: int, host: str):
+        self.index = index
+        self.container_name = container_name
+        self.port = port
+        self.host = host
+        # The project folder (relative to the projects folder) the dev server is serving
+        self.project: Optional[str] = None
+        self.leases = 0
+        self.running = False
+        self.last_used = time.monotonic()
+        # Held while the dev server is being swapped, other previews of the same project wait on it
+        self.swap_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+
+class PreviewPool:
+    """
+    Keeps size warm node containers and hands them out to previews.
+    """
+
+    def __init__(self, projects_folder: str, host_os_project_path: str, size: int = 2,
+                 idle_timeout_seconds: float = 900, base_port: int = 3100,
+                 node_image: str = f"node:{SCAFFOLD_NODE_VERSION}", host: str = "localhost",
+                 ready_timeout_seconds: float = 120):
+        """
+        :param projects_folder: The folder with all the projects, as this process sees it
+        :param host_os_project_path: The same folder on the host OS, it is what the containers mount
+        :param size: how many containers to keep
+        :param idle_timeout_seconds: containers not used for this long are removed
+        :param base_port: the first host port, container i is served on base_port + i
+        :param node_image: the image of the containers
+        :param host: the host the previews are served on
+        :param ready_timeout_seconds: how long a dev server has to start
+        """
+        self.projects_folder = projects_folder
+        self.host_os_project_path = host_os_project_path
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.node_image = node_image
+        self.ready_timeout_seconds = ready_timeout_seconds
+        self.slots: List[PreviewSlot] = [PreviewSlot(index, f"{PREVIEW_CONTAINER_PREFIX}_{index}", base_port + index,
+                                                     host)
+                                         for index in range(size)]
+        self._condition = threading.Condition()
+        self._reaper: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+        self._warm_gauge = get_metrics_registry().gauge("preview_containers_warm",
+                                                        "How many preview containers are running")
+
+    def warm(self) -> None:
+        """
+        Starts every container of the pool, so the first previews don't wait for them
+        """
+        self._start_reaper()
+        with ThreadPoolExecutor(max_workers=len(self.slots)) as executor:
+            list(executor.map(self._ensure_container, self.slots))
+
+    def preview(self, project_path: str, wait_ready: bool = True) -> PreviewSlot:
+        """
+        Serves the project from a warm container, a project that is already being served keeps its container.
+        CAN RAISE AN ERROR: CustomError if the container or the dev server couldn't be started
+        :param project_path: the path of the project (the folder with package.json), inside projects_folder
+        :param wait_ready: wait until the dev server answers
+        :return: the slot serving the project, give it back with release
+        """
+        self._start_reaper()
+        project = os.path.relpath(os.path.abspath(project_path), os.path.abspath(self.projects_folder))
+        if project.startswith(".."):
+            raise CustomError(f"{project_path} is not in {self.projects_folder}", error_type="preview_outside_root")
+
+        start_time = time.perf_counter_ns()
+        slot, needs_swap = self._acquire(project)
+        try:
+            with slot.swap_lock:
+                if needs_swap:
+                    self._ensure_container(slot)
+                    self._swap(slot, project)
+                if wait_ready:
+                    self._wait_ready(slot)
+        except BaseException:
+            with self._condition:
+                slot.project = None
+            self.release(slot)
+            raise
+        get_metrics_registry().histogram("preview_ready_duration_seconds", "How long a preview took to be ready",
+                                         swapped=str(needs_swap)).observe_ns(time.perf_counter_ns() - start_time)
+        log_it(logger, error=None, custom_message=f"Previewing {project} on {slot.url}", log_level='info')
+        return slot
+
+    def release(self, slot: PreviewSlot) -> None:
+        """
+        Gives the slot back, the dev server keeps running so previewing the same project again is instant
+        """
+        with self._condition:
+            slot.leases = max(0, slot.leases - 1)
+            slot.last_used = time.monotonic()
+            self._condition.notify_all()
+
+    def recycle_idle(self) -> int:
+        """
+        Removes the containers nobody used for idle_timeout_seconds
+        :return: how many containers were removed
+        """
+        now = time.monotonic()
+        with self._condition:
+            idle_slots = [slot for slot in self.slots if slot.running and slot.leases == 0
+                          and now - slot.last_used > self.idle_timeout_seconds]
+            for slot in idle_slots:
+                # Leased so nobody gets it while it is being removed, and without a project so a preview of its
+                # project doesn't wait on a dev server that is going away
+                slot.leases += 1
+                slot.project = None
+        for slot in idle_slots:
+            self._remove_container(slot)
+            self.release(slot)
+        return len(idle_slots)
+
+    def shutdown(self) -> None:
+        """
+        Removes every container of the pool
+        """
+        self._closed.set()
+        for slot in self.slots:
+            self._remove_container(slot)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._condition:
+            return [{"container": slot.container_name, "url": slot.url, "project": slot.project,
+                     "leases": slot.leases, "running": slot.running,
+                     "idle_seconds": time.monotonic() - slot.last_used} for slot in self.slots]
+
+    def _acquire(self, project: str) -> Tuple[PreviewSlot, bool]:
+        """
+        :return: the slot, and if the project has to be swapped in
+        """
+        with self._condition:
+            while True:
+                for slot in self.slots:
+                    # A slot still being swapped to the project counts, preview waits on its swap_lock
+                    if slot.project == project:
+                        slot.leases += 1
+                        return slot, False
+                free_slots = [slot for slot in self.slots if slot.leases == 0]
+                if free_slots:
+                    # Warm and empty first, then the least recently used warm one, then a cold one
+                    slot = min(free_slots, key=lambda free: (not free.running, free.project is not None,
+                                                             free.last_used))
+                    slot.leases += 1
+                    slot.project = project
+                    return slot, True
+                self._condition.wait()
+
+    def _ensure_container(self, slot: PreviewSlot) -> None:
+        if slot.running:
+            return
+        # Removes a container left over from an earlier run
+        _docker("rm", "-f", slot.container_name, check=False)
+        try:
+            # --init reaps the stopped dev servers, sleep can't, and the swap waits until they are gone
+            _docker("run", "-d", "--init", "--name", slot.container_name, "-u", "1000:1000",
+                    "-p", f"{slot.port}:{PREVIEW_CONTAINER_PORT}",
+                    "-v", f"{self.host_os_project_path}:{PREVIEW_PROJECTS_MOUNT}",
+                    "-e", "BROWSER=none", "-e", f"PORT={PREVIEW_CONTAINER_PORT}", "-e", "HOST=0.0.0.0",
+                    "-e", "CHOKIDAR_USEPOLLING=true",
+                    self.node_image, "sleep", "infinity")
+        except subprocess.CalledProcessError as e:
+            raise CustomError(f"Couldn't start the preview container {slot.container_name}: {e.stderr}",
+                              error_type="preview_container")
+        with self._condition:
+            slot.running = True
+        self._warm_gauge.inc()
+
+    def _swap(self, slot: PreviewSlot, project: str) -> None:
+        """
+        Stops the dev server in the container and starts the one of the project.
+        The new one is only started once the old one is gone and the port is free, otherwise the readiness probe
+        could be answered by the old project
+        """
+        project_in_container = f"{PREVIEW_PROJECTS_MOUNT}/{project}"
+        try:
+            _docker("exec", slot.container_name, "sh", "-c", SWAP_SCRIPT, "preview", project_in_container,
+                    str(PREVIEW_CONTAINER_PORT), str(int(STOP_TIMEOUT_SECONDS / READY_PROBE_INTERVAL_SECONDS)),
+                    str(READY_PROBE_INTERVAL_SECONDS))
+        except subprocess.CalledProcessError as e:
+            raise CustomError(f"Couldn't start the dev server of {project}: {e.stderr}", error_type="preview_swap")
+
+    def _wait_ready(self, slot: PreviewSlot) -> None:
+        deadline = time.monotonic() + self.ready_timeout_seconds
+        while time.monotonic() < deadline:
+            probe = _docker("exec", slot.container_name, "curl", "-s", "-o", "/dev/null",
+                            f"http://localhost:{PREVIEW_CONTAINER_PORT}", check=False)
+            if probe.returncode == 0:
+                return
+            time.sleep(READY_PROBE_INTERVAL_SECONDS)
+        log_output = _docker("exec", slot.container_name, "tail", "-n", "20", "/tmp/preview.log", check=False).stdout
+        raise CustomError(f"The preview of {slot.project} wasn't ready after {self.ready_timeout_seconds} seconds:\n"
+                          f"{log_output}", error_type="preview_timeout")
+
+    def _remove_container(self, slot: PreviewSlot) -> None:
+        _docker("rm", "-f", slot.container_name, check=False)
+        with self._condition:
+            was_running = slot.running
+            slot.running = False
+            slot.project = None
+        if was_running:
+            self._warm_gauge.dec()
+
+    def _start_reaper(self) -> None:
+        with self._condition:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap, name="preview_pool_reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self) -> None:
+        while not self._closed.wait(min(60.0, self.idle_timeout_seconds / 2)):
+            try:
+                self.recycle_idle()
+            except Exception as e:
+                log_it(logger, error=e, custom_message="Recycling idle preview containers failed", log_level='error')
+
+
+def _docker(*args: str, check: bool = True) -> subprocess.CompletedProcess:
+    return subprocess.run(["docker", *args], check=check, capture_output=True, text=True)
+
+
+_preview_pool: Optional[PreviewPool] = None
+_preview_pool_lock = threading.Lock()
+
+
+def get_preview_pool() -> PreviewPool:
+    """
+    Returns the pool used by run_react_website(..., 'preview'), set up from the PREVIEW_POOL section of config.yaml, EX:
+    PREVIEW_POOL:
+      PROJECTS_FOLDER: /container/projects
+      HOST_OS_PROJECT_PATH: /home/alex/Documents/Code/ai_projects
+      SIZE: 2
+      IDLE_TIMEOUT_SECONDS: 900
+      BASE_PORT: 3100
+    :return: the PreviewPool
+    """
+    global _preview_pool
+    with _preview_pool_lock:
+        if _preview_pool is None:
+            pool_config: Dict[str, Any] = State.config.get("PREVIEW_POOL") or {}
+            _preview_pool = PreviewPool(projects_folder=pool_config.get("PROJECTS_FOLDER", "/container/projects"),
+                                        host_os_project_path=pool_config["HOST_OS_PROJECT_PATH"],
+                                        size=int(pool_config.get("SIZE", 2)),
+                                        idle_timeout_seconds=float(pool_config.get("IDLE_TIMEOUT_SECONDS", 900)),
+                                        base_port=int(pool_config.get("BASE_PORT", 3100)),
+                                        host=pool_config.get("HOST", "localhost"))
+        return _preview_pool
+
+
+def configure_preview_pool(**kwargs) -> PreviewPool:
+    """
+    Replaces the pool used by run_react_website, the containers of the old pool are removed
+    :param kwargs: the arguments of PreviewPool
+    :return: the new PreviewPool
+    """
+    global _preview_pool
+    with _preview_pool_lock:
+        if _preview_pool is not None:
+            _preview_pool.shutdown()
+        _preview_pool = PreviewPool(**kwargs)
+        return _preview_pool
@@ -1,25 +1,46 @@
 import os
+import re
 import subprocess
 from typing import Optional
 
 from global_code.helpful_functions import log_it, create_logger_error
+from global_code.metrics import get_metrics_registry
+from react.compose_supervisor import ComposeHandle, start_compose, DEFAULT_READY_PATTERN
+
+# Histogram of how long each docker build/run step took, labeled with the step
+DOCKER_STEP_METRIC = "docker_step_duration_seconds"
 
 
 def run_react_website(project_path: str, type_of_run: str):
     """
     This function will start up the react website
     :param project_path: The path to the project folder.
-    :param type_of_run: The type of environment to run the project in. It Can be either 'docker' or 'docker_compose'.
-    :return:
+    :param type_of_run: The type of environment to run the project in. It Can be either 'docker', 'docker_compose'
+    or 'preview' (the dev server in a warm container of the preview pool, see react.preview_pool).
+    :return: for docker_compose the ComposeHandle of the running project, for preview the PreviewSlot serving it
+    (give it back with get_preview_pool().release(slot))
     """
     if type_of_run == 'docker':
         run_with_docker(project_path)
+    elif type_of_run == 'preview':
+        # Imported here, the preview pool uses the scaffold settings of create_react_project which imports this file
+        from react.preview_pool import get_preview_pool
+
+        return get_preview_pool().preview(project_path)
     elif type_of_run == 'docker_compose':
         x = run_with_docker_compose(project_path)
         # clear_docker_logs(project_path)
         return x
 
 
+def get_project_image_tag(project_path: str) -> str:
+    """
+    :return: the docker image tag of the project, docker tags have to be lowercase
+    """
+    project_name = os.path.basename(os.path.normpath(project_path))
+    return f"{re.sub(r'[^a-z0-9_.-]', '_', project_name.lower())}_container"
+
+
 def run_with_docker(project_path: str):
     """
     Runs the Python project in a safe, containerized environment using Docker.
@@ -41,12 +62,16 @@ def run_with_docker(project_path: str):
         log_it(logger, error=e, custom_message=what_to_log, log_level='critical')
         return
 
+    # Every project gets its own image, so building one project never replaces the image of another
+    image_tag = get_project_image_tag(project_path)
+
     # Step 1: Build the Docker container
-    build_command = ["docker", "build", "-t", "python_project_container", "."]
+    build_command = ["docker", "build", "-t", image_tag, "."]
     try:
         log_it(logger, error=None, custom_message="Building Docker container for the Python project...",
                log_level='info')
-        subprocess.run(build_command, check=True, cwd=project_path)
+        with get_metrics_registry().time(DOCKER_STEP_METRIC, step='build'):
+            subprocess.run(build_command, check=True, cwd=project_path)
     except subprocess.CalledProcessError:
         log_it(logger, error=None, custom_message="Failed to build the Docker container. Please check your Dockerfile.",
                log_level='critical')
@@ -57,11 +82,12 @@ def run_with_docker(project_path: str):
         return
 
     # Step 2: Run the Docker container
-    run_command = ["docker", "run", "--rm", "python_project_container"]
+    run_command = ["docker", "run", "--rm", image_tag]
     try:
         log_it(logger, error=None, custom_message="Running the Python project in a Docker container...",
                log_level='info')
-        subprocess.run(run_command, check=True, cwd=project_path)
+        with get_metrics_registry().time(DOCKER_STEP_METRIC, step='run'):
+            subprocess.run(run_command, check=True, cwd=project_path)
     except subprocess.CalledProcessError:
         log_it(logger, error=None,
                custom_message="Failed to run the Docker container. Please check if the container's entry "
@@ -76,11 +102,18 @@ def run_with_docker(project_path: str):
            log_level='info')
 
 
-def run_with_docker_compose(project_path: str) -> Optional[str]:
+def run_with_docker_compose(project_path: str, ready_pattern: Optional[str] = DEFAULT_READY_PATTERN,
+                            ready_url: Optional[str] = None,
+                            ready_timeout: Optional[float] = 300) -> Optional[ComposeHandle]:
     """
     Runs the Python project in a safe, containerized environment using Docker Compose.
+    Compose runs detached, its logs are streamed into the handle in the background (see react.compose_supervisor).
     :param project_path: The path to the project folder.
-    :return: Either None or the output of the process
+    :param ready_pattern: the project is ready once a log line matches it
+    :param ready_url: the project is ready once this url answers, EX: http://localhost:80
+    :param ready_timeout: how long to wait for the project to be ready, None to not wait
+    :return: Either None or the handle of the running project, use handle.tail() for the output,
+    handle.wait() to wait for it to exit and handle.stop() to stop it
     """
     logger = create_logger_error(os.path.abspath(__file__), 'run_project', log_to_console=True,
                                  log_to_file=False)
@@ -97,27 +130,27 @@ def run_with_docker_compose(project_path: str) -> Optional[str]:
         log_it(logger, error=e, custom_message=what_to_log, log_level='critical')
         return
 
-    # Step 1: Run docker compose
-    build_command = ["docker-compose", "up", "--build"]
-    logs_command = ["docker-compose", "logs"]
-    try:
-        log_it(logger, error=None, custom_message="Running docker_compose.yml file container for the React project...",
-               log_level='info')
-        output2 = subprocess.run(build_command, check=True, cwd=project_path, stderr=subprocess.PIPE, text=True)
-        output = subprocess.run(logs_command, check=True, cwd=project_path, capture_output=True, text=True)
-    except subprocess.CalledProcessError as err:
-        log_it(logger, error=None, custom_message=f"Something went wrong with subprocess.CalledProcessError {err}",
-               log_level='critical')
-        return
-    except Exception as e:
-        log_it(logger, error=e, custom_message="An unexpected error occurred during the build process",
+    # Step 1: Run docker compose in the background
+    log_it(logger, error=None, custom_message="Running docker_compose.yml file container for the React project...",
+           log_level='info')
+    handle = start_compose(project_path, ready_pattern=ready_pattern, ready_url=ready_url)
+    if ready_timeout is None:
+        return handle
+
+    # Step 2: Wait until it is serving
+    with get_metrics_registry().time(DOCKER_STEP_METRIC, step='compose_up'):
+        is_ready = handle.wait_ready(ready_timeout)
+    if not is_ready:
+        what_went_wrong = handle.error or f"the project wasn't ready after {ready_timeout} seconds"
+        log_it(logger, error=None, custom_message=f"Something went wrong with docker-compose, {what_went_wrong}:\n"
+                                                  + "\n".join(handle.tail(20)),
                log_level='critical')
-        return
+        return handle
 
     log_it(logger, error=None, custom_message="React project ran successfully in a Docker container.",
            log_level='info')
 
-    return output.stdout
+    return handle
 
 
 def clear_docker_logs(project_path: str):
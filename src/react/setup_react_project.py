@@ -2,6 +2,8 @@ import os
 import subprocess
 from typing import Optional
 
+from global_code.workspace_writer import WorkspaceWriter
+
 
 def setup_project_react(project_path_input: str, project_name: str,
                   host_os_project_path: str) -> None:
@@ -48,17 +50,11 @@ def setup_project_react(project_path_input: str, project_name: str,
     os.makedirs(services_directory, exist_ok=True)
     os.makedirs(routes_directory, exist_ok=True)
 
-    with open(dockerignore_file_path, 'w') as req_file:
-        req_file.write(dockerignore_content)
-
-    with open(gitignore_file_path, 'w') as req_file:
-        req_file.write(gitignore_content)
-
-    with open(os.path.join(project_path2, 'Dockerfile.prod'), 'w') as dockerfile:
-        dockerfile.write(dockerfile_content)
-
-    with open(os.path.join(project_path2, 'docker-compose.yaml'), 'w') as docker_compose:
-        docker_compose.write(docker_compose_content)
+    with WorkspaceWriter(project_path2) as writer:
+        writer.add(dockerignore_file_path, dockerignore_content)
+        writer.add(gitignore_file_path, gitignore_content)
+        writer.add('Dockerfile.prod', dockerfile_content)
+        writer.add('docker-compose.yaml', docker_compose_content)
 
 
 def create_gitignore_file() -> str:
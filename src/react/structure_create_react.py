@@ -1,60 +1,284 @@
+import hashlib
 import json
 import os
-from typing import Dict, Union
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from typing import Dict, Union, List, Tuple, Optional
 
-from code_creation.architect.react.crud_js_file import create_base_js_file
+from global_code.helpful_functions import create_logger_error, log_it, CustomError
+from global_code.workspace_writer import WorkspaceWriter
+from react.crud_js_file import create_base_js_text
 from prompts.react_frontend import ReactPrompts
 
+logger = create_logger_error(os.path.abspath(__file__), "structure_create_react",
+                             log_to_console=True, log_to_file=True)
+
+# Only these files get real code generated for them, everything else (EX: DIRECTORY_README.md) stays a stub
+CODE_FILE_EXTENSIONS = (".js", ".jsx")
+# What the last run was built from, read back by incremental runs
+STRUCTURE_FILE = "STRUCTURE_JSON.md"
+SCOPE_FILE = "SCOPE.md"
+DESIGN_FILE = "DESIGN.md"
+DESCRIPTION_FILE = "DESCRIPTION.md"
+# Not a file of the folder, the blueprint the folder was made from
+DIRECTORY_README_FILE = "DIRECTORY_README.md"
+
 
 def create_react_ai_structure(project_path: str, project_name: str, description_to_build: str,
-                              host_os_project_path: str) -> Dict[str, Union[str, Dict[str, str]]]:
+                              host_os_project_path: str,
+                              max_concurrent_folders: int = 8,
+                              incremental: bool = False, scope_blueprint: Optional[str] = None,
+                              design_blueprint: Optional[str] = None,
+                              batch_directories: bool = True) -> Dict[str, Union[str, Dict[str, str]]]:
     """
     The AI creates the structure for the react project.
     :param project_path: The path to the project.
     :param project_name: The name of the project.
     :param description_to_build: The description of the project to build.
     :param host_os_project_path: The path to the project on the host OS. WILL BE THE HIGH LEVEL WITH ALL OTHER PROJECTS
+    :param max_concurrent_folders: How many folder blueprints can be generated at the same time.
+    :param incremental: Reuse what the last run made. If the description didn't change nothing is generated,
+    otherwise the scope, design and high level structure are, and only the folders whose blueprint changed.
+    :param scope_blueprint: the scope if it was already made, EX: by an earlier step of the workflow
+    :param design_blueprint: the design if it was already made, it has to be made from scope_blueprint
+    :param batch_directories: make the files of every folder with one call, see create_directories_concurrently
     :return: The structure of the project.
     """
-    scope_blueprint: str = ReactPrompts.create_scope(project_name=project_name,
-                              project_description=description_to_build)
-    design_blueprint: str = ReactPrompts.designer(project_name=project_name, project_description=description_to_build,
-                                                  design_blueprint=scope_blueprint)
+    previous_structure = load_previous_structure(project_path) if incremental else None
+    structure_plan = plan_react_structure(project_path, project_name, description_to_build,
+                                          max_concurrent_folders=max_concurrent_folders,
+                                          previous_structure=previous_structure, scope_blueprint=scope_blueprint,
+                                          design_blueprint=design_blueprint, batch_directories=batch_directories)
+    write_structure_artifacts(project_path, structure_plan, description_to_build)
+    return structure_plan["structure"]
+
+
+def plan_react_structure(project_path: str, project_name: str, description_to_build: str,
+                         max_concurrent_folders: int = 8,
+                         previous_structure: Optional[Dict[str, Dict[str, str]]] = None,
+                         scope_blueprint: Optional[str] = None,
+                         design_blueprint: Optional[str] = None,
+                         batch_directories: bool = True) -> Dict[str, Union[str, Dict[str, Dict[str, str]]]]:
+    """
+    Every LLM call of create_react_ai_structure, nothing is written.
+    The project folder is only read (for an incremental run), so this can run before the project is scaffolded.
+    :param project_path: The path to the project.
+    :param project_name: The name of the project.
+    :param description_to_build: The description of the project to build.
+    :param max_concurrent_folders: How many folder blueprints can be generated at the same time.
+    :param previous_structure: the structure of the last run (load_previous_structure), makes it incremental.
+    If the description didn't change it is reused, otherwise only the folders whose blueprint changed are made again.
+    :param scope_blueprint: the scope if it was already made, EX: by an earlier step of the workflow
+    :param design_blueprint: the design if it was already made, it has to be made from scope_blueprint
+    :param batch_directories: make the files of every folder with one call, see create_directories_concurrently
+    :return: {"structure": the structure of the project, "scope": the scope, "design": the design}
+    """
+    if previous_structure is not None and _read_text(project_path, DESCRIPTION_FILE) == description_to_build:
+        previous_scope = _read_text(project_path, SCOPE_FILE)
+        previous_design = _read_text(project_path, DESIGN_FILE)
+        if previous_scope is not None and previous_design is not None:
+            log_it(logger, error=None, custom_message="The description didn't change, reusing the last structure",
+                   log_level="info")
+            return {"structure": previous_structure, "scope": previous_scope, "design": previous_design}
+
+    if scope_blueprint is None:
+        scope_blueprint = ReactPrompts.create_scope(project_name=project_name,
+                                                    project_description=description_to_build)
+    if design_blueprint is None:
+        design_blueprint = ReactPrompts.designer(project_name=project_name, project_description=description_to_build,
+                                                 design_blueprint=scope_blueprint)
     high_level_of_structure: Dict[str, str] = (ReactPrompts
                                .create_high_level_structure(project_reqs=scope_blueprint,
                                                            design_blueprint=design_blueprint))
     # high level structure will represent the 8 main folders of the react project, they can be nothing
+    new_structure: Dict[str, Dict[str, str]] = create_directories_concurrently(high_level_of_structure,
+                                                                               max_concurrent_folders,
+                                                                               previous_structure=previous_structure,
+                                                                               batch_directories=batch_directories)
+    return {"structure": new_structure, "scope": scope_blueprint, "design": design_blueprint}
+
+
+def write_structure_artifacts(project_path: str, structure_plan: Dict[str, Union[str, Dict[str, Dict[str, str]]]],
+                              description_to_build: str) -> None:
+    """
+    Writes STRUCTURE_JSON.md, SCOPE.md, DESIGN.md and DESCRIPTION.md to the project folder
+    :param project_path: The path to the project, it has to exist.
+    :param structure_plan: what plan_react_structure returned
+    :param description_to_build: The description of the project to build.
+    :return: None
+    """
+    with WorkspaceWriter(project_path) as writer:
+        # create a structure.md file in the project folder
+        writer.add(STRUCTURE_FILE, json.dumps(structure_plan["structure"]))
+        # Create the scope.md file in the project folder
+        writer.add(SCOPE_FILE, structure_plan["scope"])
+        # Create the design.md file in the project folder
+        writer.add(DESIGN_FILE, structure_plan["design"])
+        # What it was built from, so an incremental run knows if anything changed
+        writer.add(DESCRIPTION_FILE, description_to_build)
+
+
+def load_previous_structure(project_path: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """
+    Reads back the structure the last run wrote to STRUCTURE_JSON.md
+    :param project_path: The path to the project.
+    :return: the structure, None if there is no (readable) structure
+    """
+    structure_text = _read_text(project_path, STRUCTURE_FILE)
+    if structure_text is None:
+        return None
+    try:
+        structure = json.loads(structure_text)
+    except ValueError as e:
+        log_it(logger, error=e, custom_message=f"{STRUCTURE_FILE} can't be read, rebuilding everything",
+               log_level="warning")
+        return None
+    return structure if isinstance(structure, dict) else None
+
+
+def _read_text(project_path: str, file_name: str) -> Optional[str]:
+    try:
+        with open(os.path.join(project_path, file_name), "r") as text_file:
+            return text_file.read()
+    except OSError:
+        return None
+
+
+def create_directories_concurrently(high_level_of_structure: Dict[str, str],
+                                   max_concurrent_folders: int = 8,
+                                   previous_structure: Optional[Dict[str, Dict[str, str]]] = None,
+                                   batch_directories: bool = True) -> Dict[str, Dict[str, str]]:
+    """
+    Makes the files of every folder.
+    With batch_directories every folder is made with one call (create_all_directories), only the folders it got
+    wrong go through the directory blueprint chain (3 calls each).
+    The chain runs for every folder at the same time, each folder is independent of the others,
+    so they are fanned out over a bounded thread pool.
+    The results are merged back in the same order as the high level structure, so the output is deterministic.
+    :param high_level_of_structure: folder name -> folder blueprint, an empty blueprint means an empty folder
+    :param max_concurrent_folders: the max number of folders being generated at once
+    :param previous_structure: the structure of the last run, matched by folder name.
+    A folder with the same blueprint (ignoring case and whitespace) is reused as it is, the files of the other folders
+    are given to the prompts so the files that still fit keep their names and descriptions
+    (and so their code, see create_react_physical_structure).
+    :param batch_directories: try making every folder with one call first
+    :return: folder name -> {file name: file description}
+    """
+    if max_concurrent_folders < 1:
+        raise ValueError("max_concurrent_folders must be at least 1")
+
+    reused_folders: Dict[str, Dict[str, str]] = {}
+    previous_files: Dict[str, Dict[str, str]] = {}
+    for folder, folder_blueprint in high_level_of_structure.items():
+        previous_folder = (previous_structure or {}).get(folder)
+        if folder_blueprint == "" or not isinstance(previous_folder, dict) or previous_folder.get("empty"):
+            continue
+        if description_fingerprint(previous_folder.get(DIRECTORY_README_FILE, "")) \
+                == description_fingerprint(folder_blueprint):
+            reused_folders[folder] = dict(previous_folder)
+        else:
+            previous_files[folder] = {file: description for file, description in previous_folder.items()
+                                      if file != DIRECTORY_README_FILE}
+    if previous_structure is not None:
+        log_it(logger, error=None, custom_message=f"Reusing {len(reused_folders)} folder blueprints from the last run, "
+                                                  f"keeping the files of {len(previous_files)} more where they fit",
+               log_level="info")
+
+    folders_to_make = {folder: folder_blueprint for folder, folder_blueprint in high_level_of_structure.items()
+                       if folder_blueprint != "" and folder not in reused_folders}
+    batched_folders: Dict[str, Dict[str, str]] = {}
+    if batch_directories and folders_to_make:
+        batched_folders = create_all_directories(folders_to_make, previous_files)
+
+    futures: Dict[str, Future] = {}
+    with ThreadPoolExecutor(max_workers=max_concurrent_folders) as executor:
+        for folder, folder_blueprint in folders_to_make.items():
+            if folder in batched_folders:
+                continue
+            futures[folder] = executor.submit(ReactPrompts.create_directory, directory_name=folder,
+                                              directory_blueprint=folder_blueprint,
+                                              previous_files=previous_files.get(folder))
+
     new_structure: Dict[str, Dict[str, str]] = {}
     for folder, folder_blueprint in high_level_of_structure.items():
         if folder_blueprint == "":
             new_structure[folder] = {"empty": "empty"}
             continue
-        created_dir: Dict[str, str] = ReactPrompts.create_directory(directory_name=folder,
-                                             directory_blueprint=folder_blueprint)
-        created_dir["DIRECTORY_README.md"] = folder_blueprint
+        if folder in reused_folders:
+            new_structure[folder] = reused_folders[folder]
+            continue
+        created_dir: Dict[str, str] = batched_folders[folder] if folder in batched_folders \
+            else futures[folder].result()
+        created_dir[DIRECTORY_README_FILE] = folder_blueprint
         new_structure[folder] = created_dir
+    return new_structure
 
-    # create a structure.md file in the project folder
-    with open(f"{project_path}/STRUCTURE_JSON.md", "w") as structure_file:
-        structure_file.write(json.dumps(new_structure))
-    # Create the scope.md file in the project folder
-    with open(f"{project_path}/SCOPE.md", "w") as scope_file:
-        scope_file.write(scope_blueprint)
-    # Create the design.md file in the project folder
-    with open(f"{project_path}/DESIGN.md", "w") as design_file:
-        design_file.write(design_blueprint)
 
-    return new_structure
+def create_all_directories(directory_blueprints: Dict[str, str],
+                           previous_files: Optional[Dict[str, Dict[str, str]]] = None) -> Dict[str, Dict[str, str]]:
+    """
+    Makes the files of every folder with one call
+    :param directory_blueprints: folder name -> folder blueprint
+    :param previous_files: folder name -> the files the last run made for it
+    :return: folder name -> {file name: file description}, only for the folders the answer got right
+    """
+    try:
+        created_dirs = ReactPrompts.create_all_directories(directory_blueprints=directory_blueprints,
+                                                           previous_directories=previous_files)
+    except CustomError as e:
+        log_it(logger, error=e, custom_message="Making every folder with one call failed, making them one by one",
+               log_level="warning")
+        return {}
+    valid_dirs = {folder: dict(created_dirs[folder]) for folder in directory_blueprints
+                  if _is_valid_directory(created_dirs.get(folder))}
+    if len(valid_dirs) < len(directory_blueprints):
+        log_it(logger, error=None, custom_message=f"Making {sorted(set(directory_blueprints) - set(valid_dirs))} "
+                                                  f"one by one, the batched answer got them wrong",
+               log_level="info")
+    return valid_dirs
 
 
-def create_react_physical_structure(project_path: str, structure: Dict[str, Dict[str, str]]):
+def _is_valid_directory(created_dir: Optional[Dict[str, str]]) -> bool:
+    """
+    :return: True if it has files, and every file is a file name (no folders) with a description
+    """
+    if not isinstance(created_dir, dict) or not created_dir:
+        return False
+    return all(isinstance(description, str) and description.strip() and "." in file_name.strip(".")
+               and "/" not in file_name and "\\" not in file_name
+               for file_name, description in created_dir.items())
+
+
+def create_react_physical_structure(project_path: str, structure: Dict[str, Dict[str, str]],
+                                    generate_code: bool = True, max_concurrent_components: int = 8,
+                                    max_concurrent_css: int = 8,
+                                    max_concurrent_tests: int = 8,
+                                    previous_structure: Optional[Dict[str, Dict[str, str]]] = None
+                                    ) -> Dict[str, List[str]]:
     """
     Create the physical structure of the react project.
     :param project_path: The path to the project.
     :param structure: The structure of the project.
-    :return:
+    :param generate_code: If True the component, css and test code is generated for every js file,
+    if False only the base js files are written.
+    :param max_concurrent_components: max component code generations running at once
+    :param max_concurrent_css: max css generations running at once
+    :param max_concurrent_tests: max test generations running at once
+    :param previous_structure: the structure of the last run (load_previous_structure), makes it incremental.
+    A file is only made again if its description changed or one of its outputs is missing,
+    a changed component always gets its css and test made again too.
+    The outputs of files that aren't in the structure anymore are deleted.
+    Every file is written atomically with a WorkspaceWriter, the stub files in one batch before the code generation
+    starts, and the generated files one by one as they finish.
+    :return: file path in the structure -> every file written for it
     """
     src_path = os.path.join(project_path, "src")
+    written_files: Dict[str, List[str]] = {}
+    code_files: List[Tuple[str, str]] = []
+    if previous_structure is not None:
+        delete_stale_outputs(src_path, previous_structure, structure, generate_code)
+    skipped_files = 0
+    stub_writer = WorkspaceWriter(project_path)
     for folder, folder_structure in structure.items():
         if folder_structure.get("empty"):
             continue
@@ -62,8 +286,167 @@ def create_react_physical_structure(project_path: str, structure: Dict[str, Dict
         for file, file_structure in folder_structure.items():
             if file == "empty":
                 continue
-            create_base_js_file(file_path=f"{folder_path}/{file}", description=file_structure)
-    return
+            file_path = f"{folder_path}/{file}"
+            if previous_structure is not None and _is_up_to_date(file_path, file_structure,
+                                                                 previous_structure.get(folder), file, generate_code):
+                skipped_files += 1
+                continue
+            if generate_code and file.endswith(CODE_FILE_EXTENSIONS):
+                code_files.append((file_path, file_structure))
+                continue
+            stub_writer.add(file_path, create_base_js_text(description=file_structure))
+            written_files[file_path] = [file_path]
+    stub_writer.flush()
+
+    if previous_structure is not None:
+        log_it(logger, error=None, custom_message=f"Incremental build: {skipped_files} files are up to date, "
+                                                  f"{len(written_files) + len(code_files)} are being made",
+               log_level="info")
+
+    if code_files:
+        written_files.update(generate_component_files(code_files,
+                                                      max_concurrent_components=max_concurrent_components,
+                                                      max_concurrent_css=max_concurrent_css,
+                                                      max_concurrent_tests=max_concurrent_tests,
+                                                      writer=WorkspaceWriter(project_path, max_pending_files=1)))
+    return written_files
+
+
+def get_file_outputs(file_path: str, generate_code: bool = True) -> List[str]:
+    """
+    Every file that is made for a file of the structure, a component has its css and test file depending on it
+    :param file_path: the path of the file in the structure
+    :return: the paths of every output
+    """
+    if generate_code and file_path.endswith(CODE_FILE_EXTENSIONS):
+        base_path = os.path.splitext(file_path)[0]
+        return [file_path, f"{base_path}.css", f"{base_path}.test.js"]
+    return [file_path]
+
+
+def delete_stale_outputs(src_path: str, previous_structure: Dict[str, Dict[str, str]],
+                         structure: Dict[str, Dict[str, str]], generate_code: bool = True) -> List[str]:
+    """
+    Deletes the outputs of the files that were in the last structure but aren't in this one
+    :return: the deleted paths
+    """
+    deleted: List[str] = []
+    for folder, previous_folder in previous_structure.items():
+        if not isinstance(previous_folder, dict) or previous_folder.get("empty"):
+            continue
+        folder_structure = structure.get(folder) or {}
+        for file in previous_folder:
+            if file == "empty" or (file in folder_structure and not folder_structure.get("empty")):
+                continue
+            for output_path in get_file_outputs(f"{src_path}/{folder}/{file}", generate_code):
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                    deleted.append(output_path)
+    if deleted:
+        log_it(logger, error=None, custom_message=f"Deleted {len(deleted)} files that aren't in the structure anymore",
+               log_level="info")
+    return deleted
+
+
+def _is_up_to_date(file_path: str, description: str, previous_folder: Optional[Dict[str, str]], file: str,
+                   generate_code: bool) -> bool:
+    """
+    Matched by path, the file has to be in the same folder with the same name
+    :return: True if the file has the same description as the last run (ignoring case and whitespace)
+    and every output of it exists
+    """
+    if not isinstance(previous_folder, dict) or not isinstance(previous_folder.get(file), str) \
+            or description_fingerprint(previous_folder[file]) != description_fingerprint(description):
+        return False
+    return all(os.path.exists(output_path) for output_path in get_file_outputs(file_path, generate_code))
+
+
+def description_fingerprint(description: str) -> str:
+    """
+    :return: a hash of the description that doesn't change with case or whitespace
+    """
+    normalized = " ".join(description.split()).lower()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def generate_component_files(code_files: List[Tuple[str, str]], max_concurrent_components: int = 8,
+                             max_concurrent_css: int = 8, max_concurrent_tests: int = 8,
+                             writer: Optional[WorkspaceWriter] = None) -> Dict[str, List[str]]:
+    """
+    Pipelined code generation for every js file.
+    Component code is generated for up to max_concurrent_components files at once, streamed so it is done the moment
+    the code block closes. Every stage has its own pool, sized to its limit.
+    As soon as a file's component code exists it is written,
+    and its css and test code are generated at the same time (they both depend on the component code).
+    Every output is added to the writer the moment it finishes, a writer with max_pending_files=1 writes it right away.
+    If the component code fails the base js file is written instead, so the file still exists.
+    :param code_files: (file path, description of the file)
+    :param max_concurrent_components: max component code generations running at once
+    :param max_concurrent_css: max css generations running at once
+    :param max_concurrent_tests: max test generations running at once
+    :param writer: where the outputs go, None to write every output as it finishes
+    :return: file path -> every file written for it
+    """
+    if writer is None:
+        with WorkspaceWriter(os.path.commonpath([os.path.dirname(file_path) for file_path, _ in code_files])
+                             if code_files else os.getcwd(), max_pending_files=1) as own_writer:
+            return generate_component_files(code_files, max_concurrent_components, max_concurrent_css,
+                                            max_concurrent_tests, writer=own_writer)
+    if min(max_concurrent_components, max_concurrent_css, max_concurrent_tests) < 1:
+        raise ValueError("Every stage needs a concurrency limit of at least 1")
+    written_files: Dict[str, List[str]] = {file_path: [] for file_path, _ in code_files}
+    written_files_lock = threading.Lock()
 
+    def write_output(file_path: str, output_path: str, code: str):
+        writer.add(output_path, code)
+        with written_files_lock:
+            written_files[file_path].append(output_path)
 
+    def component_stage(file_path: str, description: str) -> str:
+        component_code: str = ReactPrompts.create_component_code_streaming(description_of_code=description)
+        writer.add(file_path, create_base_js_text(description=description, code=component_code))
+        with written_files_lock:
+            written_files[file_path].append(file_path)
+        return component_code
+
+    def css_stage(file_path: str, description: str, component_code: str):
+        css_code: str = ReactPrompts.create_css_code(description_of_code=description, component_code=component_code)
+        write_output(file_path, f"{os.path.splitext(file_path)[0]}.css", css_code)
+
+    def test_stage(file_path: str, description: str, component_code: str):
+        test_code: str = ReactPrompts.create_js_test_code(description_of_code=description,
+                                                          component_code=component_code)
+        write_output(file_path, f"{os.path.splitext(file_path)[0]}.test.js", test_code)
+
+    # One pool per stage, sized to its limit, so the css and test code of a finished component never queue
+    # behind the components still waiting for a thread
+    with ThreadPoolExecutor(max_workers=max_concurrent_components, thread_name_prefix="component_code") as \
+            component_executor, \
+            ThreadPoolExecutor(max_workers=max_concurrent_css, thread_name_prefix="css_code") as css_executor, \
+            ThreadPoolExecutor(max_workers=max_concurrent_tests, thread_name_prefix="test_code") as test_executor:
+        component_futures: Dict[Future, Tuple[str, str]] = {
+            component_executor.submit(component_stage, file_path, description): (file_path, description)
+            for file_path, description in code_files}
+        follow_up_futures: Dict[Future, str] = {}
+        for future in as_completed(component_futures):
+            file_path, description = component_futures[future]
+            try:
+                component_code = future.result()
+            except Exception as e:
+                log_it(logger, error=e, custom_message=f"Failed to generate the component code for {file_path}",
+                       log_level="error")
+                writer.add(file_path, create_base_js_text(description=description))
+                with written_files_lock:
+                    written_files[file_path].append(file_path)
+                continue
+            follow_up_futures[css_executor.submit(css_stage, file_path, description, component_code)] = file_path
+            follow_up_futures[test_executor.submit(test_stage, file_path, description, component_code)] = file_path
 
+        for future in as_completed(follow_up_futures):
+            try:
+                future.result()
+            except Exception as e:
+                log_it(logger, error=e,
+                       custom_message=f"Failed to generate the css or test code for {follow_up_futures[future]}",
+                       log_level="error")
+    return written_files
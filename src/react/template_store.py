@@ -0,0 +1,214 @@
+"""
+Template store, a scaffolded project is only made once for each (PROJECT_TYPE, UI_LIB, STATE_MANAGEMENT_LIB)
+and every new project is cloned from it, instead of running docker, create-react-app and setup_project_react
+for every project.
+The store lives in <projects_folder>/.template_store/<key>/<key>, <key> being the settings and the scaffold version.
+Cloning tries, in order:
+    reflink: copy on write clone of every file (btrfs, xfs, ...), instant and nothing is shared
+    hardlink: node_modules is hardlinked (it is never edited in place), everything else is copied
+    copy: a plain copy
+Only the project specific files (package.json, package-lock.json, docker-compose.yaml) are rewritten after the clone.
+"""
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from global_code.helpful_functions import create_logger_error, log_it, CustomError
+from global_code.metrics import get_metrics_registry
+from react.create_react_project import create_setup_project_sh, create_seed_project_sh, create_setup_docker, \
+    run_setup_docker_for_react, SCAFFOLD_VERSION
+from react.setup_react_project import setup_project_react, create_docker_compose_file
+
+logger = create_logger_error(os.path.abspath(__file__), "template_store", log_to_console=True, log_to_file=True)
+
+TEMPLATE_STORE_FOLDER = ".template_store"
+# Written once the template is fully made, a template without it is made again
+TEMPLATE_COMPLETE_MARKER = ".template_complete"
+CLONE_STRATEGIES = ["reflink", "hardlink", "copy"]
+
+_template_locks: Dict[str, threading.Lock] = {}
+_template_locks_lock = threading.Lock()
+
+
+def get_template_key(project_type: str = "cra", ui_lib: str = "material-ui",
+                     state_management_lib: str = "redux") -> str:
+    """
+    :return: the name of the template, it is also its folder and package name
+    """
+    return f"{project_type}-{ui_lib}-{state_management_lib}-v{SCAFFOLD_VERSION}".lower()
+
+
+def get_template_path(projects_folder: str, template_key: str) -> str:
+    """
+    :return: the path of the scaffolded template project
+    """
+    return os.path.join(projects_folder, TEMPLATE_STORE_FOLDER, template_key, template_key)
+
+
+def materialize_template(projects_folder: str, host_os_project_path: str, project_type: str = "cra",
+                         ui_lib: str = "material-ui", state_management_lib: str = "redux") -> Optional[str]:
+    """
+    Makes the template project if it isn't in the store yet, with the same docker flow a normal project uses.
+    :param projects_folder: The folder with all the projects
+    :param host_os_project_path: The same folder on the host OS
+    :return: the path of the template project, None if it couldn't be made
+    """
+    template_key = get_template_key(project_type, ui_lib, state_management_lib)
+    template_path = get_template_path(projects_folder, template_key)
+    with _get_template_lock(template_key):
+        if os.path.exists(os.path.join(template_path, TEMPLATE_COMPLETE_MARKER)):
+            return template_path
+
+        log_it(logger, error=None, custom_message=f"Materializing the template {template_key}, this only happens once",
+               log_level='info')
+        store_folder = os.path.join(projects_folder, TEMPLATE_STORE_FOLDER)
+        host_os_store_folder = os.path.join(host_os_project_path, TEMPLATE_STORE_FOLDER)
+        key_folder = os.path.join(store_folder, template_key)
+        os.makedirs(key_folder, exist_ok=True)
+
+        create_setup_project_sh(key_folder)
+        create_seed_project_sh(key_folder)
+        create_setup_docker(key_folder)
+        run_setup_docker_for_react(key_folder, template_key, host_os_store_folder, project_type=project_type,
+                                   ui_lib=ui_lib, state_management_lib=state_management_lib)
+        if not os.path.exists(os.path.join(template_path, "package.json")):
+            log_it(logger, error=None, custom_message=f"The scaffold of the template {template_key} failed",
+                   log_level='critical')
+            return None
+        setup_project_react(store_folder, template_key, host_os_store_folder)
+
+        with open(os.path.join(template_path, TEMPLATE_COMPLETE_MARKER), 'w') as marker_file:
+            marker_file.write(str(time.time()))
+        return template_path
+
+
+def clone_template(template_path: str, destination: str) -> str:
+    """
+    Clones the template into destination, with the cheapest strategy the filesystem supports.
+    The clone is made in a folder next to destination and renamed into place, so a clone that fails only removes
+    what it made, and never leaves a half made project behind.
+    CAN RAISE AN ERROR: CustomError if destination already exists
+    :param template_path: the path of the template project
+    :param destination: the path of the new project, it can't exist yet
+    :return: the strategy that was used (one of CLONE_STRATEGIES)
+    """
+    if os.path.lexists(destination):
+        raise CustomError(f"Can't clone a template into {destination}, it already exists",
+                          error_type="template_destination_exists")
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    staging_path = f"{destination}.cloning-{os.getpid()}-{threading.get_ident()}"
+    try:
+        strategy = _clone_into(template_path, staging_path)
+        os.rename(staging_path, destination)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+    return strategy
+
+
+def rewrite_project_files(project_path: str, project_name: str, host_os_project_path: str) -> None:
+    """
+    Rewrites the files of a cloned project that have the name or path of the project in them
+    :param project_path: the path of the new project (projects_folder/project_name/project_name)
+    :param project_name: The name of the project.
+    :param host_os_project_path: The path to the projects on the host OS. HIGH LEVEL WITH OTHER PROJECTS
+    :return: None
+    """
+    os.remove(os.path.join(project_path, TEMPLATE_COMPLETE_MARKER))
+
+    for package_file in ["package.json", "package-lock.json"]:
+        package_path = os.path.join(project_path, package_file)
+        if not os.path.exists(package_path):
+            continue
+        with open(package_path, 'r') as package:
+            package_content = json.load(package)
+        package_content["name"] = project_name
+        if "" in package_content.get("packages", {}):
+            package_content["packages"][""]["name"] = project_name
+        with open(package_path, 'w') as package:
+            json.dump(package_content, package, indent=2)
+            package.write("\n")
+
+    host_os = os.path.join(host_os_project_path, project_name, project_name)
+    with open(os.path.join(project_path, 'docker-compose.yaml'), 'w') as docker_compose:
+        docker_compose.write(create_docker_compose_file(host_os, project_name))
+
+
+def create_project_from_template(projects_folder: str, project_name: str, host_os_project_path: str,
+                                 project_type: str = "cra", ui_lib: str = "material-ui",
+                                 state_management_lib: str = "redux") -> bool:
+    """
+    Makes projects_folder/project_name/project_name from the template store,
+    the same project run_setup_docker_for_react + setup_project_react make.
+    :param projects_folder: The folder with all the projects
+    :param project_name: The name of the project.
+    :param host_os_project_path: The path to the projects on the host OS. HIGH LEVEL WITH OTHER PROJECTS
+    :return: True if the project exists after this, False if it couldn't be made from the template store
+    (the folder of the project exists without package.json, or the template couldn't be made)
+    """
+    project_path = os.path.join(projects_folder, project_name, project_name)
+    if os.path.exists(os.path.join(project_path, "package.json")):
+        log_it(logger, error=None, custom_message=f"Project {project_name} already exists", log_level='info')
+        return True
+    if os.path.lexists(project_path):
+        # Cloning would have to merge into or replace what is there, the docker scaffold fills it in instead
+        log_it(logger, error=None, custom_message=f"{project_path} exists without a package.json, "
+                                                  f"not cloning it from the template store", log_level='warning')
+        return False
+
+    template_path = materialize_template(projects_folder, host_os_project_path, project_type, ui_lib,
+                                         state_management_lib)
+    if template_path is None:
+        return False
+
+    strategy, duration = _clone_and_rewrite(template_path, project_path, project_name, host_os_project_path)
+    log_it(logger, error=None, custom_message=f"Scaffolded {project_name} from the template store with {strategy} "
+                                              f"in {duration:.3f}s",
+           log_level='info')
+    return True
+
+
+def _clone_and_rewrite(template_path: str, project_path: str, project_name: str,
+                       host_os_project_path: str) -> Tuple[str, float]:
+    start_time = time.perf_counter_ns()
+    strategy = clone_template(template_path, project_path)
+    rewrite_project_files(project_path, project_name, host_os_project_path)
+    duration_ns = time.perf_counter_ns() - start_time
+    get_metrics_registry().histogram("template_clone_duration_seconds", "How long cloning a template took",
+                                     strategy=strategy).observe_ns(duration_ns)
+    return strategy, duration_ns / 1_000_000_000
+
+
+def _clone_into(template_path: str, destination: str) -> str:
+    """
+    Tries every strategy of CLONE_STRATEGIES in order, destination doesn't exist and is only made here
+    :return: the strategy that worked
+    """
+    try:
+        subprocess.run(["cp", "-r", "--reflink=always", template_path, destination], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return "reflink"
+    except (subprocess.CalledProcessError, OSError):
+        shutil.rmtree(destination, ignore_errors=True)
+
+    node_modules = os.path.join(template_path, "node_modules")
+    if os.path.isdir(node_modules):
+        try:
+            shutil.copytree(template_path, destination, symlinks=True, ignore=shutil.ignore_patterns("node_modules"))
+            shutil.copytree(node_modules, os.path.join(destination, "node_modules"), symlinks=True,
+                            copy_function=os.link)
+            return "hardlink"
+        except OSError:
+            # Hardlinks don't work across filesystems
+            shutil.rmtree(destination, ignore_errors=True)
+
+    shutil.copytree(template_path, destination, symlinks=True)
+    return "copy"
+
+
+def _get_template_lock(template_key: str) -> threading.Lock:
+    with _template_locks_lock:
+        return _template_locks.setdefault(template_key, threading.Lock())